@@ -4,32 +4,45 @@
 # pylint: disable=broad-except
 
 import logging
+import copy
 import os
 import time
 import pickle
 import re
+import json
+import hashlib
+import shutil
+import threading
+import socket
+import signal
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import urlparse
 from io import BytesIO
 import multiprocessing as mp
+import mmap
 import sqlite3
-from typing import Optional, Union, Sequence, List, Callable, Any
+from typing import Optional, Union, Sequence, List, Dict, Callable, Any
 from typing_extensions import TypedDict, Literal
 import numpy as np
 import healpy as hp
 import pyvo as vo
 import cherrypy
-from cherrypy.process.plugins import Daemonizer, PIDFile
+from cherrypy.process.plugins import Daemonizer, PIDFile, Monitor
 import requests
 from astropy.io import fits
-from astropy.table import Table
+from astropy.table import Table, Column, MaskedColumn
 from astropy.coordinates import SkyCoord, Angle
 from mocpy import MOC
 from astroquery.vizier import Vizier
-from spatial_index import SpatialIndex  # pylint: disable=no-name-in-module
-from ADQL.adql import ADQL
 import astropy.wcs
-from xnicer import XNicer, XDGaussianMixture, guess_wcs, make_maps
+import astropy.wcs.utils
+from xnicer import XNicer, XDGaussianMixture, make_maps
 from xnicer.catalogs import PhotometricCatalogue, AstrometricCatalogue
 from xnicer.kde import KDE
+from threadpoolctl import threadpool_limits
 
 ###############################################################################
 # FIXME: this is a patch for astroquery.vizier.
@@ -257,15 +270,154 @@ VIZIER_TIMEOUT = 600
 # Vizier return type: can be either 'votable' (slow) or 'asu-binfits' (fast)
 VIZIER_RETURN_TYPE = 'asu-binfits'
 
+# Size in bytes of the blocks used when streaming remote data to disk
+DOWNLOAD_BLOCK_SIZE = 1024 * 1024
+
 # Local database parameters
 LOCAL_MOC_ORDER = 8
 LOCAL_HPX_ORDER = 8
-LOCAL_ADQL_ORDER = 8
-LOCAL_ADQL_MODE = SpatialIndex.HTM
+# HEALPix order of the (nested) spatial index used to sort local tables and
+# to select the rows within a region: must not be smaller than LOCAL_HPX_ORDER
+LOCAL_INDEX_ORDER = 8
+
+# Number of rows processed at once during the ingestion of local tables, and
+# inserted at once in, and fetched at once from, the temporary sqlite databases
+# used for local queries with complex conditions
+LOCAL_INGEST_CHUNK = 100000
+LOCAL_FETCH_CHUNK = 100000
 
 # Grace time for cached files in hours
 GRACE_TIME = 24
 
+# Names of the planes of the final product, in the order used by make_maps
+PRODUCT_PLANES = ('ext_map.fits', 'ext_ivar.fits', 'weight.fits', 'density.fits',
+                  'xext_map.fits', 'xext_ivar.fits', 'xweight.fits')
+
+# HiPS tile pyramids of the final product: planes to convert, width in pixels
+# of the tiles (a power of 2), and number of threads used to build them
+HIPS_PLANES = ('ext_map.fits', 'ext_ivar.fits')
+HIPS_TILE_WIDTH = 512
+HIPS_MAX_THREADS = 4
+
+# Stages of the pipeline, in order, with the processing parameters each stage
+# depends upon (beside the outputs of the previous stages). The checkpoints of
+# the stages are saved in `processes/process_ID_stages`; shared stages, whose
+# checkpoints are saved as `processes/PREFIX_KEY.pkl` and reused by all
+# sessions, are listed with their prefix. The retrieval stages use the cached
+# query results as checkpoints.
+PIPELINE_STAGES = {
+    'cf': (),
+    'photometry': ('mags', 'magErrs', 'morphclass', 'reddeningLaw'),
+    'selection': ('starFraction', 'areaFraction'),
+    'xd': ('numComponents', 'maxExtinction', 'extinctionSteps'),
+    'calibration': ('extinctionSubsteps',),
+    'sf': (),
+    'predict': ('mags', 'magErrs', 'morphclass', 'reddeningLaw'),
+    'map': ('wcs', 'smoothpar', 'clipIters', 'clipping', 'products')
+}
+PIPELINE_SHARED_STAGES = {'calibration': 'model'}
+USE_CHECKPOINTS = True
+
+# Streaming of the science field: minimum expected number of objects for which
+# the science field is converted and predicted in batches of `STREAM_BATCH_SIZE`
+# objects while it is downloaded, without joining the catalogue (None to
+# disable)
+STREAM_MIN_OBJS = 2000000
+STREAM_BATCH_SIZE = 100000
+
+# Selection of the control field objects: maximum number of objects used to fit
+# the single-component model, finest HEALPix order used to bin the extinctions,
+# and minimum number of objects of the median pixel of the binning
+SELECTION_FIT_SIZE = 100000
+SELECTION_MAX_ORDER = 12
+SELECTION_PIXEL_OBJS = 20
+
+# Extreme deconvolution of large control fields: maximum number of objects used
+# for the fit (None to fit all objects), taken as a subsample stratified on the
+# HEALPix pixels of order SELECTION_MAX_ORDER, and number of held-out objects
+# used to check the subsample fit
+XD_FIT_SIZE = 300000
+XD_HOLDOUT_SIZE = 50000
+
+# Memory budget of a pipeline run, in bytes (None for no limit), used when the
+# processing parameters have no `memoryBudget`: the science field is stored in
+# single precision when the double precision footprint exceeds the budget, and
+# jobs exceeding the budget even in single precision are refused
+MEMORY_BUDGET = 16 * 1024**3
+
+# Chunked extinction prediction: number of objects predicted at once (None to
+# predict whole catalogues at once), number of processes predicting blocks in
+# parallel for each pipeline run (None to share the cores of the host among the
+# pipeline workers), and number of BLAS threads used by each of them
+PREDICT_BLOCK_SIZE = 100000
+PREDICT_PROCESSES = None
+PREDICT_BLAS_THREADS = 1
+
+# Shared query cache: directory, maximum total size in bytes, and time-to-live
+# in hours of the query results shared among sessions
+QUERY_CACHE_PATH = 'query_cache'
+QUERY_CACHE_MAX_SIZE = 20 * 1024**3
+QUERY_CACHE_TTL = 7 * 24
+
+# Spatial tile cache: directory, HEALPix order of the tiles (None to disable
+# the tile cache), and maximum number of missing tiles retrieved with a single
+# query (larger queries are not tiled)
+TILE_CACHE_PATH = 'tile_cache'
+TILE_CACHE_ORDER = 6
+TILE_CACHE_MAX_QUERY = 64
+
+# Parallel retrieval: maximum number of concurrent downloads of a pipeline run,
+# and maximum number of concurrent connections to the same server (the keys
+# are the host names, or 'vizier' for VizieR; 'default' is used for servers
+# not listed)
+RETRIEVE_MAX_THREADS = 4
+SERVER_MAX_CONNECTIONS = {'default': 2}
+
+# Sharding of tiled TAP queries: maximum number of sub-queries downloaded in
+# parallel, and minimum number of missing tiles per sub-query
+TAP_MAX_SHARDS = 4
+TAP_SHARD_TILES = 16
+
+# Density maps used to count stars: URL of the remote maps, nsides tried (in
+# order), directory of the on-disk mirror, maximum memory in bytes used by the
+# maps kept in memory, time in hours a missing map is remembered, and time in
+# hours a downloaded map is kept on disk
+DENSITY_MAP_URL = 'http://alasky.u-strasbg.fr/footprints/tables/vizier'
+DENSITY_MAP_NSIDES = (256, 128, 64)
+DENSITY_CACHE_PATH = 'density_cache'
+DENSITY_CACHE_MAX_MEMORY = 512 * 1024**2
+DENSITY_CACHE_NEGATIVE_TTL = 24
+DENSITY_CACHE_TTL = 30 * 24
+
+# Persistent job queue: path of the database (shared by all hosts running
+# workers), maximum number of queued jobs, maximum cost of a job (the number of
+# stars of the science and control fields), maximum total cost of the jobs
+# running at the same time on a host (a single job is always allowed to run),
+# time in seconds after which a running job that gave no news is considered
+# lost and queued again, polling interval in seconds of idle workers (and of
+# the abort requests of running jobs), and time in seconds after which a job
+# that does not stop after an abort request is killed
+JOB_QUEUE_PATH = 'processes/queue.db'
+JOB_MAX_QUEUED = 50
+JOB_MAX_COST = 2 * MAX_OBJS
+JOB_MAX_RUNNING_COST = 2 * MAX_OBJS
+JOB_HEARTBEAT_TIMEOUT = 600
+JOB_POLL_INTERVAL = 2
+JOB_ABORT_TIMEOUT = 30
+
+# Process logs: maximum number of entries kept for each job, and minimum time
+# in seconds between two updates of the progress (entries starting with %)
+JOB_LOG_SIZE = 200
+JOB_PROGRESS_INTERVAL = 0.5
+
+# Long polling of the process log: maximum time in seconds a request waits for
+# news, interval in seconds between two checks of the job queue (made by a
+# single thread for all waiting requests), and size of the pool of server
+# threads (each waiting request holds one of them)
+PROGRESS_WAIT_TIMEOUT = 25
+PROGRESS_WAIT_INTERVAL = 0.5
+SERVER_THREAD_POOL = 64
+
 # Type definition
 class ProcessLogEntry(TypedDict):
     """A single entry of the process log."""
@@ -276,6 +428,1362 @@ class ProcessLogEntry(TypedDict):
     message: str
 
 
+################################# Caches ###################################
+
+def link_or_copy(src: str, dst: str):
+    """Hard-link a file, or copy it if links are not supported."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class QueryCache:
+    """Content-addressed on-disk cache of remote query results.
+
+    The results of TAP and VizieR queries are saved as FITS files named after
+    a hash of the normalised query (server, catalog, fields, geometry, and
+    constraints), so that identical queries performed in different sessions
+    share the same data. A sqlite3 index keeps track of the size and of the
+    last access time of each entry: entries older than `ttl` are removed, and
+    least recently used entries are removed when the total size exceeds
+    `max_size`. All files are written atomically.
+
+    The index also associates the job URLs of pending queries to their key,
+    so that the results can be stored once retrieved.
+    """
+
+    def __init__(self, path: str = QUERY_CACHE_PATH,
+                 max_size: int = QUERY_CACHE_MAX_SIZE,
+                 ttl: float = QUERY_CACHE_TTL * 3600):
+        self.path = path
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(self.path, exist_ok=True)
+        con = sqlite3.connect(os.path.join(self.path, 'index.db'), timeout=60)
+        con.execute('CREATE TABLE IF NOT EXISTS entries ' +
+                    '(key TEXT PRIMARY KEY, size INTEGER, created REAL, accessed REAL)')
+        con.execute('CREATE TABLE IF NOT EXISTS urls ' +
+                    '(url TEXT PRIMARY KEY, key TEXT, created REAL)')
+        return con
+
+    @staticmethod
+    def make_key(server: str, catalog: str, fields: Sequence[str],
+                 geometry: Any, constraints: Any) -> str:
+        """Compute the key associated to a query.
+
+        The various parameters are normalised (spurious whitespaces removed,
+        floats rounded, fields and dictionaries sorted) and hashed.
+        """
+        def normalize(value):
+            if isinstance(value, str):
+                return ' '.join(value.split())
+            if isinstance(value, (float, np.floating)):
+                return round(float(value), 9)
+            if isinstance(value, dict):
+                return {str(k): normalize(v) for k, v in sorted(value.items())}
+            if isinstance(value, (list, tuple)):
+                return [normalize(v) for v in value]
+            return value
+        payload = json.dumps([server.strip().rstrip('/').lower(),
+                              catalog.strip().strip('"'),
+                              sorted(field.strip() for field in fields),
+                              normalize(geometry), normalize(constraints)],
+                             sort_keys=True, default=str)
+        return hashlib.sha256(payload.encode('utf8')).hexdigest()
+
+    def filename(self, key: str) -> str:
+        """Return the path of the file associated to a key."""
+        return os.path.join(self.path, f'{key}.fits')
+
+    def get(self, key: str, min_life: float = 0.0) -> Optional[str]:
+        """Return the path of a cached result, or None if not available.
+
+        Parameters
+        ----------
+        key : str
+            The query key, as returned by `make_key`.
+        min_life : float, default = 0
+            The minimum residual life, in seconds, of the entry: entries that
+            would expire before are considered unavailable.
+        """
+        now = time.time()
+        path = self.filename(key)
+        con = self._connect()
+        try:
+            with con:
+                row = con.execute('SELECT created FROM entries WHERE key=?',
+                                  (key,)).fetchone()
+                if row is None or not os.path.isfile(path) or \
+                        row[0] + self.ttl < now + min_life:
+                    return None
+                con.execute('UPDATE entries SET accessed=? WHERE key=?', (now, key))
+            return path
+        finally:
+            con.close()
+
+    def _add(self, key: str, tmp_path: str, evict: bool = True):
+        """Atomically move a temporary file into the cache and index it."""
+        path = self.filename(key)
+        os.replace(tmp_path, path)
+        now = time.time()
+        con = self._connect()
+        try:
+            with con:
+                con.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                            (key, os.path.getsize(path), now, now))
+        finally:
+            con.close()
+        if evict:
+            self.evict()
+
+    def put(self, key: str, src: str, evict: bool = True):
+        """Store a FITS file in the cache under a given key.
+
+        The file is hard-linked (or copied) into the cache, so that the source
+        file can be freely removed or renamed afterwards.
+        """
+        tmp_path = f'{self.filename(key)}.{os.getpid()}.tmp'
+        os.makedirs(self.path, exist_ok=True)
+        link_or_copy(src, tmp_path)
+        self._add(key, tmp_path, evict=evict)
+
+    def put_table(self, key: str, table: Table, evict: bool = True):
+        """Store a table in the cache under a given key."""
+        tmp_path = f'{self.filename(key)}.{os.getpid()}.tmp'
+        os.makedirs(self.path, exist_ok=True)
+        table.write(tmp_path, format='fits', overwrite=True)
+        self._add(key, tmp_path, evict=evict)
+
+    def register(self, url: str, key: str):
+        """Associate a job URL to a query key."""
+        con = self._connect()
+        try:
+            with con:
+                con.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)',
+                            (url, key, time.time()))
+        finally:
+            con.close()
+
+    def lookup(self, url: str) -> Optional[str]:
+        """Return the query key associated to a job URL, if any."""
+        con = self._connect()
+        try:
+            row = con.execute('SELECT key FROM urls WHERE url=?', (url,)).fetchone()
+        finally:
+            con.close()
+        return row[0] if row else None
+
+    def evict(self):
+        """Remove expired entries, and then the least recently used ones."""
+        now = time.time()
+        con = self._connect()
+        try:
+            with con:
+                con.execute('DELETE FROM urls WHERE created<?', (now - self.ttl,))
+                rows = con.execute(
+                    'SELECT key, size, created FROM entries ORDER BY accessed DESC').fetchall()
+                total_size = 0
+                removed = []
+                for key, size, created in rows:
+                    if created < now - self.ttl or total_size + size > self.max_size:
+                        removed.append(key)
+                    else:
+                        total_size += size
+                for key in removed:
+                    try:
+                        os.unlink(self.filename(key))
+                    except (FileNotFoundError, PermissionError):
+                        pass
+                con.executemany('DELETE FROM entries WHERE key=?',
+                                [(key,) for key in removed])
+        finally:
+            con.close()
+
+
+QUERY_CACHE = QueryCache()
+
+TILE_CACHE = QueryCache(TILE_CACHE_PATH)
+
+
+class DensityMap:
+    """A HEALPix density map, indexed for fast star counts.
+
+    For each coordinate system requested, the map is resampled once in that
+    system (so that no rotation is needed afterwards), in NESTED ordering,
+    and its cumulative sum is stored. A region is then converted into a MOC,
+    made of large cells in its interior and of cells at the map resolution
+    along its boundary: each cell is a range of consecutive nested pixels,
+    whose count is the difference of two values of the cumulative sum. The
+    cost of a count is thus proportional to the perimeter of the region, not
+    to its area.
+    """
+
+    def __init__(self, rho: np.ndarray, header: dict):
+        self.rho = rho
+        self.header = header
+        self.nside = header['NSIDE']
+        self.order = hp.nside2order(self.nside)
+        self.cumulative = {}
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self) -> int:
+        """Memory used by the map, including the indices of two systems."""
+        return 3 * self.rho.nbytes
+
+    def _cumulative(self, coo_sys: str) -> np.ndarray:
+        with self.lock:
+            if coo_sys not in self.cumulative:
+                rho = np.where(self.rho == hp.UNSEEN, 0.0, self.rho)
+                if self.header['COORDSYS'] == coo_sys:
+                    rho = hp.reorder(rho, r2n=True)
+                else:
+                    r = hp.Rotator(coord=[coo_sys, self.header['COORDSYS']])
+                    pix = np.arange(hp.nside2npix(self.nside))
+                    vecs = r(hp.pix2vec(self.nside, pix, nest=True))
+                    rho = rho[hp.vec2pix(self.nside, *vecs)]  # pylint: disable=no-value-for-parameter
+                self.cumulative[coo_sys] = np.concatenate(([0.0], np.cumsum(rho)))
+            return self.cumulative[coo_sys]
+
+    def count(self, region: dict, coo_sys: str) -> float:
+        """Return the number of stars within a region.
+
+        Parameters
+        ----------
+        region : dict
+            The region, in the format used by `region_cover`, in the
+            coordinate system `coo_sys`.
+        coo_sys : str
+            The coordinate system, 'C' (equatorial) or 'G' (galactic).
+        """
+        cumulative = self._cumulative(coo_sys)
+        if 'corners' in region:
+            lon, lat = np.transpose(region['corners'])
+            moc = MOC.from_polygon(lon * u.deg, lat * u.deg,  # pylint: disable=no-member
+                                   max_depth=self.order)
+        else:
+            moc = MOC.from_cone(region['center'][0] * u.deg,  # pylint: disable=no-member
+                                region['center'][1] * u.deg,
+                                region['radius'] * u.deg,  # pylint: disable=no-member
+                                max_depth=self.order)
+        nstars = 0.0
+        for order, cells in moc.serialize(format='json').items():
+            shift = 2 * (self.order - int(order))
+            cells = np.asarray(cells, dtype=np.int64)
+            nstars += np.sum(cumulative[(cells + 1) << shift] - cumulative[cells << shift])
+        return float(nstars)
+
+
+class DensityMapCache:
+    """In-memory LRU cache of HEALPix density maps.
+
+    Maps are kept in memory, as `DensityMap` objects, up to a total of
+    `max_memory` bytes (least recently used maps are dropped first). Remote maps are also
+    mirrored on disk, in `path`, for `ttl` seconds, so that they are
+    downloaded only once; the nsides that the server reports as not found
+    (HTTP 404) are remembered for `negative_ttl` seconds, so that they are not
+    probed again, while other errors are retried at the next request. Local
+    maps are identified by their path and modification time.
+
+    The cache is shared by all threads of the server.
+    """
+
+    def __init__(self, path: str = DENSITY_CACHE_PATH,
+                 max_memory: int = DENSITY_CACHE_MAX_MEMORY,
+                 negative_ttl: float = DENSITY_CACHE_NEGATIVE_TTL * 3600,
+                 ttl: float = DENSITY_CACHE_TTL * 3600):
+        self.path = path
+        self.max_memory = max_memory
+        self.negative_ttl = negative_ttl
+        self.ttl = ttl
+        self.maps = OrderedDict()
+        self.missing = {}
+        self.memory = 0
+        self.lock = threading.Lock()
+
+    def _get(self, key: tuple):
+        with self.lock:
+            if key in self.maps:
+                self.maps.move_to_end(key)
+                return self.maps[key]
+        return None
+
+    def _put(self, key: tuple, density: DensityMap):
+        with self.lock:
+            if key in self.maps:
+                return
+            self.maps[key] = density
+            self.memory += density.nbytes
+            while self.memory > self.max_memory and len(self.maps) > 1:
+                _, old = self.maps.popitem(last=False)
+                self.memory -= old.nbytes
+
+    @staticmethod
+    def _read(path: str) -> DensityMap:
+        rho, header = hp.read_map(path, h=True, nest=False, verbose=False)
+        return DensityMap(rho, dict(header))
+
+    def load(self, path: str) -> DensityMap:
+        """Return the density map saved in a local file."""
+        key = ('file', path, os.stat(path).st_mtime_ns)
+        result = self._get(key)
+        if result is None:
+            result = self._read(path)
+            self._put(key, result)
+        return result
+
+    def get(self, catalog: str,
+            nsides: Sequence[int] = DENSITY_MAP_NSIDES) -> Optional[DensityMap]:
+        """Return the density map of a VizieR catalog.
+
+        The nsides are tried in order; None is returned if no map is found.
+        """
+        catname = catalog.replace('/', '_').replace('+', '%2B').replace('"', '')
+        for nside in nsides:
+            key = (catname, nside)
+            result = self._get(key)
+            if result is not None:
+                return result
+            with self.lock:
+                if time.time() - self.missing.get(key, -np.inf) < self.negative_ttl:
+                    continue
+            path = os.path.join(self.path, f'{catname}-{nside}.fits')
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            try:
+                if not os.path.isfile(path):
+                    url = f'{DENSITY_MAP_URL}/{catname}/densityMap?nside={nside}'
+                    with requests.get(url, stream=True, timeout=60) as response:
+                        response.raise_for_status()
+                        with open(tmp_path, 'wb') as f:
+                            for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                                f.write(block)
+                    os.replace(tmp_path, path)
+                result = self._read(path)
+            except Exception as exc:
+                for bad_path in (path, tmp_path):
+                    try:
+                        os.unlink(bad_path)
+                    except OSError:
+                        pass
+                if isinstance(exc, requests.HTTPError) and \
+                        exc.response is not None and exc.response.status_code == 404:
+                    with self.lock:
+                        self.missing[key] = time.time()
+                else:
+                    logging.warning('Could not get the density map %s: %s', path, exc)
+                continue
+            self._put(key, result)
+            return result
+        return None
+
+    def evict(self):
+        """Remove the maps downloaded more than `ttl` seconds ago.
+
+        Expired maps are removed both from the disk mirror and from memory,
+        together with the expired entries of the not-found nsides; local maps
+        are not affected.
+        """
+        now = time.time()
+        try:
+            names = os.listdir(self.path)
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            path = os.path.join(self.path, name)
+            try:
+                if now - os.stat(path).st_mtime > self.ttl:
+                    os.unlink(path)
+            except (FileNotFoundError, PermissionError):
+                pass
+        with self.lock:
+            for key in list(self.maps):
+                if key[0] != 'file' and \
+                        not os.path.isfile(os.path.join(self.path, f'{key[0]}-{key[1]}.fits')):
+                    self.memory -= self.maps.pop(key).nbytes
+            for key, when in list(self.missing.items()):
+                if now - when >= self.negative_ttl:
+                    del self.missing[key]
+
+
+DENSITY_CACHE = DensityMapCache()
+
+
+def region_cover(nside: int, region: dict) -> np.ndarray:
+    """Return the (nested) HEALPix pixels touching a polygon or a disc.
+
+    Parameters
+    ----------
+    nside : int
+        The HEALPix nside parameter.
+    region : dict
+        The region, in the format used for TAP queries: it must contain
+        either `corners`, a list of (lon, lat) pairs in degrees, or `center`
+        (a (lon, lat) pair) and `radius`, both in degrees.
+    """
+    if 'corners' in region:
+        vecs = hp.ang2vec(*np.transpose(region['corners']), lonlat=True)
+        return hp.query_polygon(nside, vecs, inclusive=True, nest=True)
+    vec = hp.ang2vec(*region['center'], lonlat=True)
+    return hp.query_disc(nside, vec, np.radians(region['radius']),
+                         inclusive=True, nest=True)
+
+
+def region_mask(lon: np.ndarray, lat: np.ndarray, region: dict) -> np.ndarray:
+    """Return a boolean mask with the points inside a polygon or a disc.
+
+    The test is exact and follows the ADQL conventions: polygon edges are
+    great circles. Polygons are assumed to be convex.
+
+    Parameters
+    ----------
+    lon, lat : array-like
+        The coordinates of the points, in degrees.
+    region : dict
+        The region, in the same format used by `region_cover`.
+    """
+    vecs = hp.ang2vec(np.asarray(lon, dtype=np.float64),
+                      np.asarray(lat, dtype=np.float64), lonlat=True)
+    if 'corners' in region:
+        corners = hp.ang2vec(*np.transpose(region['corners']), lonlat=True)
+        center = np.sum(corners, axis=0)
+        mask = np.ones(len(vecs), dtype=bool)
+        for n, corner in enumerate(corners):
+            normal = np.cross(corner, corners[(n + 1) % len(corners)])
+            mask &= (vecs @ normal) * np.sign(center @ normal) >= 0
+        return mask
+    vec = hp.ang2vec(*region['center'], lonlat=True)
+    return vecs @ vec >= np.cos(np.radians(region['radius']))
+
+
+_server_semaphores = {}
+_server_semaphores_lock = threading.Lock()
+
+
+def server_semaphore(job_url: str):
+    """Return a context manager limiting the concurrent connections to a server.
+
+    The limits are taken from `SERVER_MAX_CONNECTIONS` and apply to all
+    threads of the current process. Virtual URLs that do not need any network
+    connection (`cache://` and `local://`) are not limited.
+    """
+    if job_url[:8] in ('cache://', 'local://'):
+        return nullcontext()
+    host = 'vizier' if job_url[:9] == 'vizier://' else urlparse(job_url).netloc
+    with _server_semaphores_lock:
+        if host not in _server_semaphores:
+            limit = SERVER_MAX_CONNECTIONS.get(host, SERVER_MAX_CONNECTIONS['default'])
+            _server_semaphores[host] = threading.BoundedSemaphore(limit)
+        return _server_semaphores[host]
+
+
+_session_locks = {}
+_session_locks_lock = threading.Lock()
+
+
+def session_lock(session_id: str) -> threading.RLock:
+    """Return the lock serialising the changes to the local files of a session.
+
+    The lock is shared by all threads of the current process: it prevents
+    concurrent requests (for example, `get_moc` and `ingest_database`) from
+    ingesting the same uploaded table at the same time.
+    """
+    with _session_locks_lock:
+        if session_id not in _session_locks:
+            _session_locks[session_id] = threading.RLock()
+        return _session_locks[session_id]
+
+
+################################# Tables ###################################
+
+class TableAccumulator:
+    """Incremental, columnar concatenation of compatible tables.
+
+    Only the selected columns are kept. The column buffers are preallocated
+    (and, if needed, enlarged geometrically), so that the total cost is linear
+    in the number of rows; the final table is then built from the buffers
+    without further copies.
+    """
+
+    def __init__(self, columns: Optional[Sequence[str]] = None, size: int = 0):
+        """Create a new accumulator.
+
+        Parameters
+        ----------
+        columns : Sequence[str], optional
+            The names of the columns to keep; by default all columns of the
+            first table are kept. Names missing in the first table are
+            ignored.
+        size : int, default = 0
+            The expected total number of rows, used to preallocate buffers.
+        """
+        self.columns = list(columns) if columns is not None else None
+        self.size = size
+        self.length = 0
+        self.data = {}
+        self.masks = {}
+        self.info = {}
+        self.meta = {}
+
+    def __len__(self):
+        return self.length
+
+    def _reserve(self, name: str, capacity: int, dtype: np.dtype):
+        """Make sure a column buffer can hold `capacity` rows of type `dtype`."""
+        buffer = self.data[name]
+        if len(buffer) >= capacity and np.can_cast(dtype, buffer.dtype):
+            return
+        dtype = np.result_type(buffer.dtype, dtype)
+        # Grow geometrically only when more rows are needed: a type promotion
+        # alone keeps the current (preallocated) size
+        if capacity > len(buffer):
+            capacity = max(capacity, 2 * len(buffer))
+        else:
+            capacity = len(buffer)
+        new_buffer = np.empty((capacity,) + buffer.shape[1:], dtype=dtype)
+        new_buffer[:self.length] = buffer[:self.length]
+        self.data[name] = new_buffer
+        mask = self.masks[name]
+        if mask is not None:
+            self.masks[name] = np.zeros(capacity, dtype=bool)
+            self.masks[name][:self.length] = mask[:self.length]
+
+    def append(self, table: Table):
+        """Add the rows of a table."""
+        if not self.data:
+            if self.columns is None:
+                self.columns = table.colnames
+            self.columns = [name for name in self.columns if name in table.colnames]
+            self.meta = dict(table.meta)
+            capacity = max(self.size, len(table))
+            for name in self.columns:
+                column = table[name]
+                self.data[name] = np.empty((capacity,) + column.shape[1:], dtype=column.dtype)
+                self.masks[name] = None
+                self.info[name] = (column.unit, column.description)
+        start, end = self.length, self.length + len(table)
+        for name in self.columns:
+            column = table[name]
+            self._reserve(name, end, column.dtype)
+            self.data[name][start:end] = np.ma.getdata(column)
+            mask = np.ma.getmask(column)
+            if mask is not np.ma.nomask and np.any(mask):
+                if self.masks[name] is None:
+                    self.masks[name] = np.zeros(len(self.data[name]), dtype=bool)
+                self.masks[name][start:end] = mask
+            elif self.masks[name] is not None:
+                self.masks[name][start:end] = False
+        self.length = end
+
+    def to_table(self) -> Table:
+        """Return the concatenated table (sharing memory with the buffers)."""
+        columns = []
+        for name in self.columns:
+            unit, description = self.info[name]
+            data = self.data[name][:self.length]
+            if self.masks[name] is None:
+                columns.append(Column(data, name=name, unit=unit,
+                                      description=description, copy=False))
+            else:
+                columns.append(MaskedColumn(data, mask=self.masks[name][:self.length],
+                                            name=name, unit=unit,
+                                            description=description, copy=False))
+        return Table(columns, meta=self.meta, copy=False)
+
+
+_CONDITION_OPERATORS = {'<': np.less, '<=': np.less_equal,
+                        '>': np.greater, '>=': np.greater_equal,
+                        '=': np.equal, '==': np.equal,
+                        '!=': np.not_equal, '<>': np.not_equal}
+
+
+def condition_mask(table: Table, condition: Sequence[str]) -> Optional[np.ndarray]:
+    """Evaluate a simple condition on a table using numpy.
+
+    Parameters
+    ----------
+    table : Table
+        The table to use.
+    condition : Sequence[str]
+        A triplet (name, operator, value), as sent by the client. The name
+        must be a column of the table (optionally within double quotes), the
+        operator a comparison, and the value a number or a quoted string.
+
+    Returns
+    -------
+    mask : np.ndarray or None
+        The boolean mask of the rows satisfying the condition (masked values
+        never satisfy it), or None if the condition is not simple enough to
+        be evaluated this way.
+    """
+    name, operator, value = (c.strip() for c in condition)
+    name = name.strip('"')
+    if name not in table.colnames or operator not in _CONDITION_OPERATORS:
+        return None
+    column = table[name]
+    if len(value) >= 2 and value[0] == value[-1] == "'":
+        value = value[1:-1].replace("''", "'")
+        if column.dtype.kind not in 'SU':
+            return None
+        data = np.ma.getdata(column)
+        if data.dtype.kind == 'S':
+            data = np.char.decode(data, 'ascii', 'replace')
+    else:
+        try:
+            value = float(value)
+        except ValueError:
+            return None
+        if column.dtype.kind not in 'biuf':
+            return None
+        data = np.ma.getdata(column)
+    if data.ndim > 1:
+        return None
+    mask = _CONDITION_OPERATORS[operator](data, value)
+    column_mask = np.ma.getmask(column)
+    if column_mask is not np.ma.nomask:
+        mask &= ~column_mask
+    return mask
+
+
+def index_rows(index: np.ndarray, pixels: np.ndarray) -> np.ndarray:
+    """Return the rows of a sorted spatial index falling in a set of pixels.
+
+    Consecutive pixels are merged into ranges, and each range is located
+    with a binary search: the cost is proportional to the number of ranges
+    and of rows selected, not to the size of the index.
+
+    Parameters
+    ----------
+    index : np.ndarray
+        The spatial index of each row, sorted in increasing order.
+    pixels : np.ndarray
+        The pixels to select, in the same indexing scheme.
+
+    Returns
+    -------
+    rows : np.ndarray
+        The sorted indices of the selected rows.
+    """
+    pixels = np.unique(pixels)
+    if len(pixels) == 0:
+        return np.zeros(0, dtype=np.int64)
+    breaks = np.flatnonzero(np.diff(pixels) != 1) + 1
+    firsts = pixels[np.concatenate(([0], breaks))]
+    lasts = pixels[np.concatenate((breaks - 1, [len(pixels) - 1]))]
+    starts = np.searchsorted(index, firsts, side='left')
+    ends = np.searchsorted(index, lasts, side='right')
+    lengths = ends - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.arange(np.sum(lengths)) + np.repeat(starts - offsets, lengths)
+
+
+def table_digest(table: Table, digest: Optional[Any] = None) -> Any:
+    """Update a hashlib digest with the content of a table.
+
+    The names, types and values of all columns (including their masks) are
+    hashed, one column at a time: memory-mapped tables are read sequentially
+    and never copied as a whole.
+
+    Parameters
+    ----------
+    table : Table
+        The table to hash.
+    digest : hashlib object, optional
+        The digest to update; if not provided, a new SHA-256 digest is used.
+
+    Returns
+    -------
+    digest : hashlib object
+        The updated digest.
+    """
+    if digest is None:
+        digest = hashlib.sha256()
+    digest.update(str(len(table)).encode())
+    for name in table.colnames:
+        column = table[name]
+        data = np.ascontiguousarray(np.ma.getdata(column))
+        digest.update(f'{name}:{data.dtype.str}:{data.shape}'.encode())
+        digest.update(data)
+        mask = np.ma.getmask(column)
+        if mask is not np.ma.nomask:
+            digest.update(np.ascontiguousarray(mask))
+    return digest
+
+
+################################## Jobs ####################################
+
+class ProcessLog:
+    """The log of a pipeline run, stored in the job queue database.
+
+    The log is a ring of at most `JOB_LOG_SIZE` entries, each with a
+    sequence number, plus a single progress entry (messages starting with
+    `%`), stored with the job and overwritten at most every
+    `JOB_PROGRESS_INTERVAL` seconds. Writing an entry is a single
+    transaction, which also signals that the job is alive; if the job has
+    been aborted, removed from the queue, or replaced by a new run of the
+    same session, writes raise KeyboardInterrupt, which stops the pipeline.
+
+    For compatibility, iterating over the log returns all entries, followed
+    by the progress entry if present.
+    """
+
+    def __init__(self, queue: 'JobQueue', job_id: int):
+        self.queue = queue
+        self.job_id = job_id
+        self.last_progress = 0.0
+
+    def read(self, since: int = 0) -> tuple:
+        """Return the entries with sequence number larger than `since`.
+
+        Returns
+        -------
+        entries : list of dict
+            The entries, each with the additional key `seq`.
+        progress : dict or None
+            The current progress entry.
+        """
+        con = self.queue._connect()  # pylint: disable=protected-access
+        try:
+            rows = con.execute('SELECT seq, time, state, step, message FROM logs '
+                               'WHERE job=? AND seq>? ORDER BY seq',
+                               (self.job_id, since)).fetchall()
+            row = con.execute('SELECT progress FROM jobs WHERE id=?',
+                              (self.job_id,)).fetchone()
+        finally:
+            con.close()
+        entries = [{'seq': r[0], 'time': r[1], 'state': r[2], 'step': r[3], 'message': r[4]}
+                   for r in rows]
+        return entries, json.loads(row[0]) if row and row[0] else None
+
+    def _all(self) -> list:
+        entries, progress = self.read()
+        return entries + [progress] if progress else entries
+
+    def __iter__(self):
+        return iter(self._all())
+
+    def __len__(self) -> int:
+        return len(self._all())
+
+    def __getitem__(self, index: int) -> ProcessLogEntry:
+        return self._all()[index]
+
+    def _write(self, con: sqlite3.Connection, progress: Optional[ProcessLogEntry]):
+        cur = con.execute('UPDATE jobs SET heartbeat=?, progress=? WHERE id=? '
+                          'AND session IS NOT NULL AND abort IS NULL',
+                          (time.time(), json.dumps(progress) if progress else None,
+                           self.job_id))
+        if cur.rowcount == 0:
+            raise KeyboardInterrupt
+
+    def append(self, entry: ProcessLogEntry):
+        """Add a new entry to the log, clearing the progress entry."""
+        con = self.queue._connect()  # pylint: disable=protected-access
+        try:
+            with con:
+                self._write(con, None)
+                con.execute('INSERT INTO logs (job, seq, time, state, step, message) '
+                            'SELECT ?, COALESCE(MAX(seq), 0) + 1, ?, ?, ?, ? '
+                            'FROM logs WHERE job=?',
+                            (self.job_id, entry['time'], entry['state'],
+                             entry['step'], entry['message'], self.job_id))
+                con.execute('DELETE FROM logs WHERE job=? AND seq<=(SELECT MAX(seq) '
+                            'FROM logs WHERE job=?) - ?',
+                            (self.job_id, self.job_id, JOB_LOG_SIZE))
+        finally:
+            con.close()
+
+    def progress(self, entry: ProcessLogEntry):
+        """Set the progress entry, unless it was set less than `JOB_PROGRESS_INTERVAL` ago."""
+        now = time.perf_counter()
+        if now - self.last_progress < JOB_PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        con = self.queue._connect()  # pylint: disable=protected-access
+        try:
+            with con:
+                self._write(con, entry)
+        finally:
+            con.close()
+
+
+class MemoryProcessLog(list):
+    """A process log kept in memory, used when the pipeline runs outside the queue."""
+
+    def progress(self, entry: ProcessLogEntry):
+        """Set the progress entry (the last one, if its message starts with %)."""
+        if len(self) > 0 and self[-1]['message'][:1] == '%':
+            self.pop()
+        self.append(entry)
+
+
+class StageCheckpoints:
+    """The checkpoints of the stages of a pipeline run.
+
+    Each stage of the pipeline (see `PIPELINE_STAGES`) is identified by a key,
+    a hash of the parameters it depends upon and of the keys of the stages
+    providing its inputs. The output of a stage is pickled, together with its
+    key, in `processes/process_ID_stages/STAGE.pkl` (or, for shared stages, in
+    `processes/PREFIX_KEY.pkl`): a later run with the same key reuses the
+    output instead of computing it again. The final maps are not pickled:
+    the product `processes/process_ID.fits` is the checkpoint of the `map`
+    stage (see `valid_product`).
+
+    Parameters
+    ----------
+    session_id : str
+        The unique session id.
+    data_pr : dict
+        The processing parameters.
+    resume : str, optional
+        If provided, the checkpoints of this stage and of all the following
+        ones are ignored: the pipeline is resumed from this stage.
+    """
+
+    def __init__(self, session_id: str, data_pr: dict, resume: Optional[str] = None):
+        self.path = f'processes/process_{session_id}_stages'
+        self.data_pr = data_pr
+        stages = list(PIPELINE_STAGES)
+        if resume is not None and resume not in stages:
+            raise ValueError(f'Unknown pipeline stage {resume}')
+        self.first = stages.index(resume) if resume else len(stages)
+        self.keys: Dict[str, str] = {}
+        self.outputs: Dict[str, Any] = {}
+
+    def forced(self, stage: str) -> bool:
+        """Check if a stage must be executed regardless of its checkpoint."""
+        return not USE_CHECKPOINTS or list(PIPELINE_STAGES).index(stage) >= self.first
+
+    def key(self, stage: str, inputs: Sequence[str] = (), extra: Any = None) -> str:
+        """Compute and record the key of a stage.
+
+        Parameters
+        ----------
+        stage : str
+            The name of the stage.
+        inputs : Sequence[str]
+            The names of the stages providing the inputs: their keys must have
+            been computed already.
+        extra : Any
+            Any additional JSON-serializable value the stage depends upon.
+        """
+        spec = [stage, [self.keys[name] for name in inputs],
+                {name: self.data_pr[name] for name in PIPELINE_STAGES[stage]}, extra]
+        self.keys[stage] = hashlib.sha256(
+            json.dumps(spec, sort_keys=True, default=str).encode()).hexdigest()
+        return self.keys[stage]
+
+    def checkpoint_path(self, stage: str) -> str:
+        """Return the path of the checkpoint of a stage."""
+        if stage in PIPELINE_SHARED_STAGES:
+            return f'processes/{PIPELINE_SHARED_STAGES[stage]}_{self.keys[stage]}.pkl'
+        return os.path.join(self.path, f'{stage}.pkl')
+
+    def get(self, stage: str, compute: Callable[[], Any],
+            logger: Callable[[str], Any] = logging.info) -> Any:
+        """Return the output of a stage, computing it only if necessary.
+
+        The key of the stage must have been computed already (see `key`). The
+        output is taken from the checkpoint if its key matches; otherwise, it
+        is computed with `compute` and saved. In both cases it is kept in
+        memory until `release` is called.
+        """
+        if stage in self.outputs:
+            return self.outputs[stage]
+        path = self.checkpoint_path(stage)
+        found = False
+        if not self.forced(stage):
+            try:
+                with open(path, 'rb') as checkpoint_file:
+                    key, output = pickle.load(checkpoint_file)
+                found = key == self.keys[stage]
+                if found:
+                    os.utime(path)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                logging.exception('Could not read the checkpoint %s', path)
+        if found:
+            logger(f'Using the results of the {stage} stage of a previous run')
+        else:
+            output = compute()
+            self.save(stage, output)
+        self.outputs[stage] = output
+        return output
+
+    def save(self, stage: str, output: Any):
+        """Save the checkpoint of a stage, atomically; errors are only logged."""
+        path = self.checkpoint_path(stage)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp_path, 'wb') as checkpoint_file:
+                pickle.dump((self.keys[stage], output), checkpoint_file,
+                            protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, path)
+        except Exception:
+            logging.exception('Could not save the checkpoint %s', path)
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+
+    def valid_product(self, stage: str, path: str) -> bool:
+        """Check if a FITS file is the output of a stage with the current key.
+
+        This is used for stages whose output is a final product, such as the
+        `map` stage: the product itself, tagged with `tag`, is the checkpoint.
+        """
+        if self.forced(stage):
+            return False
+        try:
+            return fits.getheader(path).get('STAGEKEY') == self.keys[stage]
+        except (OSError, ValueError):
+            return False
+
+    def tag(self, stage: str, header: fits.Header):
+        """Record the key of a stage in the header of its FITS product."""
+        header['STAGEKEY'] = (self.keys[stage], f'Key of the {stage} pipeline stage')
+
+    @staticmethod
+    def clear(session_id: str):
+        """Remove all the (non shared) checkpoints of a session.
+
+        These include the product `processes/process_ID.fits`, the checkpoint
+        of the `map` stage.
+        """
+        shutil.rmtree(f'processes/process_{session_id}_stages', ignore_errors=True)
+        try:
+            os.unlink(f'processes/process_{session_id}.fits')
+        except FileNotFoundError:
+            pass
+
+    def release(self, *stages: str):
+        """Drop the outputs of some stages (by default, all) kept in memory."""
+        for stage in stages or list(self.outputs):
+            self.outputs.pop(stage, None)
+
+
+class JobQueue:
+    """Persistent queue of pipeline runs.
+
+    Jobs are stored in a sqlite3 database, together with their logs, so that
+    they survive server restarts; the parameters of each job are in the file
+    `processes/process_ID.dat`. Workers, possibly running on different hosts
+    sharing the `processes` directory, take jobs in order of priority and
+    submission time (see `claim`). The number of queued jobs and the cost of
+    each job are limited, and the total cost of the jobs running on a host is
+    kept below a budget, so that memory-heavy jobs do not all run at once.
+
+    Running jobs can be aborted (see `abort`): the request is recorded in
+    the database, so that the worker running the job can stop it, or the
+    supervisor of its host can kill the worker (see `WorkerPool`).
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_PATH):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, timeout=60)
+        con.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT, state TEXT, '
+                    'priority INTEGER, cost REAL, submitted REAL, started REAL, '
+                    'finished REAL, host TEXT, pid INTEGER, heartbeat REAL, abort REAL, '
+                    'progress TEXT)')
+        con.execute('CREATE TABLE IF NOT EXISTS logs ('
+                    'job INTEGER, seq INTEGER, time REAL, state TEXT, step INTEGER, '
+                    'message TEXT, PRIMARY KEY (job, seq))')
+        con.execute('CREATE INDEX IF NOT EXISTS jobs_session ON jobs (session)')
+        return con
+
+    def submit(self, session_id: str, cost: float, priority: int = 0) -> ProcessLog:
+        """Queue a new pipeline run, replacing any previous one of the session.
+
+        Raises
+        ------
+        ValueError
+            If the job is too expensive, or the queue is full.
+        """
+        if cost > JOB_MAX_COST:
+            raise ValueError(f'The pipeline would process too many stars ({cost:,.0f})')
+        now = time.time()
+        con = self._connect()
+        try:
+            with con:
+                con.execute('BEGIN IMMEDIATE')
+                queued = con.execute("SELECT COUNT(*) FROM jobs WHERE state='queued' "
+                                     'AND session!=?', (session_id,)).fetchone()[0]
+                if queued >= JOB_MAX_QUEUED:
+                    raise ValueError('Too many pipelines are waiting: please try again later')
+                self._delete(con, session_id)
+                cur = con.execute("INSERT INTO jobs (session, state, priority, cost, "
+                                  "submitted, heartbeat) VALUES (?, 'queued', ?, ?, ?, ?)",
+                                  (session_id, priority, cost, now, now))
+                job_id = cur.lastrowid
+                con.execute('INSERT INTO logs (job, seq, time, state, step, message) '
+                            "VALUES (?, 1, 0.0, 'run', 0, 'Waiting in the queue')",
+                            (job_id,))
+        finally:
+            con.close()
+        return ProcessLog(self, job_id)
+
+    @staticmethod
+    def _delete(con: sqlite3.Connection, session_id: str):
+        con.execute('DELETE FROM logs WHERE job IN (SELECT id FROM jobs WHERE session=?)',
+                    (session_id,))
+        # Running jobs are detached from the session and aborted
+        con.execute("UPDATE jobs SET session=NULL, abort=COALESCE(abort, ?) "
+                    "WHERE session=? AND state='running'", (time.time(), session_id))
+        con.execute('DELETE FROM jobs WHERE session=?', (session_id,))
+
+    def remove(self, session_id: str):
+        """Remove the job of a session (a running job is then aborted)."""
+        con = self._connect()
+        try:
+            with con:
+                self._delete(con, session_id)
+        finally:
+            con.close()
+
+    def abort(self, session_id: str, message: Optional[str] = None):
+        """Abort the job of a session.
+
+        A queued job is simply marked as aborted; for a running job, the
+        time of the request is recorded. If `message` is provided, an
+        `abort` entry is also added to the log of the job, in the same
+        transaction: as the writes of an aborted job fail, no entry of the
+        worker can follow it.
+        """
+        now = time.time()
+        con = self._connect()
+        try:
+            with con:
+                con.execute('BEGIN IMMEDIATE')
+                if message is not None:
+                    con.execute('INSERT INTO logs (job, seq, time, state, step, message) '
+                                "SELECT j.id, COALESCE(MAX(l.seq), 0) + 1, "
+                                "COALESCE((SELECT time FROM logs WHERE job=j.id "
+                                "ORDER BY seq DESC LIMIT 1), 0.0), 'abort', "
+                                "COALESCE((SELECT step FROM logs WHERE job=j.id "
+                                "ORDER BY seq DESC LIMIT 1), 0), ? "
+                                "FROM jobs j LEFT JOIN logs l ON l.job=j.id "
+                                "WHERE j.session=? AND (j.state='queued' OR "
+                                "(j.state='running' AND j.abort IS NULL)) GROUP BY j.id",
+                                (message, session_id))
+                    con.execute('UPDATE jobs SET progress=NULL WHERE session=?', (session_id,))
+                con.execute("UPDATE jobs SET state='aborted', finished=? "
+                            "WHERE session=? AND state='queued'", (now, session_id))
+                con.execute("UPDATE jobs SET abort=COALESCE(abort, ?) "
+                            "WHERE session=? AND state='running'", (now, session_id))
+        finally:
+            con.close()
+
+    def heartbeat(self, job_id: int) -> bool:
+        """Signal that a running job is alive.
+
+        Returns
+        -------
+        alive : bool
+            False if the job has been aborted, removed, or is not running on
+            this worker anymore.
+        """
+        con = self._connect()
+        try:
+            with con:
+                cur = con.execute("UPDATE jobs SET heartbeat=? WHERE id=? AND state='running' "
+                                  'AND session IS NOT NULL AND abort IS NULL',
+                                  (time.time(), job_id))
+        finally:
+            con.close()
+        return cur.rowcount > 0
+
+    def overdue(self, host: str, timeout: float = JOB_ABORT_TIMEOUT) -> List[tuple]:
+        """Return the jobs of a host still running `timeout` seconds after an abort.
+
+        Returns
+        -------
+        jobs : list of tuples
+            The id of each job, and the pid of the worker running it.
+        """
+        con = self._connect()
+        try:
+            return con.execute("SELECT id, pid FROM jobs WHERE state='running' "
+                               'AND host=? AND abort<?',
+                               (host, time.time() - timeout)).fetchall()
+        finally:
+            con.close()
+
+    def killed(self, job_id: int):
+        """Mark a job as aborted after its worker has been killed."""
+        con = self._connect()
+        try:
+            with con:
+                con.execute("UPDATE jobs SET state='aborted', finished=? WHERE id=?",
+                            (time.time(), job_id))
+                con.execute('INSERT INTO logs (job, seq, time, state, step, message) '
+                            "SELECT ?, MAX(seq) + 1, time, 'abort', step, 'Process killed' "
+                            'FROM logs WHERE job=? AND seq=(SELECT MAX(seq) FROM logs '
+                            'WHERE job=?) HAVING COUNT(*) > 0', (job_id, job_id, job_id))
+        finally:
+            con.close()
+
+    def log(self, session_id: str) -> Optional[ProcessLog]:
+        """Return the log of the job of a session, or None if there is no job."""
+        con = self._connect()
+        try:
+            row = con.execute('SELECT id FROM jobs WHERE session=?', (session_id,)).fetchone()
+        finally:
+            con.close()
+        return ProcessLog(self, row[0]) if row else None
+
+    def claim(self, host: str, pid: int,
+              max_cost: float = JOB_MAX_RUNNING_COST) -> Optional[tuple]:
+        """Take the next job of the queue, if it fits the budget of the host.
+
+        Returns
+        -------
+        job : tuple or None
+            The session id and the log of the job, or None if no job can be
+            started now.
+        """
+        con = self._connect()
+        try:
+            with con:
+                con.execute('BEGIN IMMEDIATE')
+                running, cost_running = con.execute(
+                    "SELECT COUNT(*), COALESCE(SUM(cost), 0) FROM jobs "
+                    "WHERE state='running' AND host=?", (host,)).fetchone()
+                row = con.execute("SELECT id, session, cost FROM jobs WHERE state='queued' "
+                                  'ORDER BY priority DESC, submitted LIMIT 1').fetchone()
+                if row is None or (running > 0 and cost_running + row[2] > max_cost):
+                    return None
+                now = time.time()
+                con.execute("UPDATE jobs SET state='running', started=?, host=?, pid=?, "
+                            'heartbeat=? WHERE id=?', (now, host, pid, now, row[0]))
+        finally:
+            con.close()
+        return row[1], ProcessLog(self, row[0])
+
+    def finish(self, log: ProcessLog):
+        """Mark a job as completed, using the last state of its log."""
+        states = {'end': 'done', 'error': 'error', 'abort': 'aborted'}
+        entries, _ = log.read()
+        state = states.get(entries[-1]['state'], 'error') if entries else 'aborted'
+        con = self._connect()
+        try:
+            with con:
+                con.execute("UPDATE jobs SET state=?, finished=? "
+                            "WHERE id=? AND state='running'",
+                            (state, time.time(), log.job_id))
+        finally:
+            con.close()
+
+    def requeue(self, host: Optional[str] = None,
+                timeout: float = JOB_HEARTBEAT_TIMEOUT):
+        """Queue again lost jobs.
+
+        These are the running jobs of `host` (if provided), used when all
+        its workers are restarted, and the running jobs that gave no news
+        for `timeout` seconds.
+        """
+        now = time.time()
+        con = self._connect()
+        try:
+            with con:
+                con.execute("UPDATE jobs SET state='queued', host=NULL, pid=NULL, "
+                            "heartbeat=? WHERE state='running' AND (host=? OR heartbeat<?)",
+                            (now, host, now - timeout))
+        finally:
+            con.close()
+
+    def purge(self, max_age: float):
+        """Remove the jobs completed more than `max_age` seconds ago."""
+        con = self._connect()
+        try:
+            with con:
+                old = "SELECT id FROM jobs WHERE state NOT IN ('queued', 'running') " + \
+                    'AND finished<?'
+                con.execute(f'DELETE FROM logs WHERE job IN ({old})', (time.time() - max_age,))
+                con.execute(f'DELETE FROM jobs WHERE id IN ({old})', (time.time() - max_age,))
+        finally:
+            con.close()
+
+    def snapshot(self) -> list:
+        """Return the last sequence number and the progress of the log of each job."""
+        con = self._connect()
+        try:
+            return con.execute('SELECT jobs.id, MAX(logs.seq), jobs.progress FROM jobs '
+                               'LEFT JOIN logs ON logs.job=jobs.id '
+                               'WHERE jobs.session IS NOT NULL GROUP BY jobs.id '
+                               'ORDER BY jobs.id').fetchall()
+        finally:
+            con.close()
+
+    def position(self, session_id: str) -> Optional[dict]:
+        """Return the position in the queue of a job, and its estimated wait.
+
+        The wait, in seconds, is estimated from the cost of the jobs ahead
+        and from the throughput (cost per second) of the last completed
+        jobs; it is None if no job was completed yet. If the job is not
+        queued, None is returned.
+        """
+        con = self._connect()
+        try:
+            row = con.execute("SELECT priority, submitted FROM jobs "
+                              "WHERE session=? AND state='queued'", (session_id,)).fetchone()
+            if row is None:
+                return None
+            ahead, cost = con.execute(
+                "SELECT COUNT(*), COALESCE(SUM(cost), 0) FROM jobs WHERE state='queued' "
+                'AND (priority>? OR (priority=? AND submitted<?))',
+                (row[0], row[0], row[1])).fetchone()
+            done_cost, done_time = con.execute(
+                'SELECT SUM(cost), SUM(finished - started) FROM (SELECT cost, finished, '
+                "started FROM jobs WHERE state='done' ORDER BY finished DESC LIMIT 20)"
+            ).fetchone()
+        finally:
+            con.close()
+        wait = cost * done_time / done_cost if done_cost else None
+        return {'position': ahead + 1, 'wait': wait}
+
+
+JOB_QUEUE = JobQueue()
+
+
+class ProgressNotifier:
+    """Notify the requests waiting for news in the process logs.
+
+    A single thread checks the job queue every `PROGRESS_WAIT_INTERVAL`
+    seconds, as long as there are waiting requests, and wakes them all up
+    when any log changes: the waiting requests then just sleep on a
+    condition, instead of querying the database.
+    """
+
+    def __init__(self, queue: JobQueue):
+        self.queue = queue
+        self.condition = threading.Condition()
+        self.version = 0
+        self.waiters = 0
+        self.state = None
+        self.thread = None
+
+    def wait(self, version: int, timeout: float) -> int:
+        """Wait until the logs change after `version`, or for `timeout` seconds.
+
+        Returns
+        -------
+        version : int
+            The current version of the logs.
+        """
+        with self.condition:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True,
+                                               name='ProgressNotifier')
+                self.thread.start()
+            self.waiters += 1
+            try:
+                self.condition.wait_for(lambda: self.version != version, timeout)
+            finally:
+                self.waiters -= 1
+            return self.version
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.waiters > 0)
+            try:
+                state = self.queue.snapshot()
+            except Exception:
+                logging.exception('Could not check the process logs')
+                state = self.state
+            with self.condition:
+                if state != self.state:
+                    self.state = state
+                    self.version += 1
+                    self.condition.notify_all()
+            time.sleep(PROGRESS_WAIT_INTERVAL)
+
+
+PROGRESS_NOTIFIER = ProgressNotifier(JOB_QUEUE)
+
+
+# The prediction in progress in this process, inherited by the forked
+# processes of `AppServer.predict_extinctions`
+_predict_task = None
+
+
+def _predict_init(blas_threads: int):
+    """Initialize a prediction process, limiting its BLAS threads."""
+    threadpool_limits(blas_threads)
+
+
+def _predict_block(start: int) -> int:
+    """Predict a block of the prediction in progress, in a forked process.
+
+    The xnicer object and the color catalogue are inherited from the parent
+    process; the results are written directly in the shared output columns.
+    """
+    xnicer, colors, columns = _predict_task
+    ext = xnicer.predict(colors[start:start + PREDICT_BLOCK_SIZE])
+    for name, column in columns.items():
+        column[start:start + len(ext)] = np.asarray(ext[name])
+    return start
+
+
+def worker_predict_processes(nprocs: int) -> int:
+    """Return the number of prediction processes of each of `nprocs` workers.
+
+    This is `PREDICT_PROCESSES` or, if that is None, the share of the cores of
+    the host of each worker.
+    """
+    return PREDICT_PROCESSES or max(1, (os.cpu_count() or 1) // nprocs)
+
+
+class WorkerPool:
+    """The set of processes running pipeline jobs on this host.
+
+    Each worker takes jobs from `JOB_QUEUE` (see `AppServer.run_worker`).
+    `supervise` should be called periodically: it kills the workers whose
+    jobs do not stop within `JOB_ABORT_TIMEOUT` seconds of an abort request,
+    replaces dead workers, and queues again jobs lost by other hosts.
+    Workers are not daemonic, as they start their own prediction processes:
+    `stop` must be called before exiting.
+    """
+
+    def __init__(self, nprocs: int):
+        self.nprocs = nprocs
+        self.workers = []
+        JOB_QUEUE.requeue(socket.gethostname())
+
+    def supervise(self):
+        """Kill stuck workers, start the missing ones, and queue again lost jobs."""
+        for job_id, pid in JOB_QUEUE.overdue(socket.gethostname()):
+            for worker in self.workers:
+                if worker.pid == pid:
+                    logging.warning('Killing worker %d, running aborted job %d', pid, job_id)
+                    worker.kill()
+                    worker.join(5)
+                    JOB_QUEUE.killed(job_id)
+        self.workers = [worker for worker in self.workers if worker.is_alive()]
+        while len(self.workers) < self.nprocs:
+            worker = mp.Process(target=AppServer.run_worker, args=(self.nprocs,))
+            worker.start()
+            self.workers.append(worker)
+        JOB_QUEUE.requeue()
+
+    def stop(self):
+        """Terminate all workers."""
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.kill()
+        self.workers = []
+
+
 ################################ Servers ###################################
 
 class StaticServer:
@@ -285,22 +1793,33 @@ class StaticServer:
 class AppServer:
     """Main app server class."""
 
+    # Number of processes used by `predict_extinctions`: set by `__init__`
+    # for the memory estimates of the server, and by `run_worker`
+    predict_processes = worker_predict_processes(1)
+
     def __init__(self, nprocs: int = 3):
         """Create the main server.
 
         Parameters
         ----------
         nprocs : int, default = 3
-            The number of processes in the process pool created for the data
-            analysis. This essentially is the number of concurrent pipeline
-            runs (*not* the number of server calls: this is set by CherryPy and
-            is usually 10 or larger).
+            The number of worker processes created on this host for the data
+            analysis. This essentially is the maximum number of concurrent
+            pipeline runs (*not* the number of server calls: this is set by
+            CherryPy and is usually 10 or larger); see `WorkerPool`.
         """
         mp.set_start_method('spawn')
-        self.pool = mp.Pool(nprocs)
-        self.pool_manager = mp.Manager()
+        # The jobs are admitted with the prediction processes of our workers
+        AppServer.predict_processes = worker_predict_processes(nprocs)
+        self.workers = WorkerPool(nprocs)
+        self.workers.supervise()
+        Monitor(cherrypy.engine, self.workers.supervise,
+                frequency=JOB_POLL_INTERVAL, name='JobSupervisor').subscribe()
+        cherrypy.engine.subscribe('stop', self.workers.stop)
+        self.executor = ThreadPoolExecutor(2)
         self.last_clean_run = None
-        self.clean_old_files(0)
+        # Files younger than GRACE_TIME are kept, as queued jobs need them
+        self.clean_old_files()
 
     def _cp_dispatch(self, vpath):
         """Convert a path of the form `/products/filename/session_id`.
@@ -473,11 +1992,16 @@ class AppServer:
         try:
             # filetype = file.content_type.value
             # filename = file.filename
-            data = file.file.read()
-            path = f"local_cache/data-{cherrypy.session.id}.dat"  # pylint: disable=no-member
-            with open(path, 'w+b') as datafile:
-                datafile.write(data)
-            table = Table.read(path)
+            session_id = cherrypy.session.id  # pylint: disable=no-member
+            path = f"local_cache/data-{session_id}.dat"
+            with session_lock(session_id):
+                # The products of the ingestion of a previous upload, and the
+                # checkpoints of the pipeline runs that used it, are stale
+                self.remove_ingested_files(session_id)
+                StageCheckpoints.clear(session_id)
+                with open(path, 'w+b') as datafile:
+                    shutil.copyfileobj(file.file, datafile, DOWNLOAD_BLOCK_SIZE)
+            table = self.read_local_file(path)
             # Create an empty VOTable with all columns
             from astropy.io.votable import from_table  # pylint: disable=import-outside-toplevel
             votable = from_table(table[:0])
@@ -506,25 +2030,36 @@ class AppServer:
             return {'error': True, 'message':
                 'Error reading the data and parsing them as a catalog' }
 
+    @staticmethod
+    def remove_ingested_files(session_id: str):
+        """Remove the columnar copy, density map, and MOC of an uploaded table."""
+        shutil.rmtree(f"local_cache/columns-{session_id}", ignore_errors=True)
+        for path in [f"local_cache/densityMap-{session_id}.hpx",
+                     f"../src/static/mocs/session-{session_id}.fits"]:
+            try:
+                os.unlink(path)
+            except (FileNotFoundError, PermissionError):
+                pass
+
     @cherrypy.expose
     def clean_local_files(self):
         """Remove all local files associated to the current session id."""
         session = cherrypy.session  # pylint: disable=no-member
-        datapath = f"local_cache/data-{session.id}.dat"
-        dbpath = f"local_cache/db-{session.id}.db"
-        hpxpath = f"local_cache/densityMap-{session.id}.hpx"
-        mocpath = f"../src/static/mocs/session-{session.id}.fits"
-        paths = [datapath, dbpath, hpxpath, mocpath]
-        for path in paths:
-            if os.path.isfile(path):
-                try:
-                    os.unlink(path)
-                except (FileNotFoundError, PermissionError):
-                    pass
+        with session_lock(session.id):
+            self.remove_ingested_files(session.id)
+            try:
+                os.unlink(f"local_cache/data-{session.id}.dat")
+            except (FileNotFoundError, PermissionError):
+                pass
 
     @cherrypy.expose
     def clean_old_files(self, grace_time=GRACE_TIME * 3600):
-        """Remove files older than `GRACE_TIME`."""
+        """Remove files older than `GRACE_TIME`.
+
+        Session files, and completed jobs of the job queue, are removed based
+        on their age; the shared query, tile, and density map caches, instead,
+        are cleaned using their LRU and time-to-live policy.
+        """
         import glob  # pylint: disable=import-outside-toplevel
         now = time.time()
         if self.last_clean_run is None or now - self.last_clean_run > grace_time:
@@ -534,16 +2069,23 @@ class AppServer:
                 try:
                     stat = os.stat(path)
                     if now - stat.st_ctime > grace_time:
-                        os.unlink(path)
+                        if os.path.isdir(path):
+                            shutil.rmtree(path, ignore_errors=True)
+                        else:
+                            os.unlink(path)
                 except (FileNotFoundError, PermissionError):
                     pass
             for path in glob.glob('processes/*'):
-                if os.path.basename(path) == 'README.md':
+                if os.path.basename(path) == 'README.md' or \
+                        path.startswith(JOB_QUEUE_PATH):
                     continue
                 try:
                     stat = os.stat(path)
                     if now - stat.st_ctime > grace_time:
-                        os.unlink(path)
+                        if os.path.isdir(path):
+                            shutil.rmtree(path, ignore_errors=True)
+                        else:
+                            os.unlink(path)
                 except (FileNotFoundError, PermissionError):
                     pass
             for path in glob.glob('../src/static/mocs/session-*.fits'):
@@ -553,6 +2095,10 @@ class AppServer:
                         os.unlink(path)
                 except (FileNotFoundError, PermissionError):
                     pass
+            QUERY_CACHE.evict()
+            TILE_CACHE.evict()
+            DENSITY_CACHE.evict()
+            JOB_QUEUE.purge(grace_time)
             self.last_clean_run = now
 
     @cherrypy.expose
@@ -562,7 +2108,7 @@ class AppServer:
         """Return the MOC of a database.
 
         The MOC is available only for VizieR catalogs (downloaded from the
-        VizieR MOC database) or for local tables (built on-the-fly).
+        VizieR MOC database) or for local tables (built during the ingestion).
 
         JSON parameters
         ---------------
@@ -615,18 +2161,18 @@ class AppServer:
                     moc = MOC.from_fits(path)
                 return {'success': True, 'url': url}
             elif data['server'] == 'local':
-                path = f"local_cache/data-{cherrypy.session.id}.dat"  # pylint: disable=no-member
-                table = Table.read(path)
                 # Find the equatorial coords
                 coords = [(c[1], c[2]) for c in data['coords'] if c[0] == 'E']
                 if len(coords) == 0:
                     return {'error': True, 'message': 'Equatorial coordinates needed'}
-                coords = coords[0]
-                moc = MOC.from_lonlat(astropy.units.Quantity(table[coords[0]]),
-                                      astropy.units.Quantity(table[coords[1]]), LOCAL_MOC_ORDER)
-                url = f"static/mocs/session-{cherrypy.session.id}.fits"  # pylint: disable=no-member
+                session_id = cherrypy.session.id  # pylint: disable=no-member
+                url = f"static/mocs/session-{session_id}.fits"
                 path = f'../src/{url}'
-                moc.write(path, overwrite=True)
+                # The MOC is built during the ingestion
+                with session_lock(session_id):
+                    self.local_table(session_id, coords[0])
+                    if not os.path.exists(path):
+                        self.ingest_local_table(session_id, coords[0])
                 return {'success': True, 'url': url}
         except Exception:
             return {'error': True, 'message': 'Unexpected error creating the MOC file'}
@@ -635,14 +2181,14 @@ class AppServer:
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def ingest_database(self):
-        """Perform a sqlite3 ingestion of a local database.
+        """Perform the ingestion of a local table.
 
-        The ingestion is carried out including columns for ADQL constraints,
-        as requested by the ADQL library. The original table is supposed to be
-        already present in the cache directory; there the database will also
-        be saved.
+        The original table is supposed to be already present in the cache
+        directory. It is converted into a memory-mappable columnar copy, used
+        for all further operations, and its density map and MOC are computed
+        (see `ingest_local_table`).
 
-        SON parameters
+        JSON parameters
         ---------------
         server : str
             The server name: should always be 'local' for this method
@@ -658,80 +2204,238 @@ class AppServer:
         error : True, optional
             If present, the operation failed
         message : str
-            In case of error, the error message
+            In case of success, the ingestion statistics; in case of error, the
+            error message
         """
         data = cherrypy.request.json
         try:
             if data['server'] == 'local':
                 session = cherrypy.session  # pylint: disable=no-member
-                path = f"local_cache/data-{session.id}.dat"
-                table = Table.read(path)
                 # Find the equatorial coords
                 coords = [(c[1], c[2]) for c in data['coords'] if c[0] == 'E']
                 if len(coords) == 0:
                     return {'error': True, 'message': 'Equatorial coordinates needed'}
-                coords = coords[0]
-                ra = table[coords[0]]
-                dec = table[coords[1]]
-                zs = np.sin(np.deg2rad(dec))
-                cos_dec = np.cos(np.deg2rad(dec))
-                xs = cos_dec * np.cos(np.deg2rad(ra))
-                ys = cos_dec * np.sin(np.deg2rad(ra))
-                # Compute the indices
-                si = SpatialIndex()
-                idx = si.index(ra, dec, mode=LOCAL_ADQL_MODE, level=LOCAL_ADQL_ORDER)
-                # Enlarge the table
-                table['__ra'] = ra
-                table['__dec'] = dec
-                table['__x'] = xs
-                table['__y'] = ys
-                table['__z'] = zs
-                table['__idx'] = idx
-                # SQLITE3 database commands
-                dbpath = f"local_cache/db-{session.id}.db"
-                con = sqlite3.connect(dbpath)
-                fields = []
-                sql_fields = []
-                for c in range(len(table.columns)):
-                    column = table.columns[c]
-                    name = column.name
-                    if isinstance(column[0], (int, np.integer)):
-                        sql_fields.append(f'"{column.name}" INTEGER')
-                        fields.append((int, table[name].data))
-                    elif isinstance(column[0], (float, np.floating)):
-                        sql_fields.append(f'"{column.name}" REAL')
-                        fields.append((float, table[name].data))
-                    else:
-                        sql_fields.append(f'"{column.name}" TEXT')
-                        fields.append((str, table[name].data))
-                con.execute('DROP TABLE IF EXISTS main')
-                con.execute(f'CREATE TABLE main ({",".join(sql_fields)})')
-                command = f'INSERT INTO main VALUES ({",".join(["?"]*len(sql_fields))})'
-                table_gen = (tuple(f(v[i]) for f, v in fields) for i in range(len(table)))
-                con.executemany(command, table_gen)
-                con.commit()
-                con.close()
-                # Compute the density map
-                hpxpath = f"local_cache/densityMap-{session.id}.hpx"
-                order = LOCAL_HPX_ORDER
-                nside = hp.order2nside(order)
-                npix = hp.nside2npix(nside)
-                idx = si.index(ra, dec, mode=si.HPX, level=order)
-                data = np.bincount(idx.astype(np.int64), minlength=npix)
-                hpx = Table()
-                hpx.meta['PIXTYPE'] = 'HEALPIX'
-                hpx.meta['NSIDE'] = nside
-                hpx.meta['ORDERING'] = 'NESTED'
-                hpx.meta['COORDSYS'] = 'C'
-                hpx.meta['TDMIN'] = np.min(data)
-                hpx.meta['TDMAX'] = np.max(data)
-                hpx['densityMap'] = data.astype(np.float64)
-                hpx.write(hpxpath, format='fits', overwrite=True)
-                return {'success': True}
+                t0 = time.perf_counter()
+                # The table may have been ingested already by a concurrent
+                # `get_moc` request
+                rows = len(self.local_table(session.id, coords[0]))
+                elapsed = time.perf_counter() - t0
+                message = f"{rows:,} rows ingested in {elapsed:.1f} s " + \
+                    f"({rows / max(elapsed, 1e-9):,.0f} rows/s)"
+                logging.info('%s', message)
+                return {'success': True, 'message': message}
             return {'success': True}
         except Exception:
             return {'error': True, 'message': 'Error building the local database'}
 
+    @staticmethod
+    def read_local_file(path: str) -> Table:
+        """Read an uploaded table, memory-mapping it if possible.
+
+        FITS files are memory-mapped, so that only the parts actually used
+        are read; other formats are read in memory.
+        """
+        with open(path, 'rb') as f:
+            is_fits = f.read(6) == b'SIMPLE'
+        if is_fits:
+            return Table.read(path, format='fits', memmap=True)
+        return Table.read(path)
+
+    @staticmethod
+    def _local_coords(table: Table, coords: Sequence[str], rows):
+        """Return the equatorial coordinates of some rows, with NaN if invalid."""
+        ra = np.ma.filled(np.ma.asarray(table[coords[0]][rows], dtype=np.float64), np.nan)
+        dec = np.ma.filled(np.ma.asarray(table[coords[1]][rows], dtype=np.float64), np.nan)
+        return ra, dec
+
+    @classmethod
+    def ingest_local_table(cls, session_id: str, coords: Sequence[str]) -> dict:
+        """Build the columnar copy, density map, and MOC of an uploaded table.
+
+        The uploaded table is processed in chunks of `LOCAL_INGEST_CHUNK`
+        rows. A first pass computes the spatial index of each row and, at the
+        same time, the density map (`local_cache/densityMap-ID.hpx`) and the
+        MOC (`static/mocs/session-ID.fits`). A second pass writes each column,
+        sorted by spatial index, as a numpy file in the directory
+        `local_cache/columns-ID`; a file `meta.json` describes the columns.
+        Apart from the spatial index, the memory used is proportional to the
+        chunk size (FITS uploads are memory-mapped).
+
+        The copy includes the additional columns `__ra`, `__dec` (the
+        equatorial coordinates in degrees) and `__idx` (the nested HEALPix
+        index at order `LOCAL_INDEX_ORDER`, or -1 for invalid coordinates);
+        as rows are sorted by spatial index, the rows of any HEALPix pixel are
+        contiguous.
+
+        Parameters
+        ----------
+        session_id : str
+            The unique session id
+        coords : Sequence[str]
+            The names of the RA and Dec columns.
+
+        Returns
+        -------
+        meta : dict
+            The content of `meta.json`.
+        """
+        path = f"local_cache/columns-{session_id}"
+        table = cls.read_local_file(f"local_cache/data-{session_id}.dat")
+        nrows = len(table)
+        if nrows == 0:
+            raise ValueError('Empty table')
+        chunks = [slice(start, min(start + LOCAL_INGEST_CHUNK, nrows))
+                  for start in range(0, nrows, LOCAL_INGEST_CHUNK)]
+        nside = hp.order2nside(LOCAL_INDEX_ORDER)
+        hpx_shift = 2 * (LOCAL_INDEX_ORDER - LOCAL_HPX_ORDER)
+        moc_shift = 2 * (LOCAL_INDEX_ORDER - LOCAL_MOC_ORDER)
+        density = np.zeros(hp.nside2npix(hp.order2nside(LOCAL_HPX_ORDER)), dtype=np.int64)
+        coverage = np.zeros(hp.nside2npix(hp.order2nside(LOCAL_MOC_ORDER)), dtype=bool)
+        idx = np.empty(nrows, dtype=np.int64)
+        # First pass: spatial index, density map, and MOC
+        for chunk in chunks:
+            ra, dec = cls._local_coords(table, coords, chunk)
+            valid = np.isfinite(ra) & np.isfinite(dec)
+            pix = hp.ang2pix(nside, ra[valid], dec[valid], nest=True, lonlat=True)
+            idx[chunk] = -1
+            idx[chunk][valid] = pix
+            density += np.bincount(pix >> hpx_shift, minlength=len(density))
+            coverage[pix >> moc_shift] = True
+        order = np.argsort(idx, kind='stable')
+        # Second pass: the sorted columns
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        meta = {'racol': coords[0], 'deccol': coords[1], 'idxorder': LOCAL_INDEX_ORDER,
+                'rows': nrows, 'columns': []}
+        for n, name in enumerate(table.colnames):
+            column = table[name]
+            if column.dtype.kind == 'O':
+                # Objects are only present in tables read in memory
+                column = column.astype(str)
+            info = {'name': name, 'file': f'col{n}.npy', 'mask': None,
+                    'unit': column.unit.to_string() if column.unit is not None else None,
+                    'description': column.description}
+            data = np.lib.format.open_memmap(
+                os.path.join(tmp_path, info['file']), mode='w+',
+                dtype=column.dtype.newbyteorder('='), shape=(nrows,) + column.shape[1:])
+            mask = None
+            for chunk in chunks:
+                values = column[order[chunk]]
+                data[chunk] = np.ma.getdata(values)
+                values_mask = np.ma.getmask(values)
+                if values_mask is not np.ma.nomask and np.any(values_mask):
+                    if mask is None:
+                        info['mask'] = f'col{n}.mask.npy'
+                        mask = np.lib.format.open_memmap(
+                            os.path.join(tmp_path, info['mask']), mode='w+',
+                            dtype=bool, shape=data.shape)
+                        mask[:chunk.start] = False
+                    mask[chunk] = values_mask
+                elif mask is not None:
+                    mask[chunk] = False
+            del data, mask
+            meta['columns'].append(info)
+        ras = np.lib.format.open_memmap(os.path.join(tmp_path, 'ra.npy'), mode='w+',
+                                        dtype=np.float64, shape=(nrows,))
+        decs = np.lib.format.open_memmap(os.path.join(tmp_path, 'dec.npy'), mode='w+',
+                                         dtype=np.float64, shape=(nrows,))
+        for chunk in chunks:
+            ras[chunk], decs[chunk] = cls._local_coords(table, coords, order[chunk])
+        del ras, decs
+        np.save(os.path.join(tmp_path, 'idx.npy'), idx[order])
+        meta['columns'] += [{'name': '__ra', 'file': 'ra.npy', 'mask': None,
+                             'unit': 'deg', 'description': None},
+                            {'name': '__dec', 'file': 'dec.npy', 'mask': None,
+                             'unit': 'deg', 'description': None},
+                            {'name': '__idx', 'file': 'idx.npy', 'mask': None,
+                             'unit': None, 'description': None}]
+        with open(os.path.join(tmp_path, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        shutil.rmtree(path, ignore_errors=True)
+        os.rename(tmp_path, path)
+        # The density map
+        hpx = Table()
+        hpx.meta['PIXTYPE'] = 'HEALPIX'
+        hpx.meta['NSIDE'] = hp.order2nside(LOCAL_HPX_ORDER)
+        hpx.meta['ORDERING'] = 'NESTED'
+        hpx.meta['COORDSYS'] = 'C'
+        hpx.meta['TDMIN'] = np.min(density)
+        hpx.meta['TDMAX'] = np.max(density)
+        hpx['densityMap'] = density.astype(np.float64)
+        hpx.write(f"local_cache/densityMap-{session_id}.hpx", format='fits', overwrite=True)
+        # The MOC
+        moc = MOC.from_json({str(LOCAL_MOC_ORDER): np.flatnonzero(coverage).tolist()})
+        moc.write(f"../src/static/mocs/session-{session_id}.fits", overwrite=True)
+        return meta
+
+    @classmethod
+    def local_table(cls, session_id: str, coords: Optional[Sequence[str]] = None) -> Table:
+        """Return the columnar copy of the table uploaded in a session.
+
+        All columns are memory-mapped. The copy is built if necessary (see
+        `ingest_local_table`), holding the lock of the session.
+
+        Parameters
+        ----------
+        session_id : str
+            The unique session id
+        coords : Sequence[str], optional
+            The names of the RA and Dec columns. If provided and different
+            from the ones used for the current copy, the copy is rebuilt.
+
+        Raises
+        ------
+        ValueError
+            If there is no copy and `coords` is not provided.
+        """
+        path = f"local_cache/columns-{session_id}"
+        with session_lock(session_id):
+            try:
+                with open(os.path.join(path, 'meta.json'), encoding='utf-8') as f:
+                    meta = json.load(f)
+                current = (meta['racol'], meta['deccol'])
+            except (OSError, ValueError, KeyError):
+                meta, current = None, None
+            if meta is None:
+                if coords is None:
+                    raise ValueError('The uploaded table has not been ingested')
+                meta = cls.ingest_local_table(session_id, coords)
+            elif meta['idxorder'] != LOCAL_INDEX_ORDER or \
+                    (coords is not None and current != tuple(coords)):
+                meta = cls.ingest_local_table(session_id, coords or current)
+        columns = []
+        for info in meta['columns']:
+            data = np.load(os.path.join(path, info['file']), mmap_mode='r')
+            if info['mask']:
+                mask = np.load(os.path.join(path, info['mask']), mmap_mode='r')
+                columns.append(MaskedColumn(data, mask=mask, name=info['name'],
+                                            unit=info['unit'],
+                                            description=info['description'], copy=False))
+            else:
+                columns.append(Column(data, name=info['name'], unit=info['unit'],
+                                      description=info['description'], copy=False))
+        return Table(columns, meta={'RACOL': meta['racol'], 'DECCOL': meta['deccol']},
+                     copy=False)
+
+    @staticmethod
+    def _sql_values(column: Column) -> list:
+        """Convert a table column into a list of values for sqlite3.
+
+        The conversion is performed at once for the whole column: masked
+        values become None (NULL), byte strings are decoded, and
+        multi-dimensional values are stored as strings.
+        """
+        if column.ndim > 1 or column.dtype.kind == 'O':
+            return [str(value) for value in column]
+        mask = np.ma.getmask(column)
+        values = np.ma.getdata(column)
+        if values.dtype.kind == 'S':
+            values = np.char.decode(values, 'ascii', 'replace')
+        if mask is not np.ma.nomask and np.any(mask):
+            return np.ma.MaskedArray(values, mask=mask).tolist()
+        return values.tolist()
+
     @cherrypy.expose
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
@@ -743,61 +2447,33 @@ class AppServer:
 
         The data are taken from a local cache of HPX files, when available,
         or from VizieR footprints. This, effectively, limits non-standard
-        queries to VizieR queries.
+        queries to VizieR queries. All maps are kept in memory by
+        `DENSITY_CACHE`, so repeated counts do not read any file, and are
+        indexed in the requested coordinate system (see `DensityMap`).
         """
         self.clean_old_files()
         data = cherrypy.request.json
-        nest = False
         if data['server'] == 'local':
             # pylint: disable=no-member
             hpxpath = f"local_cache/densityMap-{cherrypy.session.id}.hpx"
             try:
-                rho, header = hp.read_map(hpxpath, h=True, nest=nest, verbose=False)
+                density = DENSITY_CACHE.load(hpxpath)
             except Exception:
                 return {'error': True, 'header': 'Missing data',
                         'content': 'Could not load the healpix file with the density map'}
         else:
-            catname = data["catalogs"][0].replace('/', '_').replace('+','%2B').replace('"', '')
-            basename = 'http://alasky.u-strasbg.fr/footprints/tables/vizier'
-            header = None
-            for nside in [256, 128, 64]:
-                url = f'{basename}/{catname}/densityMap?nside={nside}'
-                try:
-                    rho, header = hp.read_map(url, h=True, nest=nest,
-                                                verbose=False)
-                    break
-                except Exception:
-                    pass
-            if header is None:
+            density = DENSITY_CACHE.get(data["catalogs"][0])
+            if density is None:
                 res = {'error': True, 'header': 'Missing data',
                         'content': 'We could not find any density Healpix file for this dataset'}
                 return res
-        header = dict(header)
-        nside = header['NSIDE']
         coo_sys = 'G' if data['coo_sys'] == 'G' else 'C'
-        inclusive = True
         if data['shape'] == 'B':
-            corners = data['corners']
-            xs = np.radians([c[0] for c in corners])
-            ys = np.pi/2 - np.radians([c[1] for c in corners])
-            vecs = hp.ang2vec(ys, xs)
-            mask = hp.query_polygon(nside, vecs,
-                                    inclusive=inclusive, nest=nest)
-            # Change the coordinate system if necessary
-            if header['COORDSYS'] != coo_sys:
-                r = hp.Rotator(coord=[coo_sys, header['COORDSYS']])
-                mask = hp.vec2pix(nside,  # pylint: disable=no-value-for-parameter
-                                  *r(hp.pix2vec(nside, mask, nest=nest)),
-                                  nest=nest)
+            region = {'corners': [corner[:2] for corner in data['corners']]}
         else:
-            vec = hp.ang2vec(np.radians(90.0 - data['lat_ctr']),
-                             np.radians(data['lon_ctr']))
-            if header['COORDSYS'] != coo_sys:
-                r = hp.Rotator(coord=[coo_sys, header['COORDSYS']])
-                vec = r(vec)
-            mask = hp.query_disc(nside, vec, np.radians(data['radius']),
-                                 inclusive=inclusive, nest=nest)
-        nstars = np.sum(rho[mask])
+            region = {'center': [data['lon_ctr'], data['lat_ctr']],
+                      'radius': data['radius']}
+        nstars = density.count(region, coo_sys)
         if nstars < 200:
             star_number = f'~{int(nstars)}'
         elif nstars < 2000:
@@ -869,6 +2545,7 @@ class AppServer:
             constraints = f"1=CONTAINS(POINT('{coo_codes[coordinate]}', " + \
                 f"{lon_name}, {lat_name}), " + \
                 f"POLYGON('{coo_codes[coordinate]}', {', '.join(polygon)}))"
+            region = {'corners': [corner[:2] for corner in corners]}
         else:
             lon_ctr = data['lon_ctr']
             lat_ctr = data['lat_ctr']
@@ -885,11 +2562,18 @@ class AppServer:
             constraints = f"1=CONTAINS(POINT('{coo_codes[coordinate]}', " + \
                 f"{lon_name}, {lat_name}), " + \
                 f"CIRCLE('{coo_codes[coordinate]}', {lon_ctr}, {lat_ctr}, {radius}))"
-        if len(data['conditions']) > 0:
-            conditions = [c[0] + c[1] + c[2] for c in data['conditions']]
+            region = {'center': [lon_ctr, lat_ctr], 'radius': radius}
+        conditions = [c[0] + c[1] + c[2] for c in data['conditions']]
+        if len(conditions) > 0:
             constraints += f" AND {' AND '.join(conditions)}"
-        job_urls = self.execute_tap_query(step, data['server'], data['catalogs'],
-                                          data['fields'], constraints)
+        region.update({'frame': coo_codes[coordinate], 'lon': lon_name, 'lat': lat_name,
+                       'conditions': ' AND '.join(conditions)})
+        if data['server'] == 'local':
+            job_urls = self.execute_local_query(step, data['fields'], region,
+                                                data['conditions'])
+        else:
+            job_urls = self.execute_tap_query(step, data['server'], data['catalogs'],
+                                              data['fields'], constraints, region=region)
         cherrypy.session['step'] = step  # pylint: disable=no-member
         return job_urls
 
@@ -934,7 +2618,7 @@ class AppServer:
 
     def _process_state(self, session):
         """Return the last line of the process log."""
-        process_log = session.get('process_log')
+        process_log = JOB_QUEUE.log(session.id)
         if process_log:
             return process_log[-1]['state']
         else:
@@ -949,13 +2633,13 @@ class AppServer:
         This function initiate the bulk of the processing: it is called as last
         step in the user interface and effectively starts the analysis.
 
-        Since the processing is computationally intensive, this method starts
-        a new job using a separate thread (from the thread pool), and then
-        returns immediately. The status of the job is then updated through the
-        process log.
+        Since the processing is computationally intensive, this method puts
+        a new job in the persistent job queue (see `JobQueue`), and then
+        returns immediately. The job is executed by one of the workers, and
+        its status is updated through the process log.
         """
         session = cherrypy.session  # pylint: disable=no-member
-        process_log = session.get('process_log')
+        process_log = JOB_QUEUE.log(session.id)
         process_state = self._process_state(session)
         res = {'success': True, 'header': 'Connection established',
                'content': 'The server has accepted the connection and has started the pipeline.'}
@@ -966,14 +2650,13 @@ class AppServer:
             data = cherrypy.request.json
             if 'data' in data:
                 session['data_3'] = data['data']
+            # Refuse up front the jobs that would not fit the memory budget
+            self.pipeline_dtype(session['data_3'])
             with open(f'processes/process_{session.id}.dat', 'wb') as data_file:
                 pickle.dump(session.id, data_file)
                 pickle.dump(session['data_3'], data_file)
-            session['process_log'] = process_log = self.pool_manager.list([])
-            proc = self.pool.apply_async(
-                self.do_process,
-                (session.id, process_log, session['data_3']))
-            session['process'] = proc
+            process_log = JOB_QUEUE.submit(
+                session.id, session['data_3']['nstars_sf'] + session['data_3']['nstars_cf'])
         except Exception as e:
             res = {'error': True, 'header': 'Pipeline error',
                     'content':
@@ -981,7 +2664,7 @@ class AppServer:
                         f'for session ID {session.id}:\n{e}'}
             logging.exception('Fatal error during process %s',
                                 'restart' if process_state else 'creation')
-        return {'message': res, 'logs': list(process_log)}
+        return {'message': res, 'logs': list(process_log) if process_log else []}
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -989,29 +2672,21 @@ class AppServer:
     def stop_process(self):
         """Stop the process associated to the current session."""
         session = cherrypy.session  # pylint: disable=no-member
-        process_log = session.get('process_log')
+        process_log = JOB_QUEUE.log(session.id)
         process_state = self._process_state(session)
         if process_state == 'run':
             message = f'Stopping process for session ID {session.id}'
             logging.info('%s', message)
-            if len(process_log) > 0:
-                timing = process_log[-1]['time']
-                step = process_log[-1]['step']
-            else:
-                timing = 0.0
-                step = 0
-            process_log.append(
-                {'time': timing,
-                 'state': 'abort',
-                 'step': step,
-                 'message': message})
+            # The job is aborted and its log closed at once, so that the
+            # worker cannot add entries after the abort one
+            JOB_QUEUE.abort(session.id, message)
             res = {'success': True, 'header': 'Aborting', 'content': message}
         else:
             res = {'error': True, 'header': 'Error',
                    'content':
                        f'Could not find running process for session ID {session.id}:'}
             logging.exception('Fatal error during process abort')
-        return {'message': res, 'logs': list(process_log)}
+        return {'message': res, 'logs': list(process_log) if process_log else []}
 
     @cherrypy.expose
     @cherrypy.tools.json_in()
@@ -1023,7 +2698,7 @@ class AppServer:
         are stopped, and all session variables are canceled.
         """
         session = cherrypy.session  # pylint: disable=no-member
-        process_log = session.get('process_log')
+        process_log = JOB_QUEUE.log(session.id)
         process_state = self._process_state(session)
         if process_state == 'run':
             self.stop_process()
@@ -1041,11 +2716,15 @@ class AppServer:
                     os.unlink(f'processes/process_{session.id}.{ext}')
                 except FileNotFoundError:
                     pass
+            self.remove_planes(session.id)
+            self.remove_hips(session.id)
+            StageCheckpoints.clear(session.id)
             # Remove local files
             logging.info('Deleting local files')
             self.clean_local_files()
-            # Fix a few session variables
-            for var in ('data_3', 'URLs_1', 'URLs_2', 'process_log'):
+            # Remove the job and fix a few session variables
+            JOB_QUEUE.remove(session.id)
+            for var in ('data_3', 'URLs_1', 'URLs_2'):
                 try:
                     del session[var]
                 except KeyError:
@@ -1063,42 +2742,131 @@ class AppServer:
     @cherrypy.expose
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
-    def monitor(self):
-        """Monitor the current process using the log file.
+    def monitor(self):
+        """Monitor the current process using the log file.
+
+        This function will just return the process log of the current session,
+        or an empty list if unavailable. For jobs waiting in the queue, also
+        their position and estimated waiting time are returned.
+
+        JSON parameters
+        ---------------
+        since : int, optional
+            If provided, only the log entries with a sequence number larger
+            than this are returned in `log`, and the progress entry is
+            returned separately in `progress`; `next` is the value to use for
+            the following call. Otherwise, `log` contains the full log,
+            followed by the progress entry.
+        """
+        session_id = cherrypy.session.id  # pylint: disable=no-member
+        since = (cherrypy.request.json or {}).get('since')
+        process_log = JOB_QUEUE.log(session_id)
+        if process_log:
+            entries, progress = process_log.read(since or 0)
+            result = {'success': True, 'queue': JOB_QUEUE.position(session_id)}
+            if since is None:
+                result['log'] = entries + [progress] if progress else entries
+            else:
+                result.update({'log': entries, 'progress': progress,
+                               'next': entries[-1]['seq'] if entries else since})
+            return result
+        else:
+            return {'success': False, 'log': []}
+
+    @cherrypy.expose
+    @cherrypy.config(**{'tools.sessions.locking': 'explicit'})
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def wait_progress(self):
+        """Wait for news in the process log of the current session (long polling).
+
+        The request returns as soon as new log entries are available, the
+        progress entry changes, or after `PROGRESS_WAIT_TIMEOUT` seconds. The
+        session is never locked, so that waiting requests do not block the
+        other requests of the same session. While waiting, the request sleeps
+        until `PROGRESS_NOTIFIER` signals a change in the logs.
 
-        This function will just return the session variable `process_log`, or
-        an empty list if unavailable.
+        JSON parameters
+        ---------------
+        job : int, optional
+            The job id returned by the previous call. If it does not match the
+            current job of the session (because a new run has started), the
+            full log of the current job is returned.
+        since : int, optional
+            The cursor `next` returned by the previous call: only entries
+            following it are returned.
+        progress : dict, optional
+            The progress entry returned by the previous call.
+
+        Returns
+        -------
+        success : bool
+            False if the session has no job.
+        job : int
+            The id of the current job.
+        log : list of dict
+            The new log entries.
+        progress : dict or None
+            The current progress entry.
+        next : int
+            The cursor to use for the next call.
+        queue : dict or None
+            The position in the queue and the estimated wait (see `monitor`).
         """
-        process_log = cherrypy.session.get('process_log')  # pylint: disable=no-member
-        if process_log:
-            return {'success': True, 'log': list(process_log)}
-        else:
-            return {'success': False, 'log': []}
+        session_id = cherrypy.session.id  # pylint: disable=no-member
+        data = cherrypy.request.json or {}
+        deadline = time.time() + PROGRESS_WAIT_TIMEOUT
+        version = PROGRESS_NOTIFIER.version
+        while True:
+            process_log = JOB_QUEUE.log(session_id)
+            if process_log is None:
+                return {'success': False, 'log': []}
+            since = data.get('since') or 0
+            if data.get('job') != process_log.job_id:
+                since = 0
+            entries, progress = process_log.read(since)
+            if entries or progress != data.get('progress') or since == 0 or \
+                    time.time() >= deadline:
+                return {'success': True, 'job': process_log.job_id, 'log': entries,
+                        'progress': progress,
+                        'next': entries[-1]['seq'] if entries else since,
+                        'queue': JOB_QUEUE.position(session_id)}
+            version = PROGRESS_NOTIFIER.wait(version, deadline - time.time())
 
     @cherrypy.expose
     def download(self, filename: str, session_id: Optional[int]=None):
         """Download a final product.
 
         The pipeline produces a single FITS file containing all quantities in
-        different planes. This function extracts on-the-fly the relevant
-        plane of the FITS and serves it to the user as a stream.
+        different planes, and saves each plane in a separate FITS file (see
+        `write_planes`). This function serves the file of the relevant plane
+        directly from disk: partial requests (`Range`) and conditional
+        requests (`ETag` and `Last-Modified`) are supported.
         """
-        # Find the right plane
-        planes = ['ext_map.fits', 'ext_ivar.fits', 'weight.fits', 'density.fits',
-                  'xext_map.fits', 'xext_ivar.fits', 'xweight.fits']
-        try:
-            idx = planes.index(filename)
-        except ValueError:
+        if filename not in PRODUCT_PLANES:
             return ''
-        # Load the FITS cube
         if not session_id:
             session_id = cherrypy.session.id  # pylint: disable=no-member
-        hdu = fits.open(f'processes/process_{session_id}.fits')
-        # DEBUG ONLY: hdu = fits.open(f'test.fits')
-        header = hdu[0].header
-        # Extract the data
-        data = hdu[0].data[idx, :, :]
-        # Fix the header
+        path = os.path.abspath(f'processes/process_{session_id}_{filename}')
+        if not os.path.isfile(path):
+            # Products created before the planes were saved separately
+            try:
+                self.write_planes(session_id)
+            except FileNotFoundError as e:
+                raise cherrypy.NotFound() from e
+            if not os.path.isfile(path):
+                # A plane that was not computed (e.g., an XNICEST plane)
+                raise cherrypy.NotFound()
+        stat = os.stat(path)
+        cherrypy.response.headers['ETag'] = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        cherrypy.lib.cptools.validate_etags()
+        return cherrypy.lib.static.serve_file(
+            path, 'application/x-download', 'attachment', filename)
+
+    @staticmethod
+    def _plane_header(header: fits.Header, idx: int) -> fits.Header:
+        """Return the header of a single plane of the final product."""
+        header = header.copy()
         card = header.cards[header.index(f'PLANE{idx+1}')]
         for p in range(1, 8):
             try:
@@ -1107,38 +2875,216 @@ class AppServer:
                 pass
         header['NAXIS'] = 2
         del header['NAXIS3']
-        del header['CHECKSUM']
-        del header['DATASUM']
+        for keyword in ('CHECKSUM', 'DATASUM', 'STAGEKEY', 'SFDIGEST'):
+            try:
+                del header[keyword]
+            except KeyError:
+                pass
         if len(card) > 2:
             # Unit present in the description?
             m = re.match(r'\[.*\]', card[2])
             if m:
                 header['BUNIT'] = m.group(0)[1:-1]
-        # Make a new FITS file using the new header and data
-        stream = BytesIO()
-        newhdu = fits.PrimaryHDU(data, header)
-        newhdu.writeto(stream)
-        stream.seek(0)
-        return cherrypy.lib.static.serve_fileobj(
-            stream, 'application/x-download', 'attachment', filename)
+        return header
+
+    @classmethod
+    def write_planes(cls, session_id: str):
+        """Save each plane of the final product in a separate FITS file.
+
+        The files are named `processes/process_ID_PLANE`, where `PLANE` is
+        one of `PRODUCT_PLANES`. The product is memory-mapped, so that only
+        one plane at a time is loaded in memory; files are written atomically.
+        Files of planes missing in the product, left by previous runs, are
+        removed.
+        """
+        with fits.open(f'processes/process_{session_id}.fits', memmap=True) as hdu:
+            header = hdu[0].header
+            nplanes = min(header['NAXIS3'], len(PRODUCT_PLANES))
+            cls.remove_planes(session_id, PRODUCT_PLANES[nplanes:])
+            for idx in range(nplanes):
+                path = f'processes/process_{session_id}_{PRODUCT_PLANES[idx]}'
+                tmp_path = f'{path}.{os.getpid()}.tmp'
+                fits.PrimaryHDU(np.asarray(hdu[0].data[idx, :, :]),
+                                cls._plane_header(header, idx)).writeto(
+                                    tmp_path, overwrite=True, checksum=True)
+                os.replace(tmp_path, path)
+
+    @staticmethod
+    def remove_planes(session_id: str, planes: Sequence[str] = PRODUCT_PLANES):
+        """Remove the files of some planes of the final product (by default, all)."""
+        for plane in planes:
+            try:
+                os.unlink(f'processes/process_{session_id}_{plane}')
+            except FileNotFoundError:
+                pass
+
+    @cherrypy.expose
+    def hips(self, plane: str, *path: str, session_id: Optional[int]=None):
+        """Serve the HiPS tile pyramid of a final product.
+
+        The HiPS of the plane `PLANE` (for example, `ext_map`) is available at
+        the URL `/app/hips/PLANE`, and can be used directly as a HiPS survey
+        by Aladin; see `write_hips`.
+        """
+        if f'{plane}.fits' not in HIPS_PLANES or \
+                any(part in ('', '.', '..') or '/' in part for part in path):
+            raise cherrypy.NotFound()
+        if not session_id:
+            session_id = cherrypy.session.id  # pylint: disable=no-member
+        filename = os.path.abspath(os.path.join(
+            f'processes/process_{session_id}_hips', plane, *path))
+        if not os.path.isfile(filename):
+            raise cherrypy.NotFound()
+        stat = os.stat(filename)
+        cherrypy.response.headers['ETag'] = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+        cherrypy.lib.cptools.validate_etags()
+        content_type = 'text/plain' if path[-1] == 'properties' else 'application/fits'
+        return cherrypy.lib.static.serve_file(filename, content_type)
+
+    @staticmethod
+    def remove_hips(session_id: str):
+        """Remove the HiPS tile pyramids of the final product."""
+        shutil.rmtree(f'processes/process_{session_id}_hips', ignore_errors=True)
+
+    @staticmethod
+    def _hips_tile_pixels(width: int) -> np.ndarray:
+        """Return the nested index, within a HiPS tile, of each tile pixel.
+
+        The result is an array of shape (width, width): the element [y, x]
+        contains the index obtained interleaving the bits of x (even bits)
+        and of y (odd bits).
+        """
+        y, x = np.mgrid[0:width, 0:width]
+        nest = np.zeros((width, width), dtype=np.int64)
+        for bit in range(int(width).bit_length() - 1):
+            nest |= ((x >> bit) & 1) << (2 * bit)
+            nest |= ((y >> bit) & 1) << (2 * bit + 1)
+        return nest
+
+    @staticmethod
+    def _hips_sample(data: np.ndarray, w: astropy.wcs.WCS, order: int,
+                     tile_pixels: np.ndarray, tile: int) -> np.ndarray:
+        """Sample a HiPS tile of a given order directly from a map."""
+        width = len(tile_pixels)
+        tile_bits = 2 * (width.bit_length() - 1)
+        ipix = (int(tile) << tile_bits) + tile_pixels
+        lon, lat = hp.pix2ang(1 << (order + tile_bits // 2), ipix, nest=True, lonlat=True)
+        x, y = w.world_to_pixel_values(lon, lat)
+        x = np.round(x).astype(np.int64)
+        y = np.round(y).astype(np.int64)
+        inside = (x >= 0) & (x < data.shape[1]) & (y >= 0) & (y < data.shape[0])
+        image = np.full((width, width), np.nan, dtype=np.float32)
+        image[inside] = data[y[inside], x[inside]]
+        return image
+
+    @staticmethod
+    def _hips_reduce(width: int, children: Sequence[Optional[np.ndarray]]) -> np.ndarray:
+        """Build a HiPS tile averaging 2x2 blocks of pixels of its (up to) four children."""
+        image = np.full((width, width), np.nan, dtype=np.float32)
+        half = width // 2
+        for child, child_image in enumerate(children):
+            if child_image is None:
+                continue
+            blocks = child_image.reshape(half, 2, half, 2)
+            counts = np.sum(np.isfinite(blocks), axis=(1, 3))
+            with np.errstate(invalid='ignore'):
+                block = np.nansum(blocks, axis=(1, 3)) / counts
+            x0, y0 = half * (child & 1), half * (child >> 1)
+            image[y0:y0+half, x0:x0+half] = block
+        return image
+
+    @staticmethod
+    def _hips_save(root: str, order: int, tile: int, image: np.ndarray):
+        """Save a HiPS tile in the directory `root` of a HiPS."""
+        directory = os.path.join(root, f'Norder{order}', f'Dir{(tile // 10000) * 10000}')
+        os.makedirs(directory, exist_ok=True)
+        fits.PrimaryHDU(image).writeto(os.path.join(directory, f'Npix{tile}.fits'),
+                                       overwrite=True)
+
+    @classmethod
+    def write_hips(cls, session_id: str):
+        """Save the planes `HIPS_PLANES` of the final product as HiPS.
+
+        Each plane is converted into a HiPS with FITS tiles of
+        `HIPS_TILE_WIDTH` pixels, saved in the directory
+        `processes/process_ID_hips/PLANE`. The deepest order is the first
+        whose HEALPix pixels are smaller than the map pixels: its tiles are
+        sampled directly from the map, while the tiles of lower orders are
+        obtained by averaging 2x2 blocks of pixels of their four children.
+        Tiles are built in parallel using `HIPS_MAX_THREADS` threads.
+        """
+        width = HIPS_TILE_WIDTH
+        tile_bits = 2 * (width.bit_length() - 1)
+        tile_pixels = cls._hips_tile_pixels(width)
+        root = f'processes/process_{session_id}_hips'
+        tmp_root = f'{root}.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_root, ignore_errors=True)
+        cls.remove_hips(session_id)
+        for plane in HIPS_PLANES:
+            path = f'processes/process_{session_id}_{plane}'
+            if not os.path.isfile(path):
+                continue
+            with fits.open(path, memmap=True) as hdu:
+                data = hdu[0].data
+                w = astropy.wcs.WCS(hdu[0].header).celestial
+                frame = 'galactic' if w.wcs.ctype[0].startswith('GLON') else 'equatorial'
+                scale = np.radians(np.min(astropy.wcs.utils.proj_plane_pixel_scales(w)))
+                # Deepest order whose pixels are smaller than the map pixels
+                max_order = int(np.clip(np.ceil(np.log2(np.sqrt(np.pi / 3) / scale)),
+                                        tile_bits // 2, 29) - tile_bits // 2)
+                footprint = w.calc_footprint(axes=data.shape[::-1])
+                tiles = region_cover(1 << max_order, {'corners': footprint.tolist()})
+                directory = os.path.join(tmp_root, plane[:-5])
+                with ThreadPoolExecutor(HIPS_MAX_THREADS) as executor:
+                    images = dict(zip(tiles, executor.map(
+                        partial(cls._hips_sample, data, w, max_order, tile_pixels), tiles)))
+                    vmin, vmax = np.nanmin(data), np.nanmax(data)
+                    for order in range(max_order, -1, -1):
+                        list(executor.map(partial(cls._hips_save, directory, order),
+                                          images.keys(), images.values()))
+                        if order > 0:
+                            parents = np.unique(np.asarray(list(images)) >> 2)
+                            children = [[images.get(4 * p + c) for c in range(4)]
+                                        for p in parents]
+                            images = dict(zip(parents, executor.map(
+                                partial(cls._hips_reduce, width), children)))
+            with open(os.path.join(directory, 'properties'), 'w', encoding='utf-8') as f:
+                f.write(f'creator_did = ivo://dust/session/{session_id}/{plane[:-5]}\n'
+                        f'obs_title = {plane[:-5]}\n'
+                        'dataproduct_type = image\n'
+                        'hips_version = 1.4\n'
+                        f'hips_release_date = {time.strftime("%Y-%m-%dT%H:%MZ", time.gmtime())}\n'
+                        f'hips_frame = {frame}\n'
+                        f'hips_order = {max_order}\n'
+                        'hips_order_min = 0\n'
+                        f'hips_tile_width = {width}\n'
+                        'hips_tile_format = fits\n'
+                        'hips_pixel_bitpix = -32\n'
+                        f'hips_data_range = {vmin} {vmax}\n')
+        if os.path.isdir(tmp_root):
+            shutil.rmtree(root, ignore_errors=True)
+            os.rename(tmp_root, root)
 
     ############################## Data handling #############################
 
     def execute_tap_query(self, step: Literal[1, 2], server: str,
                           catalogs: Sequence[str], fields: Sequence[str],
-                          constraints: Union[str, dict]):
+                          constraints: Union[str, dict], region: Optional[dict] = None):
         """Start a TAP query.
 
         This function will try to use cached data, if available: that is, two
         identical queries will not be performed and the old query URL will be
-        returned.
+        returned. Additionally, catalogs whose query results are present in
+        the shared query cache are not queried again: for them, a virtual URL
+        of the form `cache://key` is returned. Finally, if `region` is
+        provided, the spatial tile cache is used (see `submit_tiled_query`).
 
         Parameters
         ----------
         step : int
             The step of the pipeline: 1 (science field) or 2 (control field).
         server : str
-            The URL of the TAP server, or the string 'local' for a local file
+            The URL of the TAP server
         catalogs : Sequence[str]
             List of catalog names to retrieve (part `FROM` of the query).
             If more than a catalog is provided, their table format must be
@@ -1147,6 +3093,12 @@ class AppServer:
             List of fields to retrieve (part `SELECT` of the query)
         constraints : Union[str, dict]
             Constraints to apply (part `WHERE` of the query)
+        region : dict, optional
+            The geometric part of the constraints, used for the spatial tile
+            cache. It must contain the keys `frame` (the ADQL frame), `lon`
+            and `lat` (the coordinate columns), `conditions` (the
+            non-geometric constraints), and either `corners` (for polygons) or
+            `center` and `radius` (for circles).
 
         Returns
         -------
@@ -1154,68 +3106,53 @@ class AppServer:
             The job URL, which can be used to monitor the query and retrieve
             the data when the query is completed.
         """
-        if server != 'local':
-            # Check if the query has changed
-            querydata = (server, catalogs, fields, constraints)
-            session = cherrypy.session  # pylint: disable=no-member
-            try:
-                urls = None
-                if session.get(f'querydata_{step}', ()) == querydata:
-                    urls = session[f'URLs_{step}']
-                # Check also complementary queries: useful when the control field
-                # is a copy of the science field
-                elif session.get(f'querydata_{3-step}', ()) == querydata:
-                    urls = session[f'URLs_{3-step}']
-                if urls is not None:
-                    # Check that the data are still available and will be for
-                    # the next hour
-                    # pylint: disable=import-outside-toplevel
-                    from datetime import datetime, timedelta, timezone
-                    utcnow = datetime.utcnow()
-                    now = datetime.now(timezone.utc)
-                    all_ok = True
-                    one_hour = timedelta(hours=1)
-                    for job_url in urls:
-                        job = vo.dal.tap.AsyncTAPJob(job_url)
-                        destruction = job.destruction.datetime
-                        if destruction.tzinfo is None:
-                            if job.destruction.datetime - utcnow < one_hour:
-                                all_ok = False
-                        else:
-                            if job.destruction.datetime - now < one_hour:
-                                all_ok = False
-                    if all_ok:
-                        return urls
-            except TypeError:
-                # This catches a comparison error in the SkyCoords in case of
-                # different frames: we will just consider the coordinates different!
-                pass
+        querydata = (server, catalogs, fields, constraints)
+        session = cherrypy.session  # pylint: disable=no-member
+        # Check if the query has changed
+        try:
+            urls = None
+            if session.get(f'querydata_{step}', ()) == querydata:
+                urls = session[f'URLs_{step}']
+            # Check also complementary queries: useful when the control field
+            # is a copy of the science field
+            elif session.get(f'querydata_{3-step}', ()) == querydata:
+                urls = session[f'URLs_{3-step}']
+            if urls is not None:
+                # Check that the data are still available and will be for
+                # the next hour
+                if all(self.job_available(job_url) for job_url in urls):
+                    return urls
+        except TypeError:
+            # This catches a comparison error in the SkyCoords in case of
+            # different frames: we will just consider the coordinates different!
+            pass
         job_urls = []
         try:
             self.abort_query(step)
             if self._process_state(session):
                 self.abort_process()
-            if server == 'local':
-                adql = ADQL(dbms='sqlite3', level=LOCAL_ADQL_ORDER, debugfile=None,
-                            racol='__ra', deccol='__dec',
-                            xcol='__x', ycol='__y', zcol='__z', indxcol='__idx',
-                            mode=LOCAL_ADQL_MODE)
-                adql_query = f"SELECT {', '.join(fields)}\nFROM main" + \
+            service = vo.dal.TAPService(server)
+            # Now start the new jobs and saves the URLs in the session
+            for catalog in catalogs:
+                key = QUERY_CACHE.make_key(server, catalog, fields, None, constraints)
+                if QUERY_CACHE.get(key, min_life=3600):
+                    job_urls.append('cache://' + key)
+                    continue
+                if region is not None and TILE_CACHE_ORDER is not None:
+                    job_url = self.submit_tiled_query(service, server, catalog,
+                                                      fields, region)
+                    if job_url:
+                        job_urls.append(job_url)
+                        continue
+                if catalog[0] != '"':
+                    catalog = '"' + catalog + '"'
+                query = f"SELECT {', '.join(fields)}\nFROM {catalog}" + \
                     f"\nWHERE {constraints}"
-                sql_query = adql.sql(adql_query)
-                job_urls = ['local://' + sql_query]
-            else:
-                service = vo.dal.TAPService(server)
-                # Now start the new jobs and saves the URLs in the session
-                for catalog in catalogs:
-                    if catalog[0] != '"':
-                        catalog = '"' + catalog + '"'
-                    query = f"SELECT {', '.join(fields)}\nFROM {catalog}" + \
-                        f"\nWHERE {constraints}"
-                    job = service.submit_job(query, maxrec=MAX_OBJS,
-                                             format=TAP_RETURN_TYPE)
-                    job.run()
-                    job_urls.append(job.url)
+                job = service.submit_job(query, maxrec=MAX_OBJS,
+                                         format=TAP_RETURN_TYPE)
+                job.run()
+                QUERY_CACHE.register(job.url, key)
+                job_urls.append(job.url)
         except Exception:
             return []
         # Save the URLs
@@ -1223,6 +3160,106 @@ class AppServer:
         session[f'querydata_{step}'] = querydata
         return job_urls
 
+    def execute_local_query(self, step: Literal[1, 2], fields: Sequence[str],
+                            region: dict, conditions: Sequence[Sequence[str]]):
+        """Prepare a query on the local table of the current session.
+
+        No actual query is performed here: the returned virtual URL, of the
+        form `local://spec`, contains the query specification as JSON, and
+        is evaluated directly on the columnar copy of the table by
+        `local_query`.
+
+        Parameters
+        ----------
+        step : int
+            The step of the pipeline: 1 (science field) or 2 (control field).
+        fields : Sequence[str]
+            List of fields to retrieve
+        region : dict
+            The geometric constraint, in the format used by `region_mask`,
+            in equatorial coordinates
+        conditions : Sequence[Sequence[str]]
+            The additional conditions, as (name, operator, value) triplets
+
+        Returns
+        -------
+        job_url : str
+            The virtual URL of the query.
+        """
+        session = cherrypy.session  # pylint: disable=no-member
+        self.abort_query(step)
+        if self._process_state(session):
+            self.abort_process()
+        spec = {'fields': list(fields),
+                'region': {k: v for k, v in region.items()
+                           if k in ('corners', 'center', 'radius')},
+                'conditions': [list(c) for c in conditions]}
+        job_urls = ['local://' + json.dumps(spec)]
+        session[f'URLs_{step}'] = job_urls
+        session[f'querydata_{step}'] = ('local', spec)
+        return job_urls
+
+    def submit_tiled_query(self, service: vo.dal.TAPService, server: str,
+                           catalog: str, fields: Sequence[str],
+                           region: dict) -> Optional[str]:
+        """Start a TAP query using the spatial tile cache.
+
+        The sky is divided in HEALPix tiles of order `TILE_CACHE_ORDER`, in the
+        frame of the coordinate columns. For each set of (server, catalog,
+        fields, non-geometric constraints) the tiles downloaded are saved in
+        `TILE_CACHE`. This function finds the tiles covering the region and
+        submits a query only for the missing ones, using one circle per tile.
+        Large sets of missing tiles are split into at most `TAP_MAX_SHARDS`
+        sub-queries (shards) of spatially contiguous tiles, which are then
+        downloaded in parallel.
+
+        Returns
+        -------
+        job_url : str or None
+            A virtual URL of the form `tiles://spec`, where `spec` is a JSON
+            dictionary with the tile store key, the list of tiles, the
+            region, and the shards, i.e. the URLs of the TAP jobs retrieving
+            the missing tiles together with their tiles. If the query cannot
+            be tiled (the coordinate columns are not among the fields, or too
+            many tiles are missing), None.
+        """
+        if region['lon'] not in fields or region['lat'] not in fields:
+            return None
+        order = TILE_CACHE_ORDER
+        nside = hp.order2nside(order)
+        store = TILE_CACHE.make_key(server, catalog, fields,
+                                    {'order': order, 'frame': region['frame'],
+                                     'lon': region['lon'], 'lat': region['lat']},
+                                    region['conditions'])
+        tiles = [int(tile) for tile in region_cover(nside, region)]
+        missing = [tile for tile in tiles
+                   if not TILE_CACHE.get(f'{store}-{tile}', min_life=3600)]
+        if len(missing) > TILE_CACHE_MAX_QUERY * TAP_MAX_SHARDS:
+            return None
+        n_shards = min(TAP_MAX_SHARDS, max(1, len(missing) // TAP_SHARD_TILES))
+        shards = []
+        if catalog[0] != '"':
+            catalog = '"' + catalog + '"'
+        frame = region['frame']
+        radius = hp.max_pixrad(nside, degrees=True) * 1.01
+        # Nested indices are sorted, so each shard is spatially compact
+        for shard_tiles in np.array_split(np.sort(missing), n_shards) if missing else []:
+            lons, lats = hp.pix2ang(nside, shard_tiles, nest=True, lonlat=True)
+            circles = [f"1=CONTAINS(POINT('{frame}', {region['lon']}, {region['lat']}), " +
+                       f"CIRCLE('{frame}', {lon}, {lat}, {radius}))"
+                       for lon, lat in zip(lons, lats)]
+            constraints = f"({' OR '.join(circles)})"
+            if region['conditions']:
+                constraints += f" AND {region['conditions']}"
+            query = f"SELECT {', '.join(fields)}\nFROM {catalog}" + \
+                f"\nWHERE {constraints}"
+            job = service.submit_job(query, maxrec=MAX_OBJS, format=TAP_RETURN_TYPE)
+            job.run()
+            shards.append({'job': job.url, 'tiles': [int(tile) for tile in shard_tiles]})
+        spec = {'store': store, 'order': order, 'tiles': tiles, 'missing': missing,
+                'shards': shards, 'region': region}
+        return 'tiles://' + json.dumps(spec)
+
     def execute_vizier_query(self, step: Literal[1, 2], server: Literal['vizier'],
                              catalogs: Sequence[str], fields: Sequence[str],
                              center: SkyCoord, geometry: dict, constraints: dict):
@@ -1235,125 +3272,775 @@ class AppServer:
 
         Parameters
         ----------
-        step : int
-            The step of the pipeline: 1 (science field) or 2 (control field).
-        server : str
-            Should always be "vizier"
-        catalogs : Sequence[str]
-            List of catalog names to retrieve (part `FROM` of the query).
-            If more than a catalog is provided, their table format must be
-            compatible.
-        fields : Sequence[str]
-            List of fields to retrieve (part `SELECT` of the query)
-        center : SkyCoord
-            The center of the area to query, as a SkyCoord
-        geometry: dict
-            Depending on the shape of the field, should report the relevant
-            parameters. For a cone query, the dict should have `radius` as
-            a key; for box queries, `width` and `height`. All these quantities
-            should be convertible to astropy.coordinates.Angle.
-        constraints : dict
-            Constraints to apply. The dictionary contains the column name as
-            keys, and the constraints as values.
+        step : int
+            The step of the pipeline: 1 (science field) or 2 (control field).
+        server : str
+            Should always be "vizier"
+        catalogs : Sequence[str]
+            List of catalog names to retrieve (part `FROM` of the query).
+            If more than a catalog is provided, their table format must be
+            compatible.
+        fields : Sequence[str]
+            List of fields to retrieve (part `SELECT` of the query)
+        center : SkyCoord
+            The center of the area to query, as a SkyCoord
+        geometry: dict
+            Depending on the shape of the field, should report the relevant
+            parameters. For a cone query, the dict should have `radius` as
+            a key; for box queries, `width` and `height`. All these quantities
+            should be convertible to astropy.coordinates.Angle.
+        constraints : dict
+            Constraints to apply. The dictionary contains the column name as
+            keys, and the constraints as values.
+
+        Returns
+        -------
+        job_url : str
+            The job virtual URL, which can be used to monitor the query and
+            retrieve the data when the query is completed. This URL is just
+            made of the string `vizier://` followed by the request string.
+        """
+        # Check if the query has changed
+        querydata = (server, catalogs, fields, center, geometry, constraints)
+        session = cherrypy.session  # pylint: disable=no-member
+        try:
+            if session.get(f'querydata_{step}', ()) == querydata:
+                return session[f'URLs_{step}']
+        except TypeError:
+            # This catches a comparison error in the SkyCoords in case of
+            # different frames: we will just consider the coordinates different!
+            pass
+        job_urls = []
+        try:
+            self.abort_query(step)
+            if self._process_state(session):
+                self.abort_process()
+            my_vizier = Vizier(columns=fields, timeout=VIZIER_TIMEOUT)
+            my_vizier.ROW_LIMIT = MAX_OBJS
+            region = {'frame': center.frame.name,
+                      'lon': center.spherical.lon.deg, 'lat': center.spherical.lat.deg}
+            region.update({k: Angle(v).deg for k, v in geometry.items()})
+            for catalog in catalogs:
+                key = QUERY_CACHE.make_key(server, catalog, fields, region, constraints)
+                if QUERY_CACHE.get(key, min_life=3600):
+                    job_urls.append('cache://' + key)
+                    continue
+                request = query_region_async(my_vizier, center, get_query_payload=True,
+                                             catalog=catalog, column_filters=constraints,
+                                             frame=center.frame.name, **geometry)
+                QUERY_CACHE.register('vizier://' + request, key)
+                job_urls.append('vizier://' + request)
+        except Exception:
+            return []
+        # Save the URLs
+        session[f'URLs_{step}'] = job_urls
+        session[f'querydata_{step}'] = querydata
+        return job_urls
+
+    def abort_query(self, step: Literal[1, 2]):
+        """Abort a query.
+
+        The abortion is actually performed using the thread pool by
+        `do_abort_queries`. Additionally, here the query cache files are
+        removed.
+
+        Parameters
+        ----------
+        step : int
+            The step to which the query refers: must be 1 (science field) or
+            2 (control field).
+        """
+        session = cherrypy.session  # pylint: disable=no-member
+        job_urls = session.get(f'URLs_{step}')
+        if job_urls:
+            self.executor.submit(self.do_abort_queries, job_urls)
+        session[f'URLs_{step}'] = None
+        session[f'querydata_{step}'] = ()
+        cache_path = f'processes/process_{session.id}_cache{step}.fits'
+        if USE_CACHE and os.path.isfile(cache_path):
+            try:
+                os.unlink(cache_path)
+            except (FileNotFoundError, PermissionError):
+                pass
+
+    ############################# Class methods ############################
+    # These methods can be safely used within a thread pool
+
+    @classmethod
+    def job_available(cls, job_url: str, min_life: float = 3600) -> bool:
+        """Check if the results of a job will be available for some time.
+
+        Parameters
+        ----------
+        job_url : str
+            The job URL (real or virtual).
+        min_life : float, default = 3600
+            The minimum time, in seconds, the results must still be available.
+        """
+        # pylint: disable=import-outside-toplevel
+        from datetime import datetime, timedelta, timezone
+        if job_url[:8] == 'cache://':
+            return QUERY_CACHE.get(job_url[8:], min_life=min_life) is not None
+        if job_url[:8] == 'tiles://':
+            spec = json.loads(job_url[8:])
+            if not all(cls.job_available(shard['job'], min_life=min_life)
+                       for shard in spec['shards']):
+                return False
+            missing = set(spec['missing'])
+            return all(TILE_CACHE.get(f"{spec['store']}-{tile}", min_life=min_life)
+                       for tile in spec['tiles'] if tile not in missing)
+        if job_url[:9] == 'vizier://' or job_url[:8] == 'local://':
+            return True
+        job = vo.dal.tap.AsyncTAPJob(job_url)
+        destruction = job.destruction.datetime
+        if destruction.tzinfo is None:
+            now = datetime.utcnow()
+        else:
+            now = datetime.now(timezone.utc)
+        return destruction - now >= timedelta(seconds=min_life)
+
+    @classmethod
+    def do_abort_queries(cls, job_urls: Sequence[str]):
+        """Abort one or more job queries.
+
+        Parameters
+        ----------
+        job_urls : sequence of strings
+            The list of query job URLs.
+        """
+        for job_url in job_urls:
+            if job_url[:8] == 'tiles://':
+                cls.do_abort_queries([shard['job'] for shard in
+                                      json.loads(job_url[8:])['shards']])
+                continue
+            if job_url[:9] == 'vizier://' or job_url[:8] == 'cache://':
+                continue
+            try:
+                job = vo.dal.tap.AsyncTAPJob(job_url)
+                job.delete()
+            except Exception:
+                pass
+
+    @classmethod
+    def pipeline_columns(cls, data_pr: dict) -> List[str]:
+        """Return the names of the catalog columns used by the pipeline.
+
+        These are the magnitudes, their errors, the coordinates, and the
+        morphological class (if any).
+        """
+        columns = list(data_pr['mags']) + list(data_pr['magErrs'])
+        for coord_spec in data_pr['coords']:
+            columns += list(coord_spec[1:3])
+        if data_pr['morphclass']:
+            columns.append(data_pr['morphclass'])
+        # Remove duplicates, keeping the order
+        return list(dict.fromkeys(columns))
+
+    @classmethod
+    def memory_footprint(cls, data_pr: dict, dtype: Any = np.float64) -> int:
+        """Estimate the peak memory, in bytes, used by a pipeline run.
+
+        This is a rough, conservative estimate based on the number of objects,
+        bands and components, on the size of the maps, and on the type used
+        to store the science field photometry (the control field is always
+        processed in double precision).
+        """
+        bands = len(data_pr['mags'])
+        colors = bands - 1
+        components = data_pr['numComponents']
+        columns = len(cls.pipeline_columns(data_pr))
+
+        def per_object(itemsize):
+            # Photometry (magnitudes, errors, log-probabilities) and colors
+            # with their covariances, plus indices and coordinates
+            return itemsize * (2 * bands + 2 + colors + colors**2) + 8 + 32
+
+        # Extinctions: a few quantities per object and per component
+        extinction = 8 * (6 + 3 * components)
+        raw = 8 * columns
+        nstars_cf, nstars_sf = data_pr['nstars_cf'], data_pr['nstars_sf']
+        control = nstars_cf * (raw + per_object(8) + extinction)
+        if STREAM_MIN_OBJS is not None and nstars_sf >= STREAM_MIN_OBJS:
+            # Only coordinates and extinctions are kept, plus the batches: the
+            # footprint is smaller, but still proportional to the objects
+            science = nstars_sf * (48 + extinction) + \
+                RETRIEVE_MAX_THREADS * STREAM_BATCH_SIZE * (raw + per_object(8))
+        else:
+            science = nstars_sf * (raw + per_object(np.dtype(dtype).itemsize) + extinction)
+        # Temporary arrays of the prediction of the blocks running in parallel
+        block = min(nstars_sf, PREDICT_BLOCK_SIZE or nstars_sf) * cls.predict_processes
+        predict = block * 3 * 8 * components * (colors**2 + colors + 1)
+        # Maps: all planes, plus the working copies of the smoothing
+        wcs = data_pr['wcs']
+        maps = 3 * 8 * len(PRODUCT_PLANES) * wcs['naxis1'] * wcs['naxis2']
+        return int(control + science + predict + maps)
+
+    @classmethod
+    def pipeline_dtype(cls, data_pr: dict) -> Any:
+        """Return the type used to store the science field photometry.
+
+        Double precision is used if the estimated footprint of the run (see
+        `memory_footprint`) fits within its memory budget (the `memoryBudget`
+        processing parameter, or `MEMORY_BUDGET`), single precision otherwise.
+
+        Raises
+        ------
+        ValueError
+            If the footprint exceeds the budget even in single precision.
+        """
+        budget = data_pr.get('memoryBudget', MEMORY_BUDGET)
+        if budget is None or cls.memory_footprint(data_pr, np.float64) <= budget:
+            return np.float64
+        footprint = cls.memory_footprint(data_pr, np.float32)
+        if footprint > budget:
+            raise ValueError(f'The pipeline would need about {footprint / 1024**3:.1f} GB '
+                             f'of memory, more than the {budget / 1024**3:.1f} GB available: '
+                             'please reduce the number of stars or the map size')
+        return np.float32
+
+    @classmethod
+    def photometric_catalogue(cls, data: Table, data_pr: dict,
+                              dtype: Any = np.float64) -> PhotometricCatalogue:
+        """Convert a catalog into a photometric catalogue for the pipeline."""
+        phot = PhotometricCatalogue.from_table(
+            data, data_pr['mags'], data_pr['magErrs'],
+            reddening_law=data_pr['reddeningLaw'],
+            class_names=[
+                'obj1', 'obj2'] if data_pr['morphclass'] else None,
+            class_prob_names=data_pr['morphclass'],
+            log_class_probs=False, dtype=dtype)
+        return phot
+
+    @classmethod
+    def control_field_photometry(cls, cf_data: Table, data_pr: dict,
+                                 info: Callable[..., Any]) -> PhotometricCatalogue:
+        """Build the photometric catalogue of the control field.
+
+        This is the `photometry` stage of the pipeline (steps 3 and 4): the
+        conversion of the photometric data and the fit of the number counts
+        and of the photometric uncertainties.
+        """
+        info(3, 'Converting photometric data')
+        phot_c = cls.photometric_catalogue(cf_data, data_pr)
+        phot_c.add_log_probs()
+        info(4, f'{len(phot_c):,.0f} objects with two or more bands')
+        info(4, 'Fitting number counts')
+        phot_c.fit_number_counts()
+        info(4, 'Fitting photometric uncertainties')
+        phot_c.fit_phot_uncertainties()
+        return phot_c
+
+    @classmethod
+    def select_control_field(cls, cf_data: Table, phot_c: PhotometricCatalogue,
+                             data_pr: dict, coords: Sequence[str], frame: str,
+                             wcs_frame: str, info: Callable[..., Any]) -> Optional[np.ndarray]:
+        """Select the control field objects used for the fit.
+
+        This is the `selection` stage of the pipeline (step 5): the objects
+        in the less extincted `areaFraction` of the control field, and among
+        them the `starFraction` with the smallest extinctions, are selected.
+
+        The extinctions are estimated with a single-component model fitted on
+        at most `SELECTION_FIT_SIZE` objects. They are then binned on the
+        finest HEALPix order (up to `SELECTION_MAX_ORDER`) that still has
+        `SELECTION_PIXEL_OBJS` objects in the median pixel, and the pixel
+        means are computed as weighted averages with a 3-sigma clipping.
+
+        Returns
+        -------
+        idx : np.ndarray or None
+            The indices of the selected objects of `phot_c`, or None if no
+            selection is requested.
+        """
+        info(5, f'Using coordinates in the {frame} frame')
+        if data_pr['starFraction'] >= 100 and data_pr['areaFraction'] >= 100:
+            return None
+        info(5, 'Selection of control field objects')
+        # We model control field data with a single Gaussian blob, fitted on a
+        # random (but reproducible) subsample
+        xd0 = XDGaussianMixture(n_components=1, n_classes=1)
+        xnicer0 = XNicer(xd0, [0.0])
+        if len(phot_c) > SELECTION_FIT_SIZE:
+            rng = np.random.default_rng(0)
+            xnicer0.fit(phot_c[np.sort(rng.choice(len(phot_c), SELECTION_FIT_SIZE,
+                                                  replace=False))])
+        else:
+            xnicer0.fit(phot_c)
+        # Finding the control field extinctions
+        ext_c0 = cls.predict_extinctions(xnicer0, phot_c.get_colors(),
+                                         logger=lambda message: info(5, message))
+        del xnicer0
+        mean_a = np.asarray(ext_c0['mean_A'], dtype=np.float64)
+        weight = 1.0 / np.asarray(ext_c0['variance_A'], dtype=np.float64)
+        del ext_c0
+        # and the control field coordinates
+        pix = cls.sky_pixels(cf_data, phot_c['idx'], coords, frame, wcs_frame,
+                             SELECTION_MAX_ORDER)
+        # Choose the HEALPix order: the nested scheme makes coarser pixels
+        # simple bit shifts of the finer ones
+        for order in range(SELECTION_MAX_ORDER, -1, -1):
+            cells, cell = np.unique(pix >> 2 * (SELECTION_MAX_ORDER - order),
+                                    return_inverse=True)
+            if np.median(np.bincount(cell)) >= SELECTION_PIXEL_OBJS:
+                break
+        info(5, f'Binning the control field extinctions on HEALPix order {order}')
+        # Weighted mean extinction of each pixel, with (at most three
+        # iterations of) a sigma clipping: the pixel statistics are always
+        # those of the objects surviving the last clipping
+        ncells = len(cells)
+        valid = np.isfinite(mean_a) & np.isfinite(weight)
+        for iteration in range(4):
+            sum_w = np.bincount(cell[valid], weight[valid], minlength=ncells)
+            sum_wa = np.bincount(cell[valid], (weight * mean_a)[valid], minlength=ncells)
+            sum_wa2 = np.bincount(cell[valid], (weight * mean_a**2)[valid], minlength=ncells)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cmap0 = sum_wa / sum_w
+                cvar0 = np.maximum(sum_wa2 / sum_w - cmap0**2, 0.0)
+            if iteration == 3:
+                break
+            deviation = (mean_a - cmap0[cell])**2
+            clipped = valid & (deviation <= 9.0 * cvar0[cell])
+            if np.array_equal(clipped, valid):
+                break
+            valid = clipped
+        civar0 = sum_w
+        # Areas with err < 9*median[err]
+        sel1 = civar0 > 0
+        median = np.median(civar0[sel1])
+        sel2 = np.flatnonzero(civar0 > median / 3)
+        nsel3 = int(len(sel2) * data_pr['areaFraction'])
+        if nsel3 < len(sel2):
+            sel3 = sel2[np.argpartition(cmap0[sel2], nsel3)[:nsel3]]
+        else:
+            sel3 = sel2
+        mask = np.zeros(ncells, dtype=bool)
+        mask[sel3] = True
+        sel4 = np.flatnonzero(mask[cell])
+        info(5, f'Selected {len(sel4):,.0f} objects from the ' +
+             'control field extinction map')
+        nsel5 = int(len(sel4) * data_pr['starFraction'])
+        if nsel5 < len(sel4):
+            sel5 = np.sort(np.argpartition(mean_a[sel4], nsel5)[:nsel5])
+        else:
+            sel5 = np.arange(len(sel4))
+        info(5, f'Selected {len(sel5):,.0f} objects from individual extinctions')
+        return sel4[sel5]
+
+    @staticmethod
+    def sky_pixels(table: Table, rows: np.ndarray, coords: Sequence[str], frame: str,
+                   wcs_frame: str, order: int) -> np.ndarray:
+        """Return the nested HEALPix pixels, in the map frame, of some rows of a table."""
+        coord = getattr(AstrometricCatalogue.from_table(
+            table, coords, unit='deg', frame=frame), wcs_frame)[rows]
+        names = list(coord.frame.representation_component_names.keys())
+        return hp.ang2pix(hp.order2nside(order), getattr(coord, names[0]).deg,
+                          getattr(coord, names[1]).deg, nest=True, lonlat=True)
+
+    @classmethod
+    def fit_extreme_deconvolution(cls, cf_data: Table, phot_c: PhotometricCatalogue,
+                                  data_pr: dict, coords: Sequence[str], frame: str,
+                                  wcs_frame: str, info: Callable[..., Any]) -> XNicer:
+        """Fit the XNicer model of the selected control field objects.
+
+        This is the `xd` stage of the pipeline (step 5). Control fields with
+        more than `XD_FIT_SIZE` objects are fitted on a subsample stratified
+        on the sky (see `stratified_subsample`), and the fit is checked on
+        `XD_HOLDOUT_SIZE` held-out objects. The model is always fitted from
+        scratch: it is not warm-started from the model of a previous run.
+        """
+        info(5, 'Performing the extreme deconvolution')
+        xd = XDGaussianMixture(n_components=data_pr['numComponents'],
+                               n_classes=2 if data_pr['morphclass'] else 1)
+        xnicer = XNicer(xd, np.linspace(0.0, data_pr['maxExtinction'],
+                                        data_pr['extinctionSteps']))
+        if not XD_FIT_SIZE or len(phot_c) <= XD_FIT_SIZE:
+            xnicer.fit(phot_c)
+            return xnicer
+        pix = cls.sky_pixels(cf_data, phot_c['idx'], coords, frame, wcs_frame,
+                             SELECTION_MAX_ORDER)
+        fit_idx, holdout_idx = cls.stratified_subsample(pix, XD_FIT_SIZE, XD_HOLDOUT_SIZE)
+        del pix
+        info(5, f'Fitting a stratified subsample of {len(fit_idx):,.0f} objects')
+        xnicer.fit(phot_c[fit_idx])
+        # Convergence report: the extinctions of a control field should be
+        # compatible with zero, on the fitted and on the held-out objects alike;
+        # the fitted objects are compared on a random subset of the same size
+        # of the held-out sample
+        rng = np.random.default_rng(1)
+        check_idx = np.sort(rng.choice(fit_idx, min(len(holdout_idx), len(fit_idx)),
+                                       replace=False))
+        reports = []
+        for name, idx in (('fitted', check_idx), ('held-out', holdout_idx)):
+            ext = cls.predict_extinctions(xnicer, phot_c[idx].get_colors(),
+                                          logger=lambda message: info(5, message))
+            bias, mse, err = cls.extinction_statistics(ext)
+            reports.append(f'{name}: Bias = {bias:.3f}, MSE = {mse:.3f}, Err = {err:.3f}')
+        info(5, f'Subsample fit checked on {len(check_idx):,.0f} fitted and '
+             f'{len(holdout_idx):,.0f} held-out objects, ' + '; '.join(reports))
+        return xnicer
+
+    @staticmethod
+    def stratified_subsample(pix: np.ndarray, nfit: int, nholdout: int) -> tuple:
+        """Draw a fit subsample and a disjoint held-out sample of a catalogue.
+
+        The fit subsample is stratified on the sky: the objects are sorted by
+        their nested HEALPix pixel `pix`, split in `nfit` consecutive blocks
+        of (almost) equal size, and an object is drawn at random from each of
+        them. As the pixels of each coarser HEALPix order are contiguous in
+        this sorting, every area of the field contributes in proportion to
+        its objects, whatever the order of the rows returned by the server.
+        The held-out objects are drawn at random among the remaining ones.
+        The random generator has a fixed seed, so that the samples are
+        reproducible.
+
+        Returns
+        -------
+        fit_idx, holdout_idx : np.ndarray
+            The sorted indices of the fit subsample and of the held-out sample.
+        """
+        rng = np.random.default_rng(0)
+        size = len(pix)
+        order = np.argsort(pix, kind='stable')
+        edges = (np.arange(nfit + 1) * (size / nfit)).astype(np.int64)
+        fit_idx = np.sort(
+            order[edges[:-1] + (rng.random(nfit) * np.diff(edges)).astype(np.int64)])
+        del order
+        rest = np.ones(size, dtype=bool)
+        rest[fit_idx] = False
+        rest = np.flatnonzero(rest)
+        holdout_idx = np.sort(rng.choice(rest, min(nholdout, len(rest)), replace=False))
+        return fit_idx, holdout_idx
+
+    @staticmethod
+    def extinction_statistics(ext: Any) -> tuple:
+        """Return the bias, the MSE and the average error of some extinctions.
+
+        The statistics are weighted with the inverse variances of the
+        extinctions; for a control field they should be close to zero (bias)
+        and to each other (MSE and error).
+        """
+        # Compute the weights as the inverse of each extinction measurement
+        weight = 1.0 / ext['variance_A']
+        # We normalize the weight so that its mean is unity: this simplifies
+        # some of the equations below
+        weight /= np.mean(weight)
+        # The bias is the weighted sum of the extinction measurements
+        bias = np.mean(ext['mean_A'] * weight)
+        # The mean squared error is computed below
+        mse = np.sqrt(np.mean((ext['mean_A'] * weight) ** 2))
+        # Average estimated variance: should be close to the MSE
+        err = np.sqrt(np.mean(ext['variance_A'] * weight**2))
+        return bias, mse, err
+
+    @classmethod
+    def calibrate_control_field(cls, xnicer: XNicer, phot_c: PhotometricCatalogue,
+                                data_pr: dict, info: Callable[..., Any]) -> dict:
+        """Calibrate the XNicer model and compute the control field statistics.
+
+        This is the `calibration` stage of the pipeline (steps 6 and 7). The
+        model `xnicer` is not modified: a calibrated copy is returned.
+
+        Returns
+        -------
+        model : dict
+            A dictionary with the calibrated XNicer object (`xnicer`), the
+            bias, the mean squared error and the average estimated error of
+            the control field extinctions (`bias`, `mse`, `err`).
+        """
+        info(6, 'Performing the control field a-posteriori calibration')
+        xnicer = copy.deepcopy(xnicer)
+        xnicer.calibrate(phot_c,
+                         np.linspace(
+                            -1.0, data_pr['maxExtinction'],
+                            data_pr['extinctionSteps']*data_pr['extinctionSubsteps']),
+                         update_errors=False)
+        info(7, 'Control field analysis')
+        # Compute the extinction from the color catalogue
+        ext_c = cls.predict_extinctions(xnicer, phot_c.get_colors(),
+                                        logger=lambda message: info(7, message))
+        bias_c, mse_c, err_c = cls.extinction_statistics(ext_c)
+        # We also make an histogram plot with the next line, but we don't here!
+        # plt.hist(ext_c['mean_A'], bins=200, range=[-1, 1])
+        return {'xnicer': xnicer, 'bias': bias_c, 'mse': mse_c, 'err': err_c}
+
+    @classmethod
+    def predict_extinctions(cls, xnicer: XNicer, colors: Any,
+                            logger: Callable[[str], Any] = logging.info) -> Any:
+        """Predict the extinctions of a color catalogue in blocks.
+
+        The catalogue is split in blocks of `PREDICT_BLOCK_SIZE` objects,
+        predicted in parallel by `predict_processes` forked processes, each
+        using `PREDICT_BLAS_THREADS` BLAS threads: the per-object temporary
+        arrays of the prediction are therefore bounded by the block size.
+        The processes inherit the inputs from this process, and write the
+        results directly in preallocated output columns kept in shared memory;
+        the progress is reported through `logger`.
+
+        Parameters
+        ----------
+        xnicer : XNicer
+            The fitted (and calibrated) XNicer object.
+        colors : ColorCatalogue
+            The color catalogue, as returned by `PhotometricCatalogue.get_colors`.
+        logger : Callable[[str], Any]
+            The logging function used for the progress.
 
         Returns
         -------
-        job_url : str
-            The job virtual URL, which can be used to monitor the query and
-            retrieve the data when the query is completed. This URL is just
-            made of the string `vizier://` followed by the request string.
+        ext : ExtinctionCatalogue
+            The extinction catalogue, as returned by `XNicer.predict`.
         """
-        # Check if the query has changed
-        querydata = (server, catalogs, fields, center, geometry, constraints)
-        session = cherrypy.session  # pylint: disable=no-member
+        global _predict_task  # pylint: disable=global-statement
+        size = len(colors)
+        if not PREDICT_BLOCK_SIZE or size <= PREDICT_BLOCK_SIZE:
+            return xnicer.predict(colors)
+        starts = range(0, size, PREDICT_BLOCK_SIZE)
+        first = xnicer.predict(colors[0:PREDICT_BLOCK_SIZE])
+        # Output columns in anonymous shared memory, inherited by the forks
+        columns = {}
+        for name in first.colnames:
+            dtype = np.dtype(first[name].dtype)
+            shape = (size,) + first[name].shape[1:]
+            buffer = mmap.mmap(-1, max(1, int(np.prod(shape)) * dtype.itemsize))
+            columns[name] = np.frombuffer(buffer, dtype=dtype,
+                                          count=int(np.prod(shape))).reshape(shape)
+            columns[name][:len(first)] = np.asarray(first[name])
+        catalogue_type, meta = type(first), first.meta
+        del first
+        processes = min(cls.predict_processes, len(starts) - 1)
+        _predict_task = (xnicer, colors, columns)
         try:
-            if session.get(f'querydata_{step}', ()) == querydata:
-                return session[f'URLs_{step}']
-        except TypeError:
-            # This catches a comparison error in the SkyCoords in case of
-            # different frames: we will just consider the coordinates different!
-            pass
-        job_urls = []
+            if processes <= 1:
+                blocks = map(_predict_block, starts[1:])
+                for done, _ in enumerate(blocks, 2):
+                    logger(f'%{done / len(starts) * 100}')
+            else:
+                context = mp.get_context('fork')
+                # On errors or aborts, the pool is terminated on exit
+                with context.Pool(processes, initializer=_predict_init,
+                                  initargs=(PREDICT_BLAS_THREADS,)) as pool:
+                    blocks = pool.imap_unordered(_predict_block, starts[1:])
+                    for done, _ in enumerate(blocks, 2):
+                        logger(f'%{done / len(starts) * 100}')
+        finally:
+            _predict_task = None
+        return catalogue_type(columns, meta=meta, copy=False)
+
+    @classmethod
+    def predict_science_field(cls, phot_s: PhotometricCatalogue, xnicer: XNicer,
+                              info: Callable[..., Any]) -> Table:
+        """Compute the extinctions of the science field objects.
+
+        This is the `predict` stage of the pipeline (step 9), after the
+        conversion of the photometric data.
+        """
+        info(9, f'{len(phot_s)} objects with two or more bands')
+        phot_s.add_log_probs()
+        info(9, 'Computing extinctions')
+        return cls.predict_extinctions(xnicer, phot_s.get_colors(),
+                                       logger=lambda message: info(9, message))
+
+    @staticmethod
+    def product_stream_digest(path: str) -> Optional[str]:
+        """Return the digest of the streamed science field of a product, if any."""
         try:
-            self.abort_query(step)
-            if self._process_state(session):
-                self.abort_process()
-            my_vizier = Vizier(columns=fields, timeout=VIZIER_TIMEOUT)
-            my_vizier.ROW_LIMIT = MAX_OBJS
-            for catalog in catalogs:
-                request = query_region_async(my_vizier, center, get_query_payload=True,
-                                             catalog=catalog, column_filters=constraints,
-                                             frame=center.frame.name, **geometry)
-                job_urls.append('vizier://' + request)
-        except Exception:
-            return []
-        # Save the URLs
-        session[f'URLs_{step}'] = job_urls
-        session[f'querydata_{step}'] = querydata
-        return job_urls
+            return fits.getheader(path).get('SFDIGEST')
+        except (OSError, ValueError):
+            return None
 
-    def abort_query(self, step: Literal[1, 2]):
-        """Abort a query.
+    @classmethod
+    def stream_science_field(cls, session_id: str, xnicer: XNicer, data_pr: dict,
+                             columns: Sequence[str], coords: Sequence[str],
+                             info: Callable[..., Any], dtype: Any = np.float64) -> tuple:
+        """Retrieve and predict the science field in batches.
 
-        The abortion is actually performed using the thread pool by
-        `do_abort_queries`. Additionally, here the query cache files are
-        removed.
+        This replaces the `predict` stage of the pipeline (steps 8 and 9) for
+        large science fields. Each part of the science field data is split
+        in batches of `STREAM_BATCH_SIZE` objects, which are converted and
+        predicted as soon as the part is downloaded (see the `consumer`
+        argument of `retrieve_data`), so that the computation overlaps with
+        the other downloads. Only the coordinates and the extinctions are
+        kept, so the photometric columns are never stored for the whole
+        catalogue. The memory used is not bounded, though: it still grows
+        linearly with the number of objects, since the maps are made from all
+        the extinctions at once.
 
-        Parameters
-        ----------
-        step : int
-            The step to which the query refers: must be 1 (science field) or
-            2 (control field).
+        Each part is also hashed (see `table_digest`), so that the retrieved
+        data can be identified even if they are never joined.
+
+        Returns
+        -------
+        coord_table : Table
+            A table with the coordinates `coords` of all objects.
+        ext_s : ExtinctionCatalogue
+            The extinctions, with indices referring to the rows of `coord_table`.
+        digest : str
+            A digest of the content of the retrieved data, independent of the
+            order in which the parts were retrieved.
         """
-        session = cherrypy.session  # pylint: disable=no-member
-        job_urls = session.get(f'URLs_{step}')
-        if job_urls:
-            self.pool.apply_async(self.do_abort_queries, (job_urls,))
-        session[f'URLs_{step}'] = None
-        session[f'querydata_{step}'] = ()
-        cache_path = f'processes/process_{session.id}_cache{step}.fits'
-        if USE_CACHE and os.path.isfile(cache_path):
-            try:
-                os.unlink(cache_path)
-            except (FileNotFoundError, PermissionError):
-                pass
+        lock = threading.Lock()
+        predict_lock = threading.Lock()
+        coord_accumulator = TableAccumulator(coords, size=data_pr['nstars_sf'])
+        ext_accumulator = TableAccumulator(size=data_pr['nstars_sf'])
+        ext_types = []
+        digests = []
 
-    ############################# Class methods ############################
-    # These methods can be safely used within a thread pool
+        def consume(table):
+            digest = table_digest(table).hexdigest()
+            with lock:
+                digests.append(digest)
+            for start in range(0, len(table), STREAM_BATCH_SIZE):
+                batch = table[start:start + STREAM_BATCH_SIZE]
+                phot = cls.photometric_catalogue(batch, data_pr, dtype=dtype)
+                phot.add_log_probs()
+                # XNicer.predict is not known to be thread-safe
+                with predict_lock:
+                    ext = xnicer.predict(phot.get_colors())
+                with lock:
+                    ext['idx'] += len(coord_accumulator)
+                    coord_accumulator.append(batch)
+                    ext_accumulator.append(ext)
+                    if not ext_types:
+                        ext_types.append(type(ext))
+
+        cls.retrieve_data(session_id, 1, data_pr['urls_sf'],
+                          logger=lambda message: info(8, message),
+                          expected_records=data_pr['nstars_sf'],
+                          columns=columns, consumer=consume)
+        if not ext_types:
+            info(8, 'Cannot retrieve the data: giving up')
+            raise ValueError
+        info(9, f'{len(coord_accumulator):,.0f} objects found, '
+             f'{len(ext_accumulator):,.0f} with two or more bands')
+        digest = hashlib.sha256(json.dumps(sorted(digests)).encode()).hexdigest()
+        return (coord_accumulator.to_table(),
+                ext_types[0](ext_accumulator.to_table(), copy=False), digest)
 
     @classmethod
-    def do_abort_queries(cls, job_urls: Sequence[str]):
-        """Abort one or more job queries.
+    def science_field_maps(cls, coord_s: AstrometricCatalogue, ext_s: Table,
+                           data_pr: dict, wcs_frame: str,
+                           info: Callable[..., Any]) -> fits.PrimaryHDU:
+        """Build the extinction maps of the science field.
 
-        Parameters
-        ----------
-        job_urls : sequence of strings
-            The list of query job URLs.
+        This is the `map` stage of the pipeline (step 10).
         """
-        for job_url in job_urls:
-            if job_url[:9] == 'vizier://':
-                continue
+        info(10, 'Map making')
+        wcs = data_pr['wcs']
+        w = astropy.wcs.WCS(naxis=2)
+        w.pixel_shape = (wcs['naxis1'], wcs['naxis2'])
+        w.wcs.crpix = [wcs['crpix1'], wcs['crpix2']]
+        if wcs_frame == 'galactic':
+            w.wcs.ctype = [f'GLON-{wcs["projection"]}',
+                           f'GLAT-{wcs["projection"]}']
+        else:
+            w.wcs.ctype = [f'RA---{wcs["projection"]}',
+                           f'DEC--{wcs["projection"]}']
+        w.wcs.crval = [wcs['crval1'], wcs['crval2']]
+        w.wcs.cdelt = [-wcs['scale'] / 3600.0, wcs['scale'] / 3600.0]
+        w.wcs.crota = [0.0, wcs['crota2']]
+        if isinstance(wcs['lonpole'], (int, float)) and \
+            wcs['lonpole'] == wcs['lonpole']:
+            w.wcs.lonpole = wcs['lonpole']
+        if isinstance(wcs['latpole'], (int, float)) and \
+                wcs['latpole'] == wcs['latpole']:
+            w.wcs.latpole = wcs['latpole']
+        if coord_s.equinox:
+            w.wcs.equinox = np.round(coord_s.equinox.decimalyear)
+        smoother = KDE(tuple(reversed(w.pixel_shape)), max_power=2,
+                       bandwidth=data_pr['smoothpar'])
+        use_xnicest = bool(
+            {'XNICEST map', 'XNICEST inverse variance'} & set(data_pr['products']))
+        return make_maps(getattr(coord_s, wcs_frame), ext_s, w,
+                         smoother, n_iters=data_pr['clipIters'],
+                         tolerance=data_pr['clipping'], use_xnicest=use_xnicest)
+
+    @classmethod
+    def run_worker(cls, nprocs: int = 1):
+        """Run pipeline jobs taken from the job queue, forever.
+
+        This is the main function of the worker processes (see `WorkerPool`).
+        While a job runs, a watchdog thread refreshes its heartbeat, so that
+        long silent steps are not taken for lost jobs, and checks for abort
+        requests: when one is found, a SIGINT is sent to the worker itself, so
+        that a KeyboardInterrupt stops the pipeline at the next Python
+        instruction, even within long computations of the xnicer library.
+
+        The cores of the host are shared among the `nprocs` workers: each
+        worker limits its BLAS threads, and the processes used to predict
+        extinctions (see `predict_extinctions`), accordingly.
+        """
+        host = socket.gethostname()
+        cls.predict_processes = worker_predict_processes(nprocs)
+        threadpool_limits(cls.predict_processes * PREDICT_BLAS_THREADS)
+
+        # The lock makes sure that the SIGINT is only sent while the job runs
+        lock = threading.Lock()
+
+        def watchdog(job_id: int, done: threading.Event):
+            while not done.wait(JOB_POLL_INTERVAL):
+                try:
+                    alive = JOB_QUEUE.heartbeat(job_id)
+                except Exception:
+                    logging.exception('Could not update the heartbeat of job %d', job_id)
+                    continue
+                if not alive:
+                    with lock:
+                        if not done.is_set():
+                            os.kill(os.getpid(), signal.SIGINT)
+                    break
+
+        process_log = None
+        while True:
             try:
-                job = vo.dal.tap.AsyncTAPJob(job_url)
-                job.delete()
-            except Exception:
-                pass
+                if process_log is not None:
+                    # A job whose completion could not be recorded
+                    JOB_QUEUE.finish(process_log)
+                    process_log = None
+                job = JOB_QUEUE.claim(host, os.getpid())
+                if job is None:
+                    time.sleep(JOB_POLL_INTERVAL)
+                    continue
+                session_id, process_log = job
+                done = threading.Event()
+                threading.Thread(target=watchdog, args=(process_log.job_id, done),
+                                 daemon=True).start()
+                try:
+                    with open(f'processes/process_{session_id}.dat', 'rb') as data_file:
+                        pickle.load(data_file)
+                        data_pr = pickle.load(data_file)
+                    cls.do_process(session_id, process_log, data_pr)
+                except (Exception, KeyboardInterrupt):
+                    logging.exception('Job of session %s stopped', session_id)
+                finally:
+                    with lock:
+                        done.set()
+                JOB_QUEUE.finish(process_log)
+                process_log = None
+            except (Exception, KeyboardInterrupt):
+                # A late interrupt, or an error of the job queue: the worker
+                # keeps running, and the completion is recorded again
+                logging.exception('Error in the worker loop')
+                time.sleep(JOB_POLL_INTERVAL)
 
     @classmethod
-    def do_process(cls, session_id: str, process_log: List[ProcessLogEntry],
-                   data_pr: dict, interactive_mode: bool = False):
+    def do_process(cls, session_id: str, process_log: Union[ProcessLog, MemoryProcessLog],
+                   data_pr: dict, interactive_mode: bool = False,
+                   resume: Optional[str] = None):
         """Perform the bulk of the pipeline processing.
 
-        This function will be slow: it should be called within a thread pool.
+        This function will be slow: it is called by the workers of the job
+        queue (see `run_worker`).
         The result of the pipeline can be monitored with the `process_log`
-        variable.
+        variable. The pipeline is split in stages (see `PIPELINE_STAGES`),
+        whose outputs are checkpointed by `StageCheckpoints`: a new run only
+        executes the stages whose inputs have changed.
 
         Parameters
         ----------
         session_id : str
             The unique session id, used to select the correct files.
-        process_log : List[ProcessLogEntry]
-            A list that will hold the log entries associated to the current
+        process_log : Union[ProcessLog, MemoryProcessLog]
+            The log that will hold the entries associated to the current
             process
         data_pr : dict
             A large dictionary with the relevant parameters for the processing.
@@ -1362,11 +4049,15 @@ class AppServer:
         interactive_mode : bool
             If true, the execution is taken to be in interactive mode. Useful
             for debugging purposes.
+        resume : str, optional
+            The name of a stage of the pipeline (see `PIPELINE_STAGES`): if
+            provided, the checkpoints of this stage and of the following ones
+            are ignored, and these stages are executed again.
 
         Raises
         ------
         KeyboardInterrupt
-            Raised when the process log has 'abort' as last entry
+            Raised when the job is aborted
         ValueError
             Raised for any processing error.
         """
@@ -1377,46 +4068,40 @@ class AppServer:
                                 level=logging.DEBUG)
         t0 = time.perf_counter()
 
+        last_step = 0
+
         def info(step: int, message: str,
                  state: Literal['run', 'end', 'error', 'abort'] = 'run'):
+            nonlocal last_step
+            if step < 0:
+                step = last_step
+            last_step = step
+            entry: ProcessLogEntry = {'time': time.perf_counter() - t0,
+                                      'state': state,
+                                      'step': step,
+                                      'message': message}
             if len(message) and message[0] == '%':
-                if len(process_log) > 0 and process_log[-1]['message'][0] == '%':
-                    process_log.pop()
+                process_log.progress(entry)
             else:
                 logging.info('%s', message)
-            if len(process_log) > 0 and process_log[-1]['state'] == 'abort':
-                raise KeyboardInterrupt
-            if step < 0:
-                if len(process_log) > 0:
-                    step = process_log[-1]['step']
-                else:
-                    step = 0
-            process_log.append(
-                {'time': time.perf_counter() - t0,
-                 'state': state,
-                 'step': step,
-                 'message': message})
+                process_log.append(entry)
         try:
             info(1, f'Starting (session id: {session_id})')
+            # The tile pyramids of a previous run must not be served meanwhile
+            cls.remove_hips(session_id)
+            checkpoints = StageCheckpoints(session_id, data_pr, resume)
+            dtype = cls.pipeline_dtype(data_pr)
+            if dtype != np.float64:
+                info(1, 'Using single precision to fit within the memory budget')
+            if resume:
+                info(1, f'Resuming from the {resume} stage')
             info(1, f'Retrieving control field data: expecting {data_pr["nstars_cf"]:,.0f} objects')
+            columns = cls.pipeline_columns(data_pr)
             cf_data = cls.retrieve_data(session_id, 2, data_pr['urls_cf'],
                                         logger=lambda message: info(2, message),
-                                        expected_records=data_pr["nstars_cf"])
+                                        expected_records=data_pr["nstars_cf"],
+                                        columns=columns)
             info(3, f'{len(cf_data):,.0f} objects found')
-            info(3, 'Converting photometric data')
-            phot_c = PhotometricCatalogue.from_table(
-                cf_data, data_pr['mags'], data_pr['magErrs'],
-                reddening_law=data_pr['reddeningLaw'],
-                class_names=[
-                    'obj1', 'obj2'] if data_pr['morphclass'] else None,
-                class_prob_names=data_pr['morphclass'],
-                log_class_probs=False, dtype=np.float64)
-            phot_c.add_log_probs()
-            info(4, f'{len(phot_c):,.0f} objects with two or more bands')
-            info(4, 'Fitting number counts')
-            phot_c.fit_number_counts()
-            info(4, 'Fitting photometric uncertainties')
-            phot_c.fit_phot_uncertainties()
             # Check which coordinates to use
             wcs = data_pr['wcs']
             data_coords = {v[0]: (v[1], v[2]) for v in data_pr['coords']}
@@ -1436,130 +4121,142 @@ class AppServer:
                 else:
                     frame = 'galactic'
                     coords = data_coords['G']
-            info(5, f'Using coordinates in the {frame} frame')
+            # The keys of the control field stages: the coordinates only
+            # matter when a selection of the control field objects is requested
+            checkpoints.key('cf', extra=table_digest(cf_data).hexdigest())
+            checkpoints.key('photometry', ['cf'])
             if data_pr['starFraction'] < 100 or data_pr['areaFraction'] < 100:
-                info(5, 'Selection of control field objects')
-                # We model control field data with a single Gaussian blob
-                xd0 = XDGaussianMixture(n_components=1, n_classes=1)
-                xnicer0 = XNicer(xd0, [0.0])
-                xnicer0.fit(phot_c)
-                # Finding the control field extinctions
-                ext_c0 = xnicer0.predict(phot_c.get_colors())
-                # and the control field coordinates
-                coord_c0 = AstrometricCatalogue.from_table(
-                    cf_data, coords, unit='deg', frame=frame)
-                # Guessing the control field WCS
-                coord_c1 = getattr(coord_c0, wcs_frame)
-                w0 = guess_wcs(coord_c1,
-                               nobjs=len(ext_c0), target_density=5.0)
-                smoother0 = KDE(tuple(reversed(w0.pixel_shape)), max_power=2,
-                                bandwidth=2.0)
-                hdu0 = make_maps(coord_c1, ext_c0, w0,
-                                 smoother0, n_iters=3, tolerance=3.0, use_xnicest=False)
-                cmap0 = hdu0.data[0, :, :]
-                civar0 = hdu0.data[1, :, :]
-                mask = np.zeros_like(cmap0, dtype=np.uint8)
-                sel1 = np.where(cmap0 != 0)
-                median = np.median(civar0[sel1])
-                sel2 = np.where(civar0 > median / 3)  # Areas with err < 9*median[err]
-                srt1 = np.argsort(cmap0[sel2])
-                sel3 = srt1[0:int(len(srt1) * data_pr['areaFraction'])]
-                mask[sel2[0][sel3], sel2[1][sel3]] = 1
-                names = list(
-                    coord_c1.frame.representation_component_names.keys())
-                coord_c2 = coord_c1[phot_c['idx']]
-                xy = w0.all_world2pix(
-                    getattr(coord_c2, names[0]).deg,
-                    getattr(coord_c2, names[1]).deg, 0)
-                sel4 = np.where(mask[(np.round(xy[1])).astype(int), (np.round(xy[0])).astype(int)])
-                phot_c = phot_c[sel4]
-                ext_c0 = ext_c0[sel4]
-                info(5, f'Selected {len(phot_c):,.0f} objects from the ' +
-                     'control field extinction map')
-                srt2 = np.argsort(ext_c0['mean_A'])
-                sel5 = srt2[0:int(len(phot_c) * data_pr['starFraction'])]
-                phot_c = phot_c[sel5]
-                info(5, f'Selected {len(phot_c):,.0f} objects from individual extinctions')
-            info(5, 'Performing the extreme deconvolution')
-            xd = XDGaussianMixture(n_components=data_pr['numComponents'],
-                                   n_classes=2 if data_pr['morphclass'] else 1)
-            xnicer = XNicer(xd, np.linspace(0.0, data_pr['maxExtinction'],
-                                            data_pr['extinctionSteps']))
-            xnicer.fit(phot_c)
-            info(6, 'Performing the control field a-posteriori calibration')
-            xnicer.calibrate(phot_c,
-                             np.linspace(
-                                -1.0, data_pr['maxExtinction'],
-                                data_pr['extinctionSteps']*data_pr['extinctionSubsteps']),
-                             update_errors=False)
-            info(7, 'Control field analysis')
-            # Compute the extinction from the color catalogue
-            ext_c = xnicer.predict(phot_c.get_colors())
-            # Compute the weights as the inverse of each extinction measurement
-            weight_c = 1.0 / ext_c['variance_A']
-            # We normalize the weight_c so that its mean is unity: this simplifies
-            # some of the equations below
-            weight_c /= np.mean(weight_c)
-            # The bias is the weighted sum of the extinction measurements
-            bias_c = np.mean(ext_c['mean_A'] * weight_c)
-            # The mean squared error is computed below
-            mse_c = np.sqrt(np.mean((ext_c['mean_A'] * weight_c) ** 2))
-            # Average estimated variance: should be close to the MSE
-            err_c = np.sqrt(np.mean(ext_c['variance_A'] * weight_c**2))
-            # We also make an histogram plot with the next line, but we don't here!
-            # plt.hist(ext_c['mean_A'], bins=200, range=[-1, 1])
+                checkpoints.key('selection', ['photometry'],
+                                extra=[list(coords), frame, wcs_frame, SELECTION_FIT_SIZE,
+                                       SELECTION_MAX_ORDER, SELECTION_PIXEL_OBJS])
+            else:
+                checkpoints.key('selection', ['photometry'])
+            checkpoints.key('xd', ['selection'],
+                            extra=[XD_FIT_SIZE, XD_HOLDOUT_SIZE, list(coords), frame,
+                                   wcs_frame, SELECTION_MAX_ORDER])
+            checkpoints.key('calibration', ['xd'])
+
+            # The stages are computed lazily, from the last one: a stage whose
+            # checkpoint is valid never needs the outputs of the previous ones
+            def photometry():
+                return checkpoints.get(
+                    'photometry',
+                    lambda: cls.control_field_photometry(cf_data, data_pr, info),
+                    logger=lambda message: info(4, message))
+
+            def selection():
+                phot_c = photometry()
+                idx = checkpoints.get(
+                    'selection',
+                    lambda: cls.select_control_field(cf_data, phot_c, data_pr, coords,
+                                                     frame, wcs_frame, info),
+                    logger=lambda message: info(5, message))
+                return phot_c if idx is None else phot_c[idx]
+
+            def calibration():
+                phot_c = selection()
+                xnicer = checkpoints.get(
+                    'xd', lambda: cls.fit_extreme_deconvolution(cf_data, phot_c, data_pr,
+                                                                coords, frame, wcs_frame,
+                                                                info),
+                    logger=lambda message: info(5, message))
+                return cls.calibrate_control_field(xnicer, phot_c, data_pr, info)
+
+            model = checkpoints.get('calibration', calibration,
+                                    logger=lambda message: info(7, message))
+            checkpoints.release('photometry', 'selection', 'xd')
+            # The stage closures above refer to cf_data: it is released, but
+            # not deleted
+            cf_data = None
+            xnicer = model['xnicer']
+            bias_c, mse_c, err_c = model['bias'], model['mse'], model['err']
             info(7, f'Bias = {bias_c:.3f}, MSE = {mse_c:.3f}, Err = {err_c:.3f}')
-            info(7,
-                 f'Retrieving science field data: expecting {data_pr["nstars_sf"]:,.0f} objects')
-            sf_data = cls.retrieve_data(session_id, 1, data_pr['urls_sf'],
-                                        logger=lambda message: info(8, message),
-                                        expected_records=data_pr["nstars_sf"])
-            info(9, f'{len(sf_data):,.0f} objects found')
-            info(9, 'Converting photometric data')
-            phot_s = PhotometricCatalogue.from_table(
-                sf_data, data_pr['mags'], data_pr['magErrs'],
-                reddening_law=data_pr['reddeningLaw'],
-                class_names=[
-                    'obj1', 'obj2'] if data_pr['morphclass'] else None,
-                class_prob_names=data_pr['morphclass'],
-                log_class_probs=False, dtype=np.float64)
-            info(9, f'{len(phot_s)} objects with two or more bands')
-            phot_s.add_log_probs()
-            info(9, 'Computing extinctions')
-            ext_s = xnicer.predict(phot_s.get_colors())
-            coord_s = AstrometricCatalogue.from_table(
-                sf_data, coords, unit='deg', frame=frame)
-            info(10, 'Map making')
-            w = astropy.wcs.WCS(naxis=2)
-            w.pixel_shape = (wcs['naxis1'], wcs['naxis2'])
-            w.wcs.crpix = [wcs['crpix1'], wcs['crpix2']]
-            if wcs_frame == 'galactic':
-                w.wcs.ctype = [f'GLON-{wcs["projection"]}',
-                               f'GLAT-{wcs["projection"]}']
+            product_path = f'processes/process_{session_id}.fits'
+            map_extra = [list(coords), frame, wcs_frame]
+            digest = None
+            if STREAM_MIN_OBJS is not None and data_pr['nstars_sf'] >= STREAM_MIN_OBJS:
+                # Streaming mode: the science field is predicted while it is
+                # retrieved, so that no predict checkpoint exists; the digest
+                # of the retrieved parts, together with the queries, keys the
+                # following stages, and is recorded in the product
+                def stream_keys(stream_digest: str):
+                    checkpoints.key('sf', extra=['stream', data_pr['urls_sf'], stream_digest])
+                    checkpoints.key('predict', ['calibration', 'sf'],
+                                    extra=[list(coords), frame, np.dtype(dtype).name])
+
+                # The results of a query do not change: if the product of a
+                # previous run of the same queries is still valid, the science
+                # field is not streamed again
+                digest = cls.product_stream_digest(product_path)
+                if digest is not None:
+                    stream_keys(digest)
+                    checkpoints.key('map', ['predict'], extra=map_extra)
+                if digest is None or not checkpoints.valid_product('map', product_path):
+                    info(7, 'Streaming science field data: expecting '
+                         f'{data_pr["nstars_sf"]:,.0f} objects')
+                    coord_table, ext_s, digest = cls.stream_science_field(
+                        session_id, xnicer, data_pr, columns, coords, info, dtype)
+                    stream_keys(digest)
+
+                def science_field():
+                    return AstrometricCatalogue.from_table(
+                        coord_table, coords, unit='deg', frame=frame), ext_s
+            else:
+                info(7,
+                     f'Retrieving science field data: expecting {data_pr["nstars_sf"]:,.0f} objects')
+                sf_data = cls.retrieve_data(session_id, 1, data_pr['urls_sf'],
+                                            logger=lambda message: info(8, message),
+                                            expected_records=data_pr["nstars_sf"],
+                                            columns=columns)
+                info(9, f'{len(sf_data):,.0f} objects found')
+                checkpoints.key('sf', extra=table_digest(sf_data).hexdigest())
+                checkpoints.key('predict', ['calibration', 'sf'], extra=np.dtype(dtype).name)
+
+                # The raw science field table is released as soon as it has
+                # been converted
+                def science_field():
+                    nonlocal sf_data
+                    coord_s = AstrometricCatalogue.from_table(
+                        sf_data, coords, unit='deg', frame=frame)
+
+                    def predict():
+                        nonlocal sf_data
+                        info(9, 'Converting photometric data')
+                        phot_s = cls.photometric_catalogue(sf_data, data_pr, dtype=dtype)
+                        sf_data = None
+                        return cls.predict_science_field(phot_s, xnicer, info)
+
+                    ext_s = checkpoints.get('predict', predict,
+                                            logger=lambda message: info(9, message))
+                    sf_data = None
+                    return coord_s, ext_s
+            checkpoints.key('map', ['predict'], extra=map_extra)
+            if checkpoints.valid_product('map', product_path):
+                checkpoints.release()
+                info(10, 'Using the results of the map stage of a previous run')
+                info(11, 'Saving results')
             else:
-                w.wcs.ctype = [f'RA---{wcs["projection"]}',
-                               f'DEC--{wcs["projection"]}']
-            w.wcs.crval = [wcs['crval1'], wcs['crval2']]
-            w.wcs.cdelt = [-wcs['scale'] / 3600.0, wcs['scale'] / 3600.0]
-            w.wcs.crota = [0.0, wcs['crota2']]
-            if isinstance(wcs['lonpole'], (int, float)) and \
-                wcs['lonpole'] == wcs['lonpole']:
-                w.wcs.lonpole = wcs['lonpole']
-            if isinstance(wcs['latpole'], (int, float)) and \
-                    wcs['latpole'] == wcs['latpole']:
-                w.wcs.latpole = wcs['latpole']
-            if coord_s.equinox:
-                w.wcs.equinox = np.round(coord_s.equinox.decimalyear)
-            smoother = KDE(tuple(reversed(w.pixel_shape)), max_power=2,
-                           bandwidth=data_pr['smoothpar'])
-            use_xnicest = bool(
-                {'XNICEST map', 'XNICEST inverse variance'} & set(data_pr['products']))
-            hdu = make_maps(getattr(coord_s, wcs_frame), ext_s, w,
-                            smoother, n_iters=data_pr['clipIters'],
-                            tolerance=data_pr['clipping'], use_xnicest=use_xnicest)
-            info(11, 'Saving results')
-            hdu.writeto(f'processes/process_{session_id}.fits', overwrite=True,
-                        checksum=True)
+                coord_s, ext_s = science_field()
+                hdu = cls.science_field_maps(coord_s, ext_s, data_pr, wcs_frame, info)
+                del coord_s, ext_s
+                checkpoints.release()
+                checkpoints.tag('map', hdu.header)
+                if digest is not None:
+                    hdu.header['SFDIGEST'] = (digest, 'Digest of the streamed science field')
+                info(11, 'Saving results')
+                # The product is the checkpoint of the map stage: it is
+                # written atomically, so that an interrupted write is not
+                # taken for a valid product
+                tmp_path = f'{product_path}.{os.getpid()}.tmp'
+                try:
+                    hdu.writeto(tmp_path, overwrite=True, checksum=True)
+                    os.replace(tmp_path, product_path)
+                finally:
+                    if os.path.exists(tmp_path):
+                        os.unlink(tmp_path)
+                del hdu
+            cls.write_planes(session_id)
+            cls.write_hips(session_id)
             info(12, 'Process completed', state='end')
         except KeyboardInterrupt:
             logging.info('Keyboard Interrupt')
@@ -1570,12 +4267,302 @@ class AppServer:
             if interactive_mode:
                 raise ValueError from e
 
+    @classmethod
+    def stream_to_file(cls, response: requests.Response, path: str,
+                       logger: Callable[[str], Any] = logging.info,
+                       expected_records: Optional[int] = None,
+                       votable: bool = False) -> int:
+        """Write the content of a streamed HTTP response directly to a file.
+
+        The response is consumed in blocks of `DOWNLOAD_BLOCK_SIZE` bytes,
+        which are written to disk as they arrive: at no time the whole reply
+        is kept in memory. The progress of the download is reported through
+        the logger using `%` messages.
+
+        Parameters
+        ----------
+        response : requests.Response
+            The response, obtained with `stream=True`.
+        path : str
+            The path of the output file; it will be overwritten if present.
+        logger : Callable[[str], Any], optional
+            A logging utility accepting a single string; by default logging.info
+        expected_records : int, optional
+            The expected number of records, or None if no value is available
+        votable : bool, default = False
+            If True, the response is a VOTable (used only to estimate the
+            total size when the server does not provide a `Content-Length`);
+            otherwise, it is taken to be a FITS file.
+
+        Returns
+        -------
+        size : int
+            The total number of bytes written.
+        """
+        file_size = int(response.headers.get('Content-Length', 0))
+        total_size = 0
+        cur_size = 0
+        with open(path, 'wb') as out:
+            for block in response.iter_content(DOWNLOAD_BLOCK_SIZE):
+                total_size += len(block)
+                cur_size += len(block)
+                if file_size <= 0:
+                    if votable:
+                        records = re.findall(r'<TR>.*?</TR>', str(block), re.MULTILINE)
+                        if expected_records and records:
+                            reclen = np.median([len(m) for m in records])
+                            file_size = int(reclen * expected_records)
+                        else:
+                            file_size = -len(block) * 50
+                    else:
+                        m1 = re.search(r'NAXIS1 *= *([0-9]+)', str(block))
+                        m2 = re.search(r'NAXIS2 *= *([0-9]+)', str(block))
+                        if m1 and m2:
+                            file_size = int(m1.group(1)) * int(m2.group(1))
+                        else:
+                            file_size = -len(block) * 500
+                    file_size = file_size or -1
+                if cur_size > abs(file_size):
+                    cur_size = cur_size % abs(file_size)
+                logger(f'%{cur_size / abs(file_size) * 100}')
+                out.write(block)
+        return total_size
+
+    @classmethod
+    def read_table(cls, path: str, votable: bool = False) -> Table:
+        """Read a table saved by `stream_to_file`.
+
+        FITS tables are memory-mapped, so that only the columns actually used
+        by the pipeline are loaded in memory (and only when accessed).
+        VOTables, instead, need to be fully parsed.
+        """
+        if votable:
+            return Table.read(path, format='votable')
+        return Table.read(path, format='fits', memmap=True)
+
+    @classmethod
+    def store_query_cache(cls, job_url: str, path: str, votable: bool = False):
+        """Save the results of a query in the shared query cache.
+
+        Only FITS results of queries registered in the cache are saved; errors
+        are logged and otherwise ignored.
+        """
+        if votable:
+            return
+        try:
+            key = QUERY_CACHE.lookup(job_url)
+            if key:
+                QUERY_CACHE.put(key, path)
+        except Exception:
+            logging.exception('Could not save the results in the query cache')
+
+    @classmethod
+    def assemble_tiles(cls, spec: dict, tables: Sequence[Table] = (),
+                       logger: Callable[[str], Any] = logging.info) -> List[Table]:
+        """Build the result of a tiled query.
+
+        The newly downloaded data (if any) are split into tiles and saved in
+        the tile cache; then the data of all tiles covering the region are
+        collected, and the exact geometric constraint is applied.
+
+        Parameters
+        ----------
+        spec : dict
+            The tiled query specification, as created by `submit_tiled_query`.
+        tables : Sequence[Table]
+            The results of the queries of the various shards, if any.
+        logger : Callable[[str], Any], optional
+            A logging utility accepting a single string; by default logging.info
+
+        Returns
+        -------
+        parts : List[Table]
+            The list of the tables (one per shard or cached tile) that,
+            together, make up the result of the query.
+
+        Raises
+        ------
+        ValueError
+            If a shard was truncated to `MAX_OBJS` objects, or if the cached
+            tiles have expired.
+        """
+        nside = hp.order2nside(spec['order'])
+        region = spec['region']
+        missing = set(spec['missing'])
+        parts = []
+        for shard, table in zip(spec['shards'], tables):
+            # The shards cover whole tiles, larger than the region: a truncated
+            # shard would silently lose objects of the region
+            if len(table) >= MAX_OBJS:
+                logger('Too many objects in the tiles covering the region: '
+                       'please reduce the area or add constraints')
+                raise ValueError('Truncated tiled query')
+            lon = np.ma.filled(np.ma.asarray(table[region['lon']], dtype=np.float64), np.nan)
+            lat = np.ma.filled(np.ma.asarray(table[region['lat']], dtype=np.float64), np.nan)
+            good = np.isfinite(lon) & np.isfinite(lat)
+            table, lon, lat = table[good], lon[good], lat[good]
+            pix = hp.ang2pix(nside, lon, lat, nest=True, lonlat=True) \
+                if len(table) > 0 else np.zeros(0, dtype=np.int64)
+            cls.store_tiles(spec['store'], shard['tiles'], table, pix)
+            # Shards can overlap: keep only the objects in the shard tiles
+            parts.append(table[region_mask(lon, lat, region) & np.isin(pix, shard['tiles'])])
+        for tile in spec['tiles']:
+            if tile in missing:
+                continue
+            path = TILE_CACHE.get(f"{spec['store']}-{tile}")
+            if path is None:
+                logger('The cached tiles have expired: please repeat the query')
+                raise ValueError('Expired tile cache')
+            data = cls.read_table(path)
+            parts.append(data[region_mask(data[region['lon']], data[region['lat']], region)])
+        return parts
+
+    @classmethod
+    def store_tiles(cls, store: str, tiles: Sequence[int], table: Table, pix: np.ndarray):
+        """Save a set of tiles of a tiled query in the tile cache.
+
+        Parameters
+        ----------
+        store : str
+            The key of the tile store.
+        tiles : Sequence[int]
+            The tiles to save: all of them must be fully covered by the table.
+        table : Table
+            The result of the query for the tiles.
+        pix : np.ndarray
+            The tile of each row of the table.
+        """
+        table.meta.pop('description', None)
+        order = np.argsort(pix, kind='stable')
+        sorted_pix = pix[order]
+        for tile in tiles:
+            start, end = np.searchsorted(sorted_pix, [tile, tile + 1])
+            TILE_CACHE.put_table(f'{store}-{tile}', table[order[start:end]], evict=False)
+        TILE_CACHE.evict()
+
+    @staticmethod
+    def _sql_column(values: Sequence[Any], sql_type: Optional[str]) -> np.ndarray:
+        """Convert the values of a result column into a typed array.
+
+        NULL values are converted into NaNs for numeric columns, and into
+        empty strings for text columns.
+        """
+        if sql_type == 'REAL' or (sql_type == 'INTEGER' and None in values):
+            return np.array(values, dtype=np.float64)
+        if sql_type == 'INTEGER':
+            return np.array(values, dtype=np.int64)
+        if sql_type == 'TEXT':
+            return np.array(['' if v is None else v for v in values], dtype=str)
+        # Computed column: let numpy find the type
+        return np.array([np.nan if v is None else v for v in values])
+
+    @classmethod
+    def fetch_sql(cls, con: sqlite3.Connection, sql_query: str) -> Table:
+        """Execute a SQL query and return the result as a table.
+
+        The rows are fetched in chunks of `LOCAL_FETCH_CHUNK` and converted
+        column by column into typed arrays, using the column types of the
+        table `main`; the chunks are then joined with a `TableAccumulator`.
+        """
+        sql_types = {row[1]: row[2].upper()
+                     for row in con.execute('PRAGMA table_info(main)')}
+        cur = con.execute(sql_query)
+        names = [description[0] for description in cur.description]
+        accumulator = TableAccumulator(names)
+        while True:
+            rows = cur.fetchmany(LOCAL_FETCH_CHUNK)
+            if not rows:
+                break
+            columns = [cls._sql_column(values, sql_types.get(name))
+                       for name, values in zip(names, zip(*rows))]
+            accumulator.append(Table(columns, names=names, copy=False))
+        if len(accumulator) == 0:
+            return Table(names=names)
+        return accumulator.to_table()
+
+    @classmethod
+    def local_query(cls, session_id: str, spec: dict) -> Table:
+        """Execute a query on the local table of a session.
+
+        The query is evaluated with numpy on the memory-mapped columnar copy
+        of the table (see `local_table`). The region is first converted into
+        the set of HEALPix pixels covering it, and the corresponding rows are
+        found by binary search on the sorted spatial index: the exact
+        geometric test, and the other conditions, are then applied only to
+        these candidate rows, reading just the columns involved. Conditions
+        that are not simple comparisons (see `condition_mask`) are evaluated
+        by sqlite, on an in-memory database loaded with the rows that satisfy
+        all other constraints.
+
+        Parameters
+        ----------
+        session_id : str
+            The unique session id
+        spec : dict
+            The query specification, as produced by `execute_local_query`.
+        """
+        table = cls.local_table(session_id)
+        pixels = region_cover(hp.order2nside(LOCAL_INDEX_ORDER), spec['region'])
+        rows = index_rows(table['__idx'], pixels)
+        rows = rows[region_mask(table['__ra'][rows], table['__dec'][rows],
+                                spec['region'])]
+        complex_conditions = []
+        for condition in spec['conditions']:
+            name = condition[0].strip().strip('"')
+            cond_mask = None
+            if name in table.colnames:
+                cond_mask = condition_mask(Table([table[name][rows]], copy=False),
+                                           condition)
+            if cond_mask is None:
+                complex_conditions.append(''.join(condition))
+            else:
+                rows = rows[cond_mask]
+        fields = list(spec['fields'])
+        if not complex_conditions:
+            return Table([table[name][rows] for name in fields], copy=False)
+        result = table[rows]
+        con = sqlite3.connect(':memory:')
+        try:
+            names = [name for name in result.colnames
+                     if result[name].ndim == 1 and result[name].dtype.kind != 'V']
+            types = ['REAL' if result[name].dtype.kind == 'f' else
+                     'INTEGER' if result[name].dtype.kind in 'biu' else 'TEXT'
+                     for name in names]
+            con.execute('CREATE TABLE main (' +
+                        ', '.join(f'"{n}" {t}' for n, t in zip(names, types)) + ')')
+            insert = f'INSERT INTO main VALUES ({", ".join("?" * len(names))})'
+            for start in range(0, len(result), LOCAL_INGEST_CHUNK):
+                chunk = result[start:start + LOCAL_INGEST_CHUNK]
+                con.executemany(insert, zip(*[cls._sql_values(chunk[name])
+                                              for name in names]))
+            sql_query = f"SELECT {', '.join(fields)} FROM main " + \
+                f"WHERE {' AND '.join(complex_conditions)}"
+            return cls.fetch_sql(con, sql_query)
+        finally:
+            con.close()
+
     @classmethod
     def retrieve_data(cls, session_id: str, step: Literal[1, 2], urls: Sequence[str],
                       logger: Callable[[str], Any] = logging.info,
-                      expected_records: Optional[int] = None):
+                      expected_records: Optional[int] = None,
+                      columns: Optional[Sequence[str]] = None,
+                      consumer: Optional[Callable[[Table], Any]] = None) -> Optional[Table]:
         """General function to retrieve data from previously set queries.
 
+        Remote data are streamed directly to disk, in the file
+        `processes/process_ID_cacheN.fits`, and then memory-mapped: this way
+        the memory used is close to the size of the columns actually used.
+        Results of remote queries are also saved in the shared query cache,
+        and results already present there (URLs `cache://key`) are taken
+        directly from it. Tiled queries (URLs `tiles://spec`) are assembled
+        from the spatial tile cache, after the missing tiles are downloaded.
+
+        All URLs, and all shards of tiled queries, are downloaded concurrently
+        using at most `RETRIEVE_MAX_THREADS` threads (and at most
+        `SERVER_MAX_CONNECTIONS` connections per server). The progress is
+        reported as a single, combined percentage. The results are then
+        joined column by column, keeping only the requested columns.
+
         Parameters
         ----------
         session_id : str
@@ -1591,28 +4578,26 @@ class AppServer:
             A logging utility accepting a single string; by default logging.info
         expected_records : int, optional
             The expected number of records, or None if no value is available
+        columns : Sequence[str], optional
+            The columns actually needed: if provided, all other columns are
+            dropped.
+        consumer : Callable[[Table], Any], optional
+            If provided, the data are not joined: each part is passed to this
+            function as soon as it is available (possibly concurrently, from
+            the download threads) and then released, and None is returned.
         """
 
-        def fetcher(job):
-            def reader(nbytes, data):
-                result = response.raw.read(nbytes)
-                if data[1] <= 0:
-                    if expected_records:
-                        reclen = np.median([len(m) for m in re.findall(
-                            r'<TR>.*?</TR>', str(result), re.MULTILINE)])
-                        data[1] = reclen * expected_records
-                    else:
-                        data[1] = len(result) * 50
-                if data[0] > abs(data[1]):
-                    data[0] = data[0] % abs(data[1])
-                logger(f'%{data[0] / abs(data[1]) * 100}')
-                return result
+        def prune(table):
+            # Select the columns without copying (memory-mapped) data
+            if columns is None:
+                return table
+            return Table([table[name] for name in columns if name in table.colnames],
+                         meta=table.meta, copy=False)
 
-            # This code is taken from
+        def fetcher(job, path, log):
+            # This code is adapted from
             # https://pyvo.readthedocs.io/en/latest/_modules/pyvo/dal/tap.html#AsyncTAPJob.fetch_result
-            # pylint: disable=protected-access, import-outside-toplevel
-            import functools
-            from astropy.io.votable import parse as votableparse
+            # pylint: disable=protected-access
             try:
                 response = job._session.get(job.result_uri, stream=True)
                 response.raise_for_status()
@@ -1621,136 +4606,185 @@ class AppServer:
                 # we propably got a 404 because query error. raise with error msg
                 job.raise_if_error()
                 raise vo.DALServiceError.from_except(ex, job.url)
-            response.raw.read = functools.partial(
-                response.raw.read, decode_content=True)
-            file_size = int(response.headers.get('Content-Length', 0))
-            data = [0, file_size]
-            if TAP_RETURN_TYPE == 'votable':
-                return vo.dal.TAPResults(votableparse(lambda n: reader(n, data)),
-                                         url=job.result_uri, session=job._session).to_table()
-            else:
-                content = []
-                cur_size = 0
-                for block in response.iter_content(None):
-                    cur_size += len(block)
-                    if file_size <= 0:
-                        m1 = re.search(r'NAXIS1 *= *([0-9]+)', str(block))
-                        m2 = re.search(r'NAXIS2 *= *([0-9]+)', str(block))
-                        if m1 and m2:
-                            file_size = int(m1.group(1)) * int(m2.group(1))
+            cls.stream_to_file(response, path, logger=log,
+                               expected_records=expected_records,
+                               votable=TAP_RETURN_TYPE == 'votable')
+
+        def fetch_tap(job_url, path, log):
+            job = vo.dal.tap.AsyncTAPJob(job_url)
+            n_fails = 0
+            while True:
+                log(f'Retrieving data from URL {job_url}')
+                try:
+                    job.wait(['COMPLETED', 'ERROR', 'ABORTED'], timeout=TAP_TIMEOUT)
+                    if job.phase == 'COMPLETED':
+                        fetcher(job, path, log)
+                        log('Parsing the answer')
+                        return cls.read_table(path, votable=TAP_RETURN_TYPE == 'votable')
+                    else:
+                        log(f'Unexpected job phase: {job.phase}')
+                        raise vo.DALQueryError(f'Unexpected job phase: {job.phase}')
+                except Exception as e:
+                    n_fails += 1
+                    if n_fails < TAP_MAX_FAILS:
+                        if job.phase == 'COMPLETED':
+                            log(f'Error: {e}')
                         else:
-                            file_size = -len(block) * 500
-                    if cur_size > abs(file_size):
-                        cur_size = cur_size % abs(file_size)
-                    logger(f'%{cur_size / abs(file_size) * 100}')
-                    content.append(block)
-                logger('Parsing the answer')
-                response._content = b''.join(content) or b''
-                return Table.read(BytesIO(response._content))
-
-        # pylint: disable=protected-access
-        cache_path = f'processes/process_{session_id}_cache{step}.fits'
-        if USE_CACHE and os.path.isfile(cache_path):
-            logger('Using cached results')
-            return Table.read(cache_path)
-        results: Optional[Table] = None
-        n_fails = 0
-        for job_url in urls:
+                            log(f'Job still in phase {job.phase}: trying again')
+                    else:
+                        log(f'Cannot retrieve the data after {n_fails} tries: giving up')
+                        raise
+
+        def download(job_url, path, log):
+            # Retrieve a single (non-tiled) URL: returns the table and a flag
+            # set if the table is just the content of the FITS file path
+            # pylint: disable=protected-access
+            if job_url[:8] == 'cache://':
+                log('Using results from the query cache')
+                cached_path = QUERY_CACHE.get(job_url[8:])
+                if cached_path is None:
+                    log('The cached results have expired: please repeat the query')
+                    raise ValueError('Expired query cache')
+                link_or_copy(cached_path, path)
+                return cls.read_table(path), True
             if job_url[:9] == 'vizier://':
-                logger('Retrieving data from VizieR')
+                log('Retrieving data from VizieR')
                 try:
                     payload = job_url[9:]
                     response = Vizier._request(
                         method='POST', url=Vizier._server_to_url(return_type=VIZIER_RETURN_TYPE),
                         data=payload, timeout=VIZIER_TIMEOUT, cache=False, stream=True)
-                    file_size = int(response.headers.get('Content-Length', 0))
-                    content = []
-                    cur_size = 0
-                    for block in response.iter_content(None):
-                        cur_size += len(block)
-                        if file_size <= 0:
-                            if VIZIER_RETURN_TYPE == 'votable':
-                                if expected_records:
-                                    reclen = np.median([len(m) for m in re.findall(
-                                        r'<TR>.*?</TR>', str(block), re.MULTILINE)])
-                                    file_size = reclen * expected_records
-                                else:
-                                    file_size = len(block) * 50
-                            else:
-                                m1 = re.search(r'NAXIS1 *= *([0-9]+)', str(block))
-                                m2 = re.search(r'NAXIS2 *= *([0-9]+)', str(block))
-                                if m1 and m2:
-                                    file_size = int(m1.group(1)) * int(m2.group(1))
-                                else:
-                                    file_size = -len(block) * 500
-                        if cur_size > abs(file_size):
-                            cur_size = cur_size % abs(file_size)
-                        logger(f'%{cur_size / abs(file_size) * 100}')
-                        content.append(block)
-                    logger('Parsing the answer')
-                    response._content = b''.join(content) or b''
-                    if VIZIER_RETURN_TYPE == 'votable':
-                        result = Vizier._parse_result(response)
-                        if len(result) > 0:
-                            result = result[0]
-                        else:
-                            result = None
-                    else:
-                        result = Table.read(BytesIO(response._content))
+                    votable = VIZIER_RETURN_TYPE == 'votable'
+                    cls.stream_to_file(response, path, logger=log,
+                                       expected_records=expected_records,
+                                       votable=votable)
+                    log('Parsing the answer')
+                    result = cls.read_table(path, votable=votable)
+                    cls.store_query_cache(job_url, path, votable=votable)
+                    return result, not votable
                 except Exception:
-                    logger('Cannot retrieve the data: giving up')
+                    log('Cannot retrieve the data: giving up')
                     raise
-            elif job_url[:8] == 'local://':
-                sql_query = job_url[8:]
-                dbpath = f"local_cache/db-{session_id}.db"
-                con = sqlite3.connect(dbpath)
-                con.row_factory = sqlite3.Row
-                cur = con.execute(sql_query)
-                table = cur.fetchall()
-                con.close()
-                # Convert invalid values to NaNs
-                rows = ((v if v is not None else np.nan for v in line) for line in table)
-                # Convert everything into a table
-                result = Table(rows=rows, names=table[0].keys())
+            if job_url[:8] == 'local://':
+                log('Querying the local database')
+                return cls.local_query(session_id, json.loads(job_url[8:])), False
+            result = fetch_tap(job_url, path, log)
+            votable = TAP_RETURN_TYPE == 'votable'
+            cls.store_query_cache(job_url, path, votable=votable)
+            return result, not votable
+
+        cache_path = f'processes/process_{session_id}_cache{step}.fits'
+        if USE_CACHE and os.path.isfile(cache_path):
+            results = cls.read_table(cache_path)
+            if columns is None or set(columns) <= set(results.colnames):
+                logger('Using cached results')
+                if consumer is not None:
+                    consumer(prune(results))
+                    return None
+                return prune(results)
+            logger('Cached results lack some columns: retrieving the data again')
+            del results
+        # List of downloads: (URL index, URL, part path)
+        specs = [json.loads(job_url[8:]) if job_url[:8] == 'tiles://' else None
+                 for job_url in urls]
+        tasks = []
+        for n, job_url in enumerate(urls):
+            if specs[n] is None:
+                tasks.append((n, job_url, f'processes/process_{session_id}_cache{step}_{n}.part'))
             else:
-                job = vo.dal.tap.AsyncTAPJob(job_url)
-                while True:
-                    logger(f'Retrieving data from URL {job_url}')
-                    try:
-                        job.wait(['COMPLETED', 'ERROR', 'ABORTED'], timeout=TAP_TIMEOUT)
+                for m, shard in enumerate(specs[n]['shards']):
+                    tasks.append((n, shard['job'],
+                                  f'processes/process_{session_id}_cache{step}_{n}_{m}.part'))
+        part_paths = [task[2] for task in tasks]
+        # Combined progress report
+        progress = np.zeros(len(tasks))
+        lock = threading.Lock()
 
-                        # result = job.fetch_result().to_table()
-                        result = fetcher(job)
-                        if job.phase == 'COMPLETED':
-                            break
-                        else:
-                            logger(f'Unexpected job phase: {job.phase}')
-                            raise vo.DALQueryError(f'Unexpected job phase: {job.phase}')
-                    except Exception as e:
-                        n_fails += 1
-                        if n_fails < TAP_MAX_FAILS:
-                            if job.phase == 'COMPLETED':
-                                logger(f'Error: {e}')
-                            else:
-                                logger(f'Job still in phase {job.phase}: trying again')
-                        else:
-                            logger(f'Cannot retrieve the data after {n_fails} tries: giving up')
-                            raise
-            if result:
-                if results:
-                    results = np.vstack((results, result))
-                else:
-                    results = result
-        if USE_CACHE and results:
+        def task_logger(k):
+            def log(message):
+                with lock:
+                    if len(message) and message[0] == '%':
+                        progress[k] = float(message[1:])
+                        logger(f'%{np.mean(progress)}')
+                    else:
+                        logger(message)
+            return log
+
+        def run(k):
+            n, job_url, path = tasks[k]
+            with server_semaphore(job_url):
+                output = download(job_url, path, task_logger(k))
+            progress[k] = 100.0
+            if consumer is not None and specs[n] is None:
+                # Consume the part while the other downloads proceed
+                if output[0] is not None and len(output[0]) > 0:
+                    consumer(prune(output[0]))
+                return None, False
+            return output
+
+        outputs = []
+        if tasks:
+            with ThreadPoolExecutor(max_workers=min(RETRIEVE_MAX_THREADS, len(tasks))) \
+                    as executor:
+                outputs = list(executor.map(run, range(len(tasks))))
+        parts = []
+        direct = False
+        for n, job_url in enumerate(urls):
+            url_outputs = [output for task, output in zip(tasks, outputs) if task[0] == n]
+            if specs[n] is None:
+                result, direct = url_outputs[0]
+                parts.append(result)
+            else:
+                logger('Assembling the data from the tile cache')
+                parts.extend(cls.assemble_tiles(specs[n], [output[0] for output in url_outputs],
+                                                logger=logger))
+                direct = False
+        del outputs
+        parts = [part for part in parts if part is not None and len(part) > 0]
+        if consumer is not None:
+            for part in parts:
+                consumer(prune(part))
+            del parts
+            for part_path in part_paths:
+                try:
+                    os.unlink(part_path)
+                except (FileNotFoundError, PermissionError):
+                    pass
+            return None
+        if not parts:
+            logger('Cannot retrieve the data: giving up')
+            raise ValueError
+        if len(urls) == 1 and len(part_paths) == 1 and direct:
+            # Single FITS download: the file is already the cache, no need to
+            # write the data again
+            del parts
+            os.replace(part_paths.pop(), cache_path)
+            results = prune(cls.read_table(cache_path))
+        else:
+            # Join the tables: the tables are memory-mapped, and only the
+            # relevant columns are copied once into preallocated buffers
+            accumulator = TableAccumulator(columns, size=sum(len(part) for part in parts))
+            for part in parts:
+                accumulator.append(part)
+            del parts
+            results = accumulator.to_table()
             if 'description' in results.meta:
                 # Remove this keyword: too long...
                 del results.meta['description']
-            results.write(cache_path)
-        if results:
-            return results
-        else:
-            logger('Cannot retrieve the data: giving up')
-            raise ValueError
+            results.write(cache_path, overwrite=True)
+        for part_path in part_paths:
+            try:
+                os.unlink(part_path)
+            except (FileNotFoundError, PermissionError):
+                pass
+        if not USE_CACHE:
+            # The table is memory-mapped: on POSIX systems the data remain
+            # accessible until the table is released
+            try:
+                os.unlink(cache_path)
+            except (FileNotFoundError, PermissionError):
+                pass
+        return results
 
 
 if __name__ == '__main__':
@@ -1776,15 +4810,34 @@ if __name__ == '__main__':
    
 
     # sys.argv.append('process_b9d7dbf80665f444334e11ffd0fb027560c7b760.dat')
-    if len(sys.argv) > 1:
+    if len(sys.argv) > 1 and sys.argv[1] == '--worker':
+        # Only run pipeline workers: useful for additional hosts sharing the
+        # processes directory. The optional argument is the number of workers.
+        mp.set_start_method('spawn')
+        worker_pool = WorkerPool(int(sys.argv[2]) if len(sys.argv) > 2 else 3)
+        try:
+            while True:
+                worker_pool.supervise()
+                time.sleep(JOB_POLL_INTERVAL)
+        finally:
+            worker_pool.stop()
+    elif len(sys.argv) > 1:
         print("sys.argv = ", len(sys.argv) )
-        # Interpret the 1st argument as a session id
+        # Interpret the 1st argument as a process file; the optional
+        # `--resume STAGE` arguments select the stage to resume the pipeline from
         current_filename = sys.argv[1]
+        current_resume = None
+        if len(sys.argv) > 3 and sys.argv[2] == '--resume':
+            current_resume = sys.argv[3]
+            if current_resume not in PIPELINE_STAGES:
+                sys.exit(f'Unknown pipeline stage {current_resume}: '
+                         f'use one of {", ".join(PIPELINE_STAGES)}')
         with open(current_filename, 'rb') as f:
             current_session_id = pickle.load(f)
             current_data_pr = pickle.load(f)
-            current_process_log: List[ProcessLogEntry] = []
-            AppServer.do_process(current_session_id, current_process_log, current_data_pr)
+            current_process_log = MemoryProcessLog()
+            AppServer.do_process(current_session_id, current_process_log, current_data_pr,
+                                 resume=current_resume)
     else:
        
         if DAEMONIZE:
@@ -1833,6 +4886,7 @@ if __name__ == '__main__':
         # CherryPy global configuration
         cherrypy.config.update({'server.socket_host': SOCKET_HOST,
                                 'server.socket_port': SOCKET_PORT,
+                                'server.thread_pool': SERVER_THREAD_POOL,
                                 'server.max_request_body_size': 524288000,
                                 'log.access_file': log_access_path,
                                 'log.error_file': log_error_path
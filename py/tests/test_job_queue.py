@@ -0,0 +1,141 @@
+"""Tests of the persistent job queue and of the process logs."""
+
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402  pylint: disable=wrong-import-position
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return main.JobQueue(str(tmp_path / 'queue.db'))
+
+
+def entry(message, state='run', step=1):
+    return {'time': 0.0, 'state': state, 'step': step, 'message': message}
+
+
+def test_submit_creates_queued_job(queue):
+    log = queue.submit('s1', 10)
+    assert [e['message'] for e in log] == ['Waiting in the queue']
+    assert queue.position('s1') == {'position': 1, 'wait': None}
+
+
+def test_submit_rejects_expensive_jobs(queue):
+    with pytest.raises(ValueError):
+        queue.submit('s1', main.JOB_MAX_COST + 1)
+
+
+def test_submit_replaces_previous_job(queue):
+    first = queue.submit('s1', 10)
+    second = queue.submit('s1', 10)
+    assert first.job_id != second.job_id
+    assert queue.log('s1').job_id == second.job_id
+
+
+def test_claim_order_and_budget(queue):
+    queue.submit('s1', 10)
+    queue.submit('s2', 20, priority=1)
+    session_id, _ = queue.claim('host', 1, max_cost=25)
+    assert session_id == 's2'
+    # The remaining job does not fit the budget of the host
+    assert queue.claim('host', 2, max_cost=25) is None
+    # but fits the budget of another host
+    session_id, _ = queue.claim('other', 3, max_cost=25)
+    assert session_id == 's1'
+    assert queue.claim('other', 4) is None
+
+
+def test_finish_uses_last_log_state(queue):
+    queue.submit('s1', 10)
+    _, log = queue.claim('host', 1)
+    log.append(entry('Process completed', state='end'))
+    queue.finish(log)
+    assert queue.claim('host', 1) is None
+    assert queue.position('s1') is None
+
+
+def test_heartbeat_prevents_requeue(queue):
+    queue.submit('s1', 10)
+    _, log = queue.claim('host', 1)
+    time.sleep(0.05)
+    assert queue.heartbeat(log.job_id)
+    queue.requeue(timeout=0.04)
+    assert queue.position('s1') is None
+    time.sleep(0.05)
+    queue.requeue(timeout=0.04)
+    assert queue.position('s1') == {'position': 1, 'wait': None}
+
+
+def test_requeue_jobs_of_host(queue):
+    queue.submit('s1', 10)
+    queue.claim('host', 1)
+    queue.requeue('other')
+    assert queue.position('s1') is None
+    queue.requeue('host')
+    session_id, _ = queue.claim('other', 2)
+    assert session_id == 's1'
+
+
+def test_abort_queued_job(queue):
+    queue.submit('s1', 10)
+    queue.abort('s1')
+    assert queue.claim('host', 1) is None
+
+
+def test_abort_running_job(queue):
+    queue.submit('s1', 10)
+    _, log = queue.claim('host', 1)
+    assert queue.heartbeat(log.job_id)
+    queue.abort('s1')
+    assert not queue.heartbeat(log.job_id)
+    with pytest.raises(KeyboardInterrupt):
+        log.append(entry('Still running'))
+    assert queue.overdue('host', timeout=-1) == [(log.job_id, 1)]
+    queue.killed(log.job_id)
+    assert queue.log('s1')[-1]['state'] == 'abort'
+
+
+def test_abort_closes_log(queue):
+    queue.submit('s1', 10)
+    _, log = queue.claim('host', 1)
+    log.append(entry('Working', step=3))
+    queue.abort('s1', 'Stopping')
+    with pytest.raises(KeyboardInterrupt):
+        log.append(entry('Still running'))
+    assert queue.log('s1')[-1] == {'seq': 3, 'time': 0.0, 'state': 'abort',
+                                   'step': 3, 'message': 'Stopping'}
+    queue.finish(log)
+    assert queue.claim('host', 1) is None
+    assert queue.overdue('host', timeout=-1) == []
+
+
+def test_resubmit_detaches_running_job(queue):
+    queue.submit('s1', 10)
+    _, log = queue.claim('host', 1)
+    queue.submit('s1', 10)
+    assert not queue.heartbeat(log.job_id)
+    with pytest.raises(KeyboardInterrupt):
+        log.progress(entry('%50'))
+
+
+def test_log_ring_and_progress(queue, monkeypatch):
+    monkeypatch.setattr(main, 'JOB_LOG_SIZE', 3)
+    queue.submit('s1', 10)
+    _, log = queue.claim('host', 1)
+    for n in range(5):
+        log.append(entry(f'message {n}'))
+    entries, progress = log.read()
+    assert [e['message'] for e in entries] == ['message 2', 'message 3', 'message 4']
+    assert progress is None
+    log.progress(entry('%10'))
+    entries, progress = log.read(since=entries[-1]['seq'])
+    assert entries == [] and progress['message'] == '%10'
+    # Progress updates closer than JOB_PROGRESS_INTERVAL are dropped
+    log.progress(entry('%20'))
+    assert log.read()[1]['message'] == '%10'
@@ -157,6 +157,8 @@ const ConfirmButton = (props) => {
 
 export const MyForm4 = observer((props) => {
   const [log, setLog] = React.useState([]);
+  // Starts the long polling of the process log, if not running already
+  const startPolling = React.useRef(() => {});
 
   const handleAbort = action((e) => {
     const axios = require('axios').default;
@@ -170,6 +172,7 @@ export const MyForm4 = observer((props) => {
     axios
       .post('/app/process', {}, { timeout: 30000 })
       .then(action(response => {
+        startPolling.current();
       }))
       .catch(action(error => {
         console.log(error);
@@ -192,33 +195,50 @@ export const MyForm4 = observer((props) => {
 
   React.useEffect(() => {
     const axios = require('axios').default;
-    let interval = setInterval(() => {
+    let mounted = true, active = false, job = null, since = 0, progress = null,
+      entries = [];
+    const poll = () => {
       axios
-        .post('/app/monitor', {})
+        .post('/app/wait_progress', { job: job, since: since, progress: progress },
+              { timeout: 60000 })
         .then(action(response => {
+          if (!mounted) return;
           if (response.data.success) {
-            setLog(response.data.log);
+            if (response.data.job !== job) entries = [];
+            entries = entries.concat(response.data.log);
+            job = response.data.job;
+            since = response.data.next;
+            progress = response.data.progress;
+            const newLog = progress ? entries.concat([progress]) : entries;
+            setLog(newLog);
             let state;
-            if (response.data.log.length === 0) 
+            if (newLog.length === 0) 
               state = 'run';
             else
-              state = response.data.log[response.data.log.length - 1].state;
+              state = newLog[newLog.length - 1].state;
             state4.state = state;
-            if (state === 'end') {
-              clearInterval(interval);
-              interval = null;
-            }
+            // Stop polling once the process has terminated
+            if (state === 'end' || state === 'error' || state === 'abort') active = false;
           } else state4.state = 'warning';
+          if (active) setTimeout(poll, response.data.success ? 0 : 1000);
         }))
         .catch(action(error => {
           console.log(error);
           state4.state = 'warning';
+          if (active) setTimeout(poll, 1000);
         }));
-    }, 1000);
-    return ((my_interval) =>
-      (() => {
-        my_interval && clearInterval(my_interval);
-      }))(interval);
+    };
+    startPolling.current = () => {
+      if (mounted && !active) {
+        active = true;
+        poll();
+      }
+    };
+    startPolling.current();
+    return () => {
+      mounted = false;
+      active = false;
+    };
   }, []);
 
   let step = 0, message = '', subpercent = 100;